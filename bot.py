@@ -1,15 +1,40 @@
 import asyncio
+import atexit
 import sqlite3
 import json
 import base64
+import bisect
+import copy
+import functools
+import contextvars
+import hashlib
+import heapq
+import hmac
+import itertools
 import logging
-from datetime import datetime
-from aiogram import Bot, Dispatcher, types, F
+import math
+import os
+import queue
+import signal
+import socket
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, date
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from urllib.parse import parse_qsl
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
 from aiogram.filters import Command, StateFilter
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, WebAppInfo, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SetChatMenuButton
 from aiohttp import web
 
 import difflib
@@ -19,17 +44,191 @@ API_TOKEN = '8503104964:AAFQjyQlePmmsyo1tXWHdW-IZd6V9utI4pA'
 WEB_APP_URL = "https://sergeychistiy14-ai.github.io/money_app/"
 DB_PATH = 'finance_pro.db'
 
-# Включаем логирование
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("bot_debug.log"),
-        logging.StreamHandler()
-    ]
-)
+# Получение апдейтов: "polling" или "webhook".
+# В режиме webhook Telegram шлёт апдейты на тот же aiohttp сервер, что и /api/action:
+# WEBHOOK_BASE_URL - публичный https адрес (nginx проксирует /api/ на порт 8080)
+UPDATES_MODE = os.environ.get("FINGOAL_UPDATES_MODE", "polling")
+WEBHOOK_BASE_URL = os.environ.get("FINGOAL_WEBHOOK_URL", "")
+WEBHOOK_PATH = "/api/telegram"
+# Telegram присылает его в X-Telegram-Bot-Api-Secret-Token; по умолчанию выводится из токена бота
+WEBHOOK_SECRET = os.environ.get("FINGOAL_WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{API_TOKEN}".encode()).hexdigest()
+
+# Несколько процессов на общем порту (python bot.py --workers N, только webhook):
+# сколько их всего и номер текущего. Выставляет супервизор run_workers()
+WORKERS = 1
+WORKER_ID = 0
+
+# --- ЛОГИ ---
+# Обработчики вызываются только из очереди в отдельном потоке: запись на диск не блокирует event loop.
+# В файл - JSON по строке на запись, ротация по размеру и раз в сутки; в консоль - обычный текст
+LOG_PATH = "bot_debug.log"
+LOG_LEVEL = os.environ.get("FINGOAL_LOG_LEVEL", "INFO")
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 7
+# Максимум записей в очереди; при переполнении новые отбрасываются, а не ждут диска
+LOG_QUEUE_SIZE = 10000
+# Записей в секунду с одной строки кода (ERROR и выше проходят всегда)
+LOG_RATE_PER_SITE = 20
+# Шумные логгеры: пишем каждую N-ю запись
+LOG_SAMPLE_EVERY = {
+    "aiogram.event": 10,  # "Update id=... is handled" на каждый апдейт
+    "aiohttp.access": 10,  # строка на каждый HTTP запрос
+}
+
+
+class LogSampler(logging.Filter):
+    """
+    Прореживание до постановки в очередь: логгеры из LOG_SAMPLE_EVERY пишут каждую N-ю запись
+    (в записи поле sampled=N), с одной строки кода - не больше LOG_RATE_PER_SITE записей в секунду.
+    Сколько отброшено по лимиту, видно в поле suppressed следующей записи с той же строки.
+    """
+
+    def __init__(self, sample_every=LOG_SAMPLE_EVERY, rate=LOG_RATE_PER_SITE):
+        super().__init__()
+        self.sample_every = sample_every
+        self.rate = rate
+        self._seen = Counter()  # логгер -> записей всего
+        self._sites = {}  # (файл, строка) -> [начало окна, записей в окне, отброшено]
+        self._lock = threading.Lock()
+        self.sampled_out = 0
+        self.rate_limited = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        with self._lock:
+            every = self.sample_every.get(record.name)
+            if every:
+                self._seen[record.name] += 1
+                if (self._seen[record.name] - 1) % every:
+                    self.sampled_out += 1
+                    return False
+                record.sampled = every
+            site = self._sites.get((record.pathname, record.lineno))
+            if site is None or record.created - site[0] >= 1:
+                if site is not None and site[2]:
+                    record.suppressed = site[2]
+                site = self._sites[(record.pathname, record.lineno)] = [record.created, 0, 0]
+            site[1] += 1
+            if site[1] > self.rate:
+                site[2] += 1
+                self.rate_limited += 1
+                return False
+        return True
+
+
+class LogQueueHandler(QueueHandler):
+    """QueueHandler, который не ждёт места в очереди и не форматирует запись в строку заранее"""
+
+    def __init__(self, queue_):
+        super().__init__(queue_)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Аргументы и traceback раскрываем здесь (объекты могут измениться), форматирование - в потоке логов
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "src": f"{record.module}:{record.lineno}",
+            "pid": record.process,
+        }
+        for field in ("sampled", "suppressed"):
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class SizeTimeRotatingFileHandler(RotatingFileHandler):
+    """Ротация по размеру или в полночь - что наступит раньше"""
+
+    def __init__(self, filename, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backups, encoding="utf-8", delay=True)
+        # Файл со вчерашними записями (бот был остановлен в полночь) ротируется на первой же записи
+        started = os.path.getmtime(filename) if os.path.exists(filename) else time.time()
+        self.rollover_at = self._next_midnight(started)
+
+    @staticmethod
+    def _next_midnight(ts):
+        day = date.fromtimestamp(ts)
+        return datetime.combine(date.fromordinal(day.toordinal() + 1), datetime.min.time()).timestamp()
+
+    def shouldRollover(self, record):
+        return record.created >= self.rollover_at or super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = self._next_midnight(time.time())
+
+
+def _log_file_handler(path):
+    handler = SizeTimeRotatingFileHandler(path)
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+
+log_sampler = LogSampler()
+log_handler = LogQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+log_handler.addFilter(log_sampler)
+_console_log = logging.StreamHandler()
+_console_log.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_listener = QueueListener(log_handler.queue, _console_log, _log_file_handler(LOG_PATH))
+logging.basicConfig(level=LOG_LEVEL, handlers=[log_handler])
+_log_listener_running = False
+
+
+def start_log_listener():
+    global _log_listener_running
+    if not _log_listener_running:
+        log_listener.start()
+        _log_listener_running = True
+
+
+def stop_log_listener():
+    """Дописать очередь логов и остановить поток (при выходе и перед fork)"""
+    global _log_listener_running
+    if _log_listener_running:
+        log_listener.stop()
+        _log_listener_running = False
+
+
+def use_worker_log_file(worker_id):
+    """Свой файл у каждого воркера: ротация одного файла из нескольких процессов теряет записи"""
+    stop_log_listener()
+    root, ext = os.path.splitext(LOG_PATH)
+    old = log_listener.handlers[1]
+    log_listener.handlers = (_console_log, _log_file_handler(f"{root}.w{worker_id + 1}{ext}"))
+    old.close()
+    start_log_listener()
+
+
+start_log_listener()
+# atexit выполняется в обратном порядке: очередь допишется до logging.shutdown()
+atexit.register(stop_log_listener)
+# Поток не переживает fork: останавливаем до него и запускаем заново в обоих процессах
+os.register_at_fork(before=stop_log_listener, after_in_parent=start_log_listener, after_in_child=start_log_listener)
+
 bot = Bot(token=API_TOKEN)
-dp = Dispatcher()
 
 # Note: Main web_app_data handler is defined at the end of the file (web_app_data_handler)
 
@@ -55,141 +254,2063 @@ class BudgetStates(StatesGroup):
 # Главный администратор (не может быть удалён)
 ROOT_ADMIN_ID = 616706758
 
-def init_db():
-    with sqlite3.connect(DB_PATH) as conn:
-        # 1. Транзакции
-        conn.execute('''CREATE TABLE IF NOT EXISTS transactions
-                        (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                         user_id INTEGER,
-                         amount REAL,
-                         category TEXT,
-                         type TEXT,
-                         date TEXT,
-                         description TEXT)''')
-        
+# Размер пула читающих соединений
+DB_READERS = 4
+
+# Групповой коммит: сколько ждать попутчиков после первой записи и максимум записей в одном коммите
+WRITE_BATCH_WINDOW = 0.003
+WRITE_BATCH_MAX = 256
+
+# Горячие запросы, которые обязаны идти по индексу. Проверка: python bot.py --check-plans
+# Запрос регистрируется там же, где объявлен, - проверяется ровно тот текст, который выполняет код
+HOT_QUERIES = []
+
+
+def hot_query(name, sql, params):
+    """Добавить запрос в HOT_QUERIES (params - пример параметров для EXPLAIN) и вернуть его текст"""
+    HOT_QUERIES.append((name, sql, params))
+    return sql
+
+
+class Database:
+    """
+    Общий слой доступа к SQLite.
+    Читатели - пул долгоживущих соединений в потоках, чтобы медленный отчёт
+    не блокировал polling и API сервер. Запись - один поток-писатель, который
+    собирает записи из всех обработчиков и коммитит их пачкой (один fsync на пачку).
+    """
+
+    def __init__(self, path, readers=DB_READERS):
+        self.path = path
+        self.readers = readers
+        self._pool = queue.SimpleQueue()
+        self._writes = queue.SimpleQueue()
+        self._writer_thread = None
+        self._executor = None
+        self.commits = 0
+        self.writes = 0
+
+    def _connect(self, **kwargs):
+        return sqlite3.connect(self.path, timeout=30, check_same_thread=False, **kwargs)
+
+    def open(self):
+        if self._executor is not None:
+            return
+        for _ in range(self.readers):
+            self._pool.put(self._connect())
+        self._executor = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix="db")
+
+        # Транзакциями писателя управляем сами: BEGIN / SAVEPOINT на запись / COMMIT
+        writer = self._connect(isolation_level=None)
+        writer.execute("PRAGMA journal_mode=WAL")
+        writer.execute("PRAGMA synchronous=NORMAL")
+        self._writer_thread = threading.Thread(target=self._writer_loop, args=(writer,), name="db-writer", daemon=True)
+        self._writer_thread.start()
+
+    def close(self):
+        if self._executor is None:
+            return
+        self._writes.put(None)
+        self._writer_thread.join()
+        self._writer_thread = None
+        self._executor.shutdown(wait=True)
+        self._executor = None
+        while not self._pool.empty():
+            self._pool.get().close()
+
+    def _run_read(self, fn, args):
+        conn = self._pool.get()
+        try:
+            return fn(conn, *args)
+        finally:
+            self._pool.put(conn)
+
+    def _next_batch(self):
+        """Дождаться первой записи и добрать всё, что придёт за WRITE_BATCH_WINDOW"""
+        first = self._writes.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + WRITE_BATCH_WINDOW
+        while len(batch) < WRITE_BATCH_MAX:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._writes.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                # Остановка: дописываем текущую пачку и выходим на следующем круге
+                self._writes.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _writer_loop(self, conn):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            results = []
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                # Каждая запись в своём SAVEPOINT: ошибка одной не откатывает соседей по пачке
+                for fn, args, future in batch:
+                    conn.execute("SAVEPOINT w")
+                    try:
+                        results.append((future, fn(conn, *args), None))
+                        conn.execute("RELEASE w")
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO w")
+                        conn.execute("RELEASE w")
+                        results.append((future, None, e))
+                conn.execute("COMMIT")
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                results = [(future, None, e) for _, _, future in batch]
+            else:
+                self.commits += 1
+                self.writes += len(batch)
+
+            # Результаты отдаём только после COMMIT
+            for future, result, error in results:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+        conn.close()
+
+    async def read(self, fn, *args):
+        """Выполнить fn(conn, *args) на читающем соединении вне event loop"""
+        self.open()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._run_read, fn, args)
+
+    async def write(self, fn, *args):
+        """Поставить fn(conn, *args) в очередь писателя; результат - после коммита пачки"""
+        self.open()
+        future = Future()
+        self._writes.put((fn, args, future))
+        return await asyncio.wrap_future(future)
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def execute(self, sql, params=()):
+        return await self.write(lambda conn: conn.execute(sql, params).rowcount)
+
+
+db = Database(DB_PATH)
+
+
+class PeerInvalidation:
+    """
+    Сброс кэшей в соседних воркерах (--workers): кэш, сброшенный после записи в этом
+    процессе, сбрасывается и у остальных - датаграммой по localhost ("m:<user_id>" -
+    MiniAppCache, "c:<user_id>" - CategoryIndex, "p:" - права). Попадание в кэш так и
+    остаётся чтением из памяти; устаревание у соседа ограничено доставкой датаграммы.
+    UDP сокеты создаёт супервизор до fork, поэтому перезапущенный воркер получает
+    тот же адрес, а пришедшее без него дождётся в буфере сокета.
+    """
+
+    def __init__(self):
+        self.sock = None
+        self.peers = []
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+
+    @staticmethod
+    def make_sockets(count):
+        sockets = []
+        for _ in range(count):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(("127.0.0.1", 0))
+            sockets.append(sock)
+        return sockets
+
+    def attach(self, sockets, worker_id):
+        """В воркере после fork: свой сокет слушаем, на остальные шлём"""
+        self.sock = sockets[worker_id]
+        self.sock.setblocking(False)
+        self.peers = [sock.getsockname() for i, sock in enumerate(sockets) if i != worker_id]
+
+    def publish(self, kind, user_id=""):
+        if self.sock is None:
+            return
+        message = f"{kind}:{user_id}".encode()
+        for peer in self.peers:
+            try:
+                self.sock.sendto(message, peer)
+            except OSError:
+                # Буфер соседа полон (воркер завис или перезапускается) - его кэш догонит TTL/LRU
+                self.dropped += 1
+        self.sent += 1
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            message = (await loop.sock_recv(self.sock, 64)).decode()
+            self.received += 1
+            kind, _, user_id = message.partition(":")
+            if kind == "m":
+                miniapp_cache.drop(int(user_id))
+            elif kind == "c":
+                category_index.drop(int(user_id))
+            elif kind == "p":
+                permissions.loaded_at = None
+
+
+peers = PeerInvalidation()
+
+
+# FSM: как часто сбрасывать изменения в fsm_state, сколько держать неиспользуемую запись
+# в памяти и через сколько удалять брошенное состояние из базы
+FSM_FLUSH_EVERY = 1.0
+FSM_MEMORY_TTL = 600
+FSM_STATE_TTL = 7 * 24 * 3600
+FSM_SWEEP_EVERY = 300
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM storage aiogram: состояние и данные переживают перезапуск (таблица fsm_state).
+    Чтение - из памяти, при промахе - из базы. Запись сразу идёт в память, а в базу
+    уходит пачкой раз в FSM_FLUSH_EVERY (несколько изменений одного ключа - одна строка).
+    Неиспользуемые записи вытесняются из памяти через FSM_MEMORY_TTL,
+    брошенные состояния удаляются из базы через FSM_STATE_TTL.
+    """
+
+    def __init__(self):
+        self._records = {}  # ключ -> [state, data, время последнего обращения]
+        self._dirty = set()
+        # Несколько воркеров: апдейты пользователя приходят в разные процессы,
+        # поэтому слой в памяти выключен - читаем из базы и пишем в неё сразу
+        self.shared = False
+        self.loads = 0
+        self.flushed = 0
+
+    @staticmethod
+    def _key(key):
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.business_connection_id or ''}:{key.destiny}"
+
+    _LOAD_SQL = hot_query("SQLiteStorage: состояние",
+                          "SELECT state, data FROM fsm_state WHERE key = ?", ("1:1:1:::default",))
+    _SWEEP_SQL = hot_query("SQLiteStorage: брошенные состояния",
+                           "DELETE FROM fsm_state WHERE updated_at < ?", (0,))
+
+    @staticmethod
+    def _load(conn, key):
+        return conn.execute(SQLiteStorage._LOAD_SQL, (key,)).fetchone()
+
+    async def _record(self, key):
+        key = self._key(key)
+        record = None if self.shared else self._records.get(key)
+        if record is None:
+            self.loads += 1
+            row = await db.read(self._load, key)
+            # Пока читали, запись могла появиться (параллельный апдейт того же пользователя)
+            record = None if self.shared else self._records.get(key)
+            if record is None:
+                record = [row[0], json.loads(row[1]), 0] if row else [None, {}, 0]
+                if not self.shared:
+                    self._records[key] = record
+        record[2] = time.monotonic()
+        return key, record
+
+    async def _changed(self, key, record):
+        if not self.shared:
+            self._dirty.add(key)
+            return
+        await db.write(self._write, *self._rows({key: record}))
+        self.flushed += 1
+
+    async def set_state(self, key, state=None):
+        key, record = await self._record(key)
+        record[0] = state.state if isinstance(state, State) else state
+        await self._changed(key, record)
+
+    async def get_state(self, key):
+        return (await self._record(key))[1][0]
+
+    async def set_data(self, key, data):
+        key, record = await self._record(key)
+        record[1] = dict(data)
+        await self._changed(key, record)
+
+    async def get_data(self, key):
+        return dict((await self._record(key))[1][1])
+
+    @staticmethod
+    def _write(conn, upserts, deletes):
+        conn.executemany('''INSERT INTO fsm_state (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                            ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data,
+                            updated_at = excluded.updated_at''', upserts)
+        conn.executemany("DELETE FROM fsm_state WHERE key = ?", deletes)
+
+    @staticmethod
+    def _rows(records):
+        """(upserts, deletes) для _write из {ключ: запись}"""
+        now = int(time.time())
+        upserts, deletes = [], []
+        for key, (state, data, _) in records.items():
+            # Пустая запись (state.clear()) - удаляем строку
+            if state is None and not data:
+                deletes.append((key,))
+            else:
+                upserts.append((key, state, json.dumps(data, ensure_ascii=False), now))
+        return upserts, deletes
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
         try:
-            conn.execute("ALTER TABLE transactions ADD COLUMN description TEXT")
-        except sqlite3.OperationalError:
+            await db.write(self._write, *self._rows({key: self._records[key] for key in dirty}))
+        except Exception:
+            self._dirty |= dirty
+            raise
+        self.flushed += len(dirty)
+
+    @staticmethod
+    def _sweep(conn, before):
+        return conn.execute(SQLiteStorage._SWEEP_SQL, (before,)).rowcount
+
+    async def sweep(self):
+        """Вытеснить давно не использованные записи из памяти и удалить брошенные состояния из базы"""
+        deadline = time.monotonic() - FSM_MEMORY_TTL
+        for key in [k for k, r in self._records.items() if r[2] < deadline and k not in self._dirty]:
+            del self._records[key]
+        # Брошенный в памяти ключ тоже мог протухнуть в базе
+        expired = await db.write(self._sweep, int(time.time()) - FSM_STATE_TTL)
+        if expired:
+            logging.info(f"FSM: removed {expired} abandoned states")
+
+    async def run(self):
+        last_sweep = time.monotonic()
+        while True:
+            await asyncio.sleep(FSM_FLUSH_EVERY)
+            try:
+                await self.flush()
+                if time.monotonic() - last_sweep >= FSM_SWEEP_EVERY:
+                    last_sweep = time.monotonic()
+                    await self.sweep()
+            except Exception as e:
+                logging.error(f"FSM storage flush failed: {e}")
+
+    async def close(self):
+        await self.flush()
+
+
+fsm_storage = SQLiteStorage()
+dp = Dispatcher(storage=fsm_storage)
+
+
+class LoopLagMonitor:
+    """
+    Замер задержки event loop: насколько позже запланированного просыпается sleep.
+    Любой блокирующий вызов в обработчиках сразу виден в p99/max.
+    """
+
+    def __init__(self, interval=0.25, window=240, report_every=60):
+        self.interval = interval
+        self.report_every = report_every
+        self.samples = deque(maxlen=window)
+        self.max_lag = 0.0
+        # Накопительно с запуска - _sum/_count для summary в /metrics
+        self.total = 0.0
+        self.count = 0
+
+    def stats(self):
+        if not self.samples:
+            return {"p50": 0.0, "p99": 0.0, "max": 0.0}
+        ordered = sorted(self.samples)
+        return {
+            "p50": ordered[len(ordered) // 2] * 1000,
+            "p99": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+            "max": self.max_lag * 1000,
+        }
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        last_report = loop.time()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - started - self.interval)
+            self.samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            self.total += lag
+            self.count += 1
+
+            if loop.time() - last_report >= self.report_every:
+                st = self.stats()
+                logging.info(f"Event loop lag: p50={st['p50']:.1f}ms p99={st['p99']:.1f}ms max={st['max']:.1f}ms")
+                last_report = loop.time()
+
+
+loop_lag = LoopLagMonitor()
+
+
+# --- МЕТРИКИ ОБРАБОТЧИКОВ (/metrics, текстовый формат Prometheus) ---
+# Границы бакетов гистограммы задержки, секунды
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# /metrics отдаётся только на 127.0.0.1:METRICS_PORT+номер воркера, не на общем порту 8080:
+# снаружи его не видно без nginx, а у каждого воркера (--workers N) свой адрес
+METRICS_PORT = 9100
+
+
+class HandlerMetrics:
+    """
+    Задержка (гистограмма), ошибки и вызовы в работе по обработчикам.
+    kind: "bot" - обработчики aiogram, "http" - маршруты aiohttp, "call" - функции
+    под @handler_metrics.measured; action - тип действия (/api/action), известен только в конце.
+    """
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.bounds = buckets
+        self._series = {}  # (kind, handler, action) -> [бакеты..., сумма секунд, вызовов, ошибок]
+        self._in_flight = Counter()  # (kind, handler) -> вызовов в работе
+
+    def begin(self, kind, handler):
+        self._in_flight[(kind, handler)] += 1
+        return time.perf_counter()
+
+    def end(self, kind, handler, started, error=False, action=""):
+        seconds = time.perf_counter() - started
+        self._in_flight[(kind, handler)] -= 1
+        series = self._series.get((kind, handler, action))
+        if series is None:
+            series = self._series[(kind, handler, action)] = [0] * len(self.bounds) + [0.0, 0, 0]
+        n = len(self.bounds)
+        bucket = bisect.bisect_left(self.bounds, seconds)  # первая граница >= seconds
+        if bucket < n:
+            series[bucket] += 1
+        series[n] += seconds
+        series[n + 1] += 1
+        if error:
+            series[n + 2] += 1
+
+    def measured(self, fn):
+        """Декоратор для async функции, которую вызывают несколько обработчиков"""
+        name = fn.__name__
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started = self.begin("call", name)
+            failed = True
+            try:
+                result = await fn(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                self.end("call", name, started, failed)
+
+        return wrapper
+
+    def render(self):
+        n = len(self.bounds)
+        items = sorted(self._series.items())
+        lines = ["# HELP fingoal_handler_duration_seconds Handler latency.",
+                 "# TYPE fingoal_handler_duration_seconds histogram"]
+        for (kind, handler, action), series in items:
+            base = _prom_labels(kind=kind, handler=handler, action=action)
+            cumulative = 0
+            for bound, count in zip(self.bounds, series):
+                cumulative += count
+                lines.append(f"fingoal_handler_duration_seconds_bucket{{{base},le=\"{bound}\"}} {cumulative}")
+            lines.append(f"fingoal_handler_duration_seconds_bucket{{{base},le=\"+Inf\"}} {series[n + 1]}")
+            lines.append(f"fingoal_handler_duration_seconds_sum{{{base}}} {series[n]:.6f}")
+            lines.append(f"fingoal_handler_duration_seconds_count{{{base}}} {series[n + 1]}")
+        lines += ["# HELP fingoal_handler_errors_total Handler calls that raised (HTTP: also 5xx responses).",
+                  "# TYPE fingoal_handler_errors_total counter"]
+        for (kind, handler, action), series in items:
+            lines.append(f"fingoal_handler_errors_total{{{_prom_labels(kind=kind, handler=handler, action=action)}}} {series[n + 2]}")
+        lines += ["# HELP fingoal_handler_in_flight Handler calls in progress.",
+                  "# TYPE fingoal_handler_in_flight gauge"]
+        for (kind, handler), count in sorted(self._in_flight.items()):
+            lines.append(f"fingoal_handler_in_flight{{{_prom_labels(kind=kind, handler=handler)}}} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _prom_labels(**labels):
+    """kind="bot",handler="..." - пустые значения пропускаются"""
+    return ",".join(f'{name}="{_prom_escape(value)}"' for name, value in labels.items() if value)
+
+
+def _prom_escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+handler_metrics = HandlerMetrics()
+
+
+async def bot_metrics_middleware(handler, event, data):
+    """Inner middleware aiogram: вызывается, когда фильтры уже выбрали обработчик"""
+    name = data["handler"].callback.__name__
+    started = handler_metrics.begin("bot", name)
+    failed = True
+    try:
+        result = await handler(event, data)
+        failed = False
+        return result
+    finally:
+        handler_metrics.end("bot", name, started, failed)
+
+
+for _name, _observer in dp.observers.items():
+    if _name not in ("update", "error"):
+        _observer.middleware(bot_metrics_middleware)
+
+
+@web.middleware
+async def http_metrics_middleware(request, handler):
+    """Middleware aiohttp: серия по обработчику маршрута; request["metrics_action"] - уточнение от обработчика"""
+    if request.match_info.http_exception is not None:
+        return await handler(request)
+    route_handler = request.match_info.handler
+    name = getattr(route_handler, "__qualname__", None) or type(route_handler).__name__
+    started = handler_metrics.begin("http", name)
+    failed = True
+    try:
+        response = await handler(request)
+        failed = response.status >= 500
+        return response
+    finally:
+        handler_metrics.end("http", name, started, failed, request.get("metrics_action", ""))
+
+
+# --- ДЕНЬГИ И ДАТЫ ---
+# В transactions суммы хранятся в копейках (amount_minor), время - в секундах
+# Unix (ts), календарный день - номером дня от 1970-01-01 (day).
+# Рубли и строки дат появляются только при выводе.
+
+UNIX_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def to_minor(amount):
+    """Рубли (число или строка) -> целые копейки"""
+    return int(round(float(amount) * 100))
+
+
+def from_minor(minor):
+    """Копейки -> рубли для вывода"""
+    return (minor or 0) / 100
+
+
+def day_number(d):
+    """date/datetime -> номер дня"""
+    return d.toordinal() - UNIX_EPOCH_ORDINAL
+
+
+def month_number(year, month):
+    """Ключ месяца в tx_rollup: 2024-03 -> 202403"""
+    return year * 100 + month
+
+
+def current_month():
+    now = datetime.now()
+    return month_number(now.year, now.month)
+
+
+def month_day_range(year, month):
+    """Границы месяца в номерах дней: [начало, начало следующего)"""
+    start = day_number(date(year, month, 1))
+    end = day_number(date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1))
+    return start, end
+
+
+def json_amount(minor):
+    """Сумма для Mini App: целые рубли без дробной части, иначе рубли с копейками"""
+    minor = minor or 0
+    return minor // 100 if minor % 100 == 0 else minor / 100
+
+
+def format_ts(ts, fmt="%Y-%m-%d %H:%M"):
+    return datetime.fromtimestamp(ts).strftime(fmt) if ts else ""
+
+
+# --- МИГРАЦИИ СХЕМЫ ---
+# Каждая миграция выполняется ровно один раз и в своей транзакции.
+# Применённые версии записываются в schema_version. Новые изменения схемы
+# добавляются только в конец MIGRATIONS, старые миграции не редактируются.
+
+def _migrate_base_schema(conn):
+    # 1. Транзакции
+    conn.execute('''CREATE TABLE IF NOT EXISTS transactions
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     user_id INTEGER,
+                     amount REAL,
+                     category TEXT,
+                     type TEXT,
+                     date TEXT,
+                     description TEXT)''')
+
+    # Старые базы создавались без описания
+    columns = [r[1] for r in conn.execute("PRAGMA table_info(transactions)")]
+    if "description" not in columns:
+        conn.execute("ALTER TABLE transactions ADD COLUMN description TEXT")
+
+    # 2. Цели
+    conn.execute('''CREATE TABLE IF NOT EXISTS goals
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     user_id INTEGER,
+                     name TEXT,
+                     target_amount REAL,
+                     current_amount REAL DEFAULT 0,
+                     status TEXT DEFAULT 'active',
+                     created_at TEXT)''')
+    
+    # 3. Категории
+    conn.execute('''CREATE TABLE IF NOT EXISTS categories
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     user_id INTEGER,
+                     name TEXT,
+                     type TEXT,
+                     created_at TEXT)''')
+
+    # 4. Бюджеты
+    conn.execute('''CREATE TABLE IF NOT EXISTS budgets
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     user_id INTEGER,
+                     category_name TEXT,
+                     amount REAL,
+                     month_year TEXT)''')
+    
+    # 5. Администраторы
+    conn.execute('''CREATE TABLE IF NOT EXISTS admins
+                    (user_id INTEGER PRIMARY KEY,
+                     added_by INTEGER,
+                     added_at TEXT)''')
+    
+    # Добавляем root админа если его нет
+    conn.execute('''INSERT OR IGNORE INTO admins (user_id, added_by, added_at) 
+                    VALUES (?, ?, ?)''', (ROOT_ADMIN_ID, ROOT_ADMIN_ID, datetime.now().strftime("%Y-%m-%d")))
+    
+    # 6. Пользователи (для отслеживания)
+    conn.execute('''CREATE TABLE IF NOT EXISTS users
+                    (user_id INTEGER PRIMARY KEY,
+                     username TEXT,
+                     first_name TEXT,
+                     registered_at TEXT,
+                     last_active TEXT)''')
+    
+    # 7. Ограничения пользователей
+    conn.execute('''CREATE TABLE IF NOT EXISTS user_limits
+                    (user_id INTEGER PRIMARY KEY,
+                     is_blocked INTEGER DEFAULT 0,
+                     max_transactions INTEGER DEFAULT -1,
+                     disabled_features TEXT DEFAULT '')''')
+
+
+def _migrate_hot_indexes(conn):
+    # Последние транзакции пользователя (MiniApp, история, списки)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tx_user_id ON transactions(user_id, id)")
+    # Выборки за месяц: сводка, отчёт, статистика категорий
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tx_user_date ON transactions(user_id, date)")
+    # Расходы за месяц по категориям: бюджеты, топ-5, проверка лимита
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tx_user_type_date ON transactions(user_id, type, date)")
+    # DISTINCT категорий и проверка дубликатов в save_transaction
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tx_user_type_cat ON transactions(user_id, type, category, amount)")
+
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_budgets_user_month ON budgets(user_id, month_year, category_name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_goals_user ON goals(user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_categories_user ON categories(user_id, type, name)")
+
+
+def _migrate_rollups(conn):
+    # Суммы по (пользователь, месяц, тип, категория) - для экранов за месяц
+    conn.execute('''CREATE TABLE IF NOT EXISTS tx_rollup
+                    (user_id INTEGER NOT NULL,
+                     month TEXT NOT NULL,
+                     type TEXT NOT NULL,
+                     category TEXT NOT NULL,
+                     total REAL NOT NULL DEFAULT 0,
+                     tx_count INTEGER NOT NULL DEFAULT 0,
+                     PRIMARY KEY (user_id, month, type, category)) WITHOUT ROWID''')
+    # Баланс за всё время
+    conn.execute('''CREATE TABLE IF NOT EXISTS user_balance
+                    (user_id INTEGER PRIMARY KEY,
+                     income REAL NOT NULL DEFAULT 0,
+                     expense REAL NOT NULL DEFAULT 0,
+                     tx_count INTEGER NOT NULL DEFAULT 0)''')
+    # Заполняются в миграции 6, после перевода сумм в копейки
+
+
+def _migrate_integer_columns(conn):
+    # Новые колонки рядом со старыми amount/date, заполняются миграцией 5
+    columns = [r[1] for r in conn.execute("PRAGMA table_info(transactions)")]
+    for name in ("amount_minor", "ts", "day"):
+        if name not in columns:
+            conn.execute(f"ALTER TABLE transactions ADD COLUMN {name} INTEGER")
+
+
+def _parse_legacy_date(date_str):
+    """TEXT дата старой схемы -> datetime или None, если не разобрать"""
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(date_str, fmt)
+        except (TypeError, ValueError):
             pass
+    try:
+        return datetime.fromisoformat(date_str)
+    except (TypeError, ValueError):
+        return None
 
-        # 2. Цели
-        conn.execute('''CREATE TABLE IF NOT EXISTS goals
-                        (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                         user_id INTEGER,
-                         name TEXT,
-                         target_amount REAL,
-                         current_amount REAL DEFAULT 0,
-                         status TEXT DEFAULT 'active',
-                         created_at TEXT)''')
-        
-        # 3. Категории
-        conn.execute('''CREATE TABLE IF NOT EXISTS categories
-                        (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                         user_id INTEGER,
-                         name TEXT,
-                         type TEXT,
-                         created_at TEXT)''')
-
-        # 4. Бюджеты
-        conn.execute('''CREATE TABLE IF NOT EXISTS budgets
-                        (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                         user_id INTEGER,
-                         category_name TEXT,
-                         amount REAL,
-                         month_year TEXT)''')
-        
-        # 5. Администраторы
-        conn.execute('''CREATE TABLE IF NOT EXISTS admins
-                        (user_id INTEGER PRIMARY KEY,
-                         added_by INTEGER,
-                         added_at TEXT)''')
-        
-        # Добавляем root админа если его нет
-        conn.execute('''INSERT OR IGNORE INTO admins (user_id, added_by, added_at) 
-                        VALUES (?, ?, ?)''', (ROOT_ADMIN_ID, ROOT_ADMIN_ID, datetime.now().strftime("%Y-%m-%d")))
-        
-        # 6. Пользователи (для отслеживания)
-        conn.execute('''CREATE TABLE IF NOT EXISTS users
-                        (user_id INTEGER PRIMARY KEY,
-                         username TEXT,
-                         first_name TEXT,
-                         registered_at TEXT,
-                         last_active TEXT)''')
-        
-        # 7. Ограничения пользователей
-        conn.execute('''CREATE TABLE IF NOT EXISTS user_limits
-                        (user_id INTEGER PRIMARY KEY,
-                         is_blocked INTEGER DEFAULT 0,
-                         max_transactions INTEGER DEFAULT -1,
-                         disabled_features TEXT DEFAULT '')''')
-        
-        conn.commit()
 
+def _legacy_tx_values(conn, rows):
+    """
+    (id, amount REAL, date TEXT) -> параметры UPDATE (amount_minor, ts, day, id).
+    Неразобранная дата получает ts 0, а исходный текст остаётся в legacy_tx_dates
+    (колонку date миграция 6 удаляет) - такие строки можно поправить вручную.
+    """
+    params, bad = [], []
+    for tx_id, amount, date_str in rows:
+        moment = _parse_legacy_date(date_str)
+        if moment is None:
+            bad.append((tx_id, date_str))
+            moment = datetime.fromtimestamp(0)
+        params.append((to_minor(amount or 0), int(moment.timestamp()), day_number(moment), tx_id))
+    if bad:
+        conn.execute("CREATE TABLE IF NOT EXISTS legacy_tx_dates (id INTEGER PRIMARY KEY, date TEXT)")
+        conn.executemany("INSERT OR REPLACE INTO legacy_tx_dates (id, date) VALUES (?, ?)", bad)
+        logging.warning(f"Unparseable dates in {len(bad)} transactions (ids {[r[0] for r in bad[:20]]}), "
+                        f"stored with ts 0, original text kept in legacy_tx_dates")
+    return params, len(bad)
+
+
+# Сколько строк переносить за одну короткую транзакцию
+BACKFILL_BATCH = 2000
+
+
+def _migrate_backfill_integer_columns(conn, batch=BACKFILL_BATCH):
+    # Пакетами по id: старый процесс бота может продолжать писать в базу,
+    # блокировка на запись держится только на время одного пакета
+    last_id, converted, bad_dates = 0, 0, 0
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute("SELECT id, amount, date FROM transactions WHERE id > ? AND amount_minor IS NULL "
+                                "ORDER BY id LIMIT ?", (last_id, batch)).fetchall()
+            params, bad = _legacy_tx_values(conn, rows)
+            conn.executemany("UPDATE transactions SET amount_minor = ?, ts = ?, day = ? WHERE id = ?", params)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        converted += len(rows)
+        bad_dates += bad
+    if converted:
+        logging.info(f"Backfilled integer amount/ts/day for {converted} transactions"
+                     + (f", {bad_dates} with unparseable dates (see legacy_tx_dates)" if bad_dates else ""))
+
+
+def _migrate_drop_legacy_columns(conn):
+    # Строки, записанные старым процессом уже после пакетного переноса
+    rows = conn.execute("SELECT id, amount, date FROM transactions WHERE amount_minor IS NULL").fetchall()
+    conn.executemany("UPDATE transactions SET amount_minor = ?, ts = ?, day = ? WHERE id = ?",
+                     _legacy_tx_values(conn, rows)[0])
+
+    # SQLite не умеет менять тип/NOT NULL колонки - пересоздаём таблицу
+    seq = dict(conn.execute("SELECT name, seq FROM sqlite_sequence WHERE name IN ('transactions', 'budgets')").fetchall())
+    conn.execute('''CREATE TABLE transactions_new
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     user_id INTEGER,
+                     amount_minor INTEGER NOT NULL,
+                     category TEXT,
+                     type TEXT,
+                     ts INTEGER NOT NULL,
+                     day INTEGER NOT NULL,
+                     description TEXT)''')
+    conn.execute('''INSERT INTO transactions_new (id, user_id, amount_minor, category, type, ts, day, description)
+                    SELECT id, user_id, amount_minor, category, type, ts, day, description FROM transactions''')
+    conn.execute("DROP TABLE transactions")
+    conn.execute("ALTER TABLE transactions_new RENAME TO transactions")
+
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tx_user_id ON transactions(user_id, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tx_user_day ON transactions(user_id, day)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tx_user_type_day ON transactions(user_id, type, day)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tx_user_type_cat ON transactions(user_id, type, category, amount_minor)")
+
+    # Бюджеты: лимит в копейках, месяц - число YYYYMM, как в tx_rollup
+    conn.execute('''CREATE TABLE budgets_new
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     user_id INTEGER,
+                     category_name TEXT,
+                     amount_minor INTEGER NOT NULL,
+                     month INTEGER NOT NULL)''')
+    conn.execute('''INSERT INTO budgets_new (id, user_id, category_name, amount_minor, month)
+                    SELECT id, user_id, category_name, CAST(round(COALESCE(amount, 0) * 100) AS INTEGER),
+                           COALESCE(CAST(replace(month_year, '-', '') AS INTEGER), 0)
+                    FROM budgets''')
+    conn.execute("DROP TABLE budgets")
+    conn.execute("ALTER TABLE budgets_new RENAME TO budgets")
+    # Счётчики AUTOINCREMENT не должны откатиться назад
+    for name, value in seq.items():
+        conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (value, name))
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_budgets_user_month ON budgets(user_id, month, category_name)")
+
+    # Агрегаты тоже в копейках, месяц - число YYYYMM
+    conn.execute("DROP TABLE IF EXISTS tx_rollup")
+    conn.execute("DROP TABLE IF EXISTS user_balance")
+    conn.execute('''CREATE TABLE tx_rollup
+                    (user_id INTEGER NOT NULL,
+                     month INTEGER NOT NULL,
+                     type TEXT NOT NULL,
+                     category TEXT NOT NULL,
+                     total INTEGER NOT NULL DEFAULT 0,
+                     tx_count INTEGER NOT NULL DEFAULT 0,
+                     PRIMARY KEY (user_id, month, type, category)) WITHOUT ROWID''')
+    conn.execute('''CREATE TABLE user_balance
+                    (user_id INTEGER PRIMARY KEY,
+                     income INTEGER NOT NULL DEFAULT 0,
+                     expense INTEGER NOT NULL DEFAULT 0,
+                     tx_count INTEGER NOT NULL DEFAULT 0)''')
+    rebuild_rollups(conn)
+
+
+def _migrate_search_index(conn):
+    # Trigram: поиск по любой подстроке от 3 символов, без учёта регистра
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(username, first_name, tokenize='trigram')")
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS users_fts_ins AFTER INSERT ON users BEGIN
+                        INSERT INTO users_fts (rowid, username, first_name) VALUES (new.user_id, new.username, new.first_name);
+                    END''')
+    # register_user обновляет last_active на каждом сообщении - индекс трогаем только при смене имени
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS users_fts_upd AFTER UPDATE OF username, first_name ON users
+                    WHEN old.username IS NOT new.username OR old.first_name IS NOT new.first_name BEGIN
+                        DELETE FROM users_fts WHERE rowid = old.user_id;
+                        INSERT INTO users_fts (rowid, username, first_name) VALUES (new.user_id, new.username, new.first_name);
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS users_fts_del AFTER DELETE ON users BEGIN
+                        DELETE FROM users_fts WHERE rowid = old.user_id;
+                    END''')
+
+    # owner = '#<user_id>#': фраза "#123#" встречается только у своего пользователя,
+    # поэтому фильтр по владельцу идёт по индексу, а не после поиска по всем
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS tx_fts USING fts5(owner, description, tokenize='trigram')")
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS tx_fts_ins AFTER INSERT ON transactions
+                    WHEN new.description IS NOT NULL AND new.description != '' BEGIN
+                        INSERT INTO tx_fts (rowid, owner, description) VALUES (new.id, '#' || new.user_id || '#', new.description);
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS tx_fts_upd AFTER UPDATE OF description ON transactions BEGIN
+                        DELETE FROM tx_fts WHERE rowid = old.id;
+                        INSERT INTO tx_fts (rowid, owner, description)
+                        SELECT new.id, '#' || new.user_id || '#', new.description
+                        WHERE new.description IS NOT NULL AND new.description != '';
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS tx_fts_del AFTER DELETE ON transactions BEGIN
+                        DELETE FROM tx_fts WHERE rowid = old.id;
+                    END''')
+
+    conn.execute("DELETE FROM users_fts")
+    conn.execute("INSERT INTO users_fts (rowid, username, first_name) SELECT user_id, username, first_name FROM users")
+    conn.execute("DELETE FROM tx_fts")
+    conn.execute("""INSERT INTO tx_fts (rowid, owner, description)
+                    SELECT id, '#' || user_id || '#', description FROM transactions
+                    WHERE description IS NOT NULL AND description != ''""")
+
+
+def _migrate_report_cache(conn):
+    # payload = NULL - отчёт устарел; gen растёт при каждой вставке/удалении в этом месяце
+    conn.execute('''CREATE TABLE IF NOT EXISTS report_cache
+                    (user_id INTEGER NOT NULL,
+                     month INTEGER NOT NULL,
+                     gen INTEGER NOT NULL DEFAULT 0,
+                     payload TEXT,
+                     PRIMARY KEY (user_id, month)) WITHOUT ROWID''')
+
+
+# Глобальные счётчики админ-панели: имя -> запрос, который их пересчитывает (см. reconcile_counters)
+GLOBAL_COUNTERS = {
+    "users": "SELECT COUNT(*) FROM users",
+    "transactions": "SELECT COUNT(*) FROM transactions",
+    "blocked": "SELECT COUNT(*) FROM user_limits WHERE is_blocked = 1",
+}
+
+
+def _migrate_global_counters(conn):
+    # Ведутся триггерами в той же транзакции, что и сама запись - статистика без COUNT(*)
+    conn.execute('''CREATE TABLE IF NOT EXISTS global_counters
+                    (name TEXT PRIMARY KEY,
+                     value INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID''')
+    for name, sql in GLOBAL_COUNTERS.items():
+        conn.execute(f"INSERT INTO global_counters (name, value) VALUES (?, ({sql})) "
+                     "ON CONFLICT(name) DO UPDATE SET value = excluded.value", (name,))
+
+    for table in ("users", "transactions"):
+        conn.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_count_ins AFTER INSERT ON {table} BEGIN
+                            UPDATE global_counters SET value = value + 1 WHERE name = '{table}';
+                        END''')
+        conn.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_count_del AFTER DELETE ON {table} BEGIN
+                            UPDATE global_counters SET value = value - 1 WHERE name = '{table}';
+                        END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS user_limits_blocked_ins AFTER INSERT ON user_limits
+                    WHEN new.is_blocked = 1 BEGIN
+                        UPDATE global_counters SET value = value + 1 WHERE name = 'blocked';
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS user_limits_blocked_upd AFTER UPDATE OF is_blocked ON user_limits
+                    WHEN (old.is_blocked = 1) != (new.is_blocked = 1) BEGIN
+                        UPDATE global_counters SET value = value + (new.is_blocked = 1) - (old.is_blocked = 1) WHERE name = 'blocked';
+                    END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS user_limits_blocked_del AFTER DELETE ON user_limits
+                    WHEN old.is_blocked = 1 BEGIN
+                        UPDATE global_counters SET value = value - 1 WHERE name = 'blocked';
+                    END''')
+
+
+def _migrate_fsm_state(conn):
+    # key - StorageKey aiogram одной строкой, data - JSON, updated_at - unix time для TTL
+    conn.execute('''CREATE TABLE IF NOT EXISTS fsm_state
+                    (key TEXT PRIMARY KEY,
+                     state TEXT,
+                     data TEXT NOT NULL DEFAULT '{}',
+                     updated_at INTEGER NOT NULL) WITHOUT ROWID''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fsm_state_updated ON fsm_state(updated_at)")
+
+
+def _migrate_idempotency_keys(conn):
+    # Ключи идемпотентности записей: ключ из MiniApp, nonce из /start или update_id Telegram.
+    # Повтор того же ключа упирается в PRIMARY KEY; старше IDEMPOTENCY_KEY_TTL удаляются
+    conn.execute('''CREATE TABLE IF NOT EXISTS idempotency_keys
+                    (user_id INTEGER NOT NULL,
+                     key TEXT NOT NULL,
+                     created_at INTEGER NOT NULL,
+                     PRIMARY KEY (user_id, key)) WITHOUT ROWID''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys(created_at)")
+
+
+# Таблицы, из которых собирается payload MiniApp: любая запись в них меняет версию данных
+USER_DATA_TABLES = ("transactions", "goals", "budgets", "categories")
+
+
+def _migrate_data_version(conn):
+    # Версия данных пользователя для ETag в /api/data; растёт триггерами,
+    # поэтому её не обойдёт ни один путь записи
+    conn.execute('''CREATE TABLE IF NOT EXISTS user_data_version
+                    (user_id INTEGER PRIMARY KEY,
+                     version INTEGER NOT NULL DEFAULT 0)''')
+    for table in USER_DATA_TABLES:
+        for event, row in (("INSERT", "new"), ("UPDATE", "new"), ("DELETE", "old")):
+            conn.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table} BEGIN
+                                INSERT INTO user_data_version (user_id, version) VALUES ({row}.user_id, 1)
+                                ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+                            END''')
+
+
+def _migrate_change_log(conn):
+    # Журнал изменений для /api/sync: seq - версия данных пользователя после изменения.
+    # Храним только что и у кого менялось; сами строки берутся из таблиц при синхронизации
+    conn.execute('''CREATE TABLE IF NOT EXISTS change_log
+                    (user_id INTEGER NOT NULL,
+                     seq INTEGER NOT NULL,
+                     entity TEXT NOT NULL,
+                     entity_id INTEGER NOT NULL,
+                     PRIMARY KEY (user_id, seq)) WITHOUT ROWID''')
+    # Всё, что не старше log_floor, уже вычищено компактизацией - с такой версии только полная загрузка
+    conn.execute("ALTER TABLE user_data_version ADD COLUMN log_floor INTEGER NOT NULL DEFAULT 0")
+    conn.execute("UPDATE user_data_version SET log_floor = version")
+    for table in USER_DATA_TABLES:
+        for event, row in (("INSERT", "new"), ("UPDATE", "new"), ("DELETE", "old")):
+            conn.execute(f"DROP TRIGGER IF EXISTS {table}_version_{event.lower()}")
+            conn.execute(f'''CREATE TRIGGER IF NOT EXISTS {table}_change_{event.lower()} AFTER {event} ON {table} BEGIN
+                                INSERT INTO user_data_version (user_id, version) VALUES ({row}.user_id, 1)
+                                ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+                                INSERT INTO change_log (user_id, seq, entity, entity_id)
+                                SELECT {row}.user_id, version, '{table}', {row}.id FROM user_data_version WHERE user_id = {row}.user_id;
+                            END''')
+
+
+def _migrate_rollup_category_index(conn):
+    # Категории пользователя из истории (CategoryIndex): DISTINCT по индексу, без временного B-дерева
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_rollup_user_type_cat ON tx_rollup(user_id, type, category)")
+
+
+def _migrate_users_last_active_index(conn):
+    # Список пользователей в админке - по last_active с курсором (без OFFSET и сортировки всей таблицы).
+    # NULL не сравнивается с курсором - такие строки выпали бы из списка
+    conn.execute("UPDATE users SET last_active = COALESCE(registered_at, '') WHERE last_active IS NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_last_active ON users(last_active)")
+
+
+MIGRATIONS = [
+    (1, "base schema", _migrate_base_schema),
+    (2, "indexes for transactions hot paths", _migrate_hot_indexes),
+    (3, "monthly category rollups and lifetime balance", _migrate_rollups),
+    (4, "integer amount/ts/day columns", _migrate_integer_columns),
+    (5, "backfill integer columns", _migrate_backfill_integer_columns),
+    (6, "drop REAL amount and TEXT date", _migrate_drop_legacy_columns),
+    (7, "fts5 search over users and transaction descriptions", _migrate_search_index),
+    (8, "persistent cache of monthly reports", _migrate_report_cache),
+    (9, "per-user data version for /api/data etag", _migrate_data_version),
+    (10, "per-user change log for /api/sync", _migrate_change_log),
+    (11, "global counters for the admin dashboard", _migrate_global_counters),
+    (12, "persistent fsm storage", _migrate_fsm_state),
+    (13, "idempotency keys instead of the 5-second duplicate check", _migrate_idempotency_keys),
+    (14, "index for distinct rollup categories", _migrate_rollup_category_index),
+    (15, "index for the admin users list", _migrate_users_last_active_index),
+]
+
+# Миграции, которые сами делят работу на короткие транзакции
+ONLINE_MIGRATIONS = {5}
+
+
+def apply_migrations(conn):
+    """Применить недостающие миграции (conn в режиме autocommit)"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version
+                    (version INTEGER PRIMARY KEY,
+                     name TEXT,
+                     applied_at TEXT)''')
+    current = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+    for version, name, migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        if version in ONLINE_MIGRATIONS:
+            migrate(conn)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if version not in ONLINE_MIGRATIONS:
+                migrate(conn)
+            conn.execute("INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                         (version, name, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        logging.info(f"Schema migrated to v{version}: {name}")
+
+
+def run_migrations(path=DB_PATH):
+    """Вызывается один раз при запуске, до открытия пула соединений"""
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        apply_migrations(conn)
+    finally:
+        conn.close()
+
+
+def check_query_plans(conn):
+    """
+    EXPLAIN QUERY PLAN по HOT_QUERIES.
+    Возвращает список проблем: полный скан таблицы/индекса, сортировка
+    всей истории пользователя ради LIMIT или временное B-дерево для DISTINCT.
+    """
+    problems = []
+    for name, sql, params in HOT_QUERIES:
+        details = [r[3] for r in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        for detail in details:
+            # Виртуальная таблица FTS5 с MATCH тоже выглядит как SCAN, но идёт по своему индексу
+            if detail.startswith("SCAN ") and "VIRTUAL TABLE INDEX" not in detail:
+                problems.append(f"{name}: {detail}")
+            elif "LIMIT" in sql and "GROUP BY" not in sql and detail.startswith("USE TEMP B-TREE FOR ORDER BY"):
+                problems.append(f"{name}: {detail}")
+            elif detail.startswith("USE TEMP B-TREE FOR DISTINCT"):
+                problems.append(f"{name}: {detail}")
+    return problems
+
+
+def check_plans_cli():
+    """Проверка планов на свежей схеме: код возврата 1, если горячий запрос ушёл в скан"""
+    conn = sqlite3.connect(":memory:", isolation_level=None)
+    apply_migrations(conn)
+    problems = check_query_plans(conn)
+    conn.close()
+    for problem in problems:
+        print(f"FAIL {problem}")
+    if not problems:
+        print(f"OK: {len(HOT_QUERIES)} hot queries use indexes")
+    return 1 if problems else 0
+
+
+# --- АГРЕГАТЫ (tx_rollup / user_balance) ---
+# Обновляются в той же транзакции, что и сами транзакции.
+# Сверка с сырыми данными: python bot.py --rebuild-rollups
+
+def _rollup_add(conn, user_id, month, category, t_type, amount, count):
+    """Прибавить сумму в копейках к агрегатам (при удалении amount и count отрицательные)"""
+    conn.execute('''INSERT INTO tx_rollup (user_id, month, type, category, total, tx_count)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(user_id, month, type, category) DO UPDATE SET
+                    total = total + excluded.total,
+                    tx_count = tx_count + excluded.tx_count''',
+                 (user_id, month, t_type, category, amount, count))
+    if count < 0:
+        conn.execute("DELETE FROM tx_rollup WHERE user_id = ? AND month = ? AND type = ? AND category = ? AND tx_count <= 0",
+                     (user_id, month, t_type, category))
+
+    income = amount if t_type == 'income' else 0
+    expense = amount if t_type == 'expense' else 0
+    conn.execute('''INSERT INTO user_balance (user_id, income, expense, tx_count)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                    income = income + excluded.income,
+                    expense = expense + excluded.expense,
+                    tx_count = tx_count + excluded.tx_count''',
+                 (user_id, income, expense, count))
+    _invalidate_report(conn, user_id, month)
+
+
+def _delete_transactions(conn, user_id, where, params=()):
+    """Удалить транзакции пользователя по условию, вычитая их из агрегатов. Возвращает число удалённых"""
+    groups = conn.execute(f"""
+        SELECT CAST(strftime('%Y%m', day * 86400, 'unixepoch') AS INTEGER), COALESCE(category, ''), type,
+               SUM(amount_minor), COUNT(*)
+        FROM transactions WHERE user_id = ? AND {where}
+        GROUP BY 1, 2, 3
+    """, (user_id, *params)).fetchall()
+    for month, category, t_type, total, count in groups:
+        _rollup_add(conn, user_id, month, category, t_type, -total, -count)
+    conn.execute(f"DELETE FROM transactions WHERE user_id = ? AND {where}", (user_id, *params))
+    return sum(g[4] for g in groups)
+
+
+def rebuild_rollups(conn):
+    """
+    Пересчитать агрегаты из transactions.
+    Возвращает список расхождений между сохранёнными и пересчитанными значениями.
+    """
+    fresh = {(r[0], r[1], r[2], r[3]): (r[4], r[5]) for r in conn.execute("""
+        SELECT user_id, CAST(strftime('%Y%m', day * 86400, 'unixepoch') AS INTEGER), type, COALESCE(category, ''),
+               SUM(amount_minor), COUNT(*)
+        FROM transactions GROUP BY 1, 2, 3, 4
+    """)}
+    stored = {(r[0], r[1], r[2], r[3]): (r[4], r[5]) for r in conn.execute(
+        "SELECT user_id, month, type, category, total, tx_count FROM tx_rollup")}
+
+    drift = []
+    for key in fresh.keys() | stored.keys():
+        want, have = fresh.get(key, (0, 0)), stored.get(key, (0, 0))
+        if want != have:
+            drift.append(f"rollup {key}: stored={have} actual={want}")
+
+    fresh_bal = {r[0]: (r[1], r[2], r[3]) for r in conn.execute("""
+        SELECT user_id,
+               COALESCE(SUM(CASE WHEN type = 'income' THEN amount_minor END), 0),
+               COALESCE(SUM(CASE WHEN type = 'expense' THEN amount_minor END), 0),
+               COUNT(*)
+        FROM transactions GROUP BY user_id
+    """)}
+    stored_bal = {r[0]: (r[1], r[2], r[3]) for r in conn.execute(
+        "SELECT user_id, income, expense, tx_count FROM user_balance")}
+    for uid in fresh_bal.keys() | stored_bal.keys():
+        want, have = fresh_bal.get(uid, (0, 0, 0)), stored_bal.get(uid, (0, 0, 0))
+        if want != have:
+            drift.append(f"balance {uid}: stored={have} actual={want}")
+
+    conn.execute("DELETE FROM tx_rollup")
+    conn.executemany("INSERT INTO tx_rollup (user_id, month, type, category, total, tx_count) VALUES (?, ?, ?, ?, ?, ?)",
+                     [(*key, total, count) for key, (total, count) in fresh.items()])
+    conn.execute("DELETE FROM user_balance")
+    conn.executemany("INSERT INTO user_balance (user_id, income, expense, tx_count) VALUES (?, ?, ?, ?)",
+                     [(uid, *values) for uid, values in fresh_bal.items()])
+    return drift
+
+
+def rebuild_rollups_cli():
+    run_migrations()
+    conn = sqlite3.connect(DB_PATH, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        drift = rebuild_rollups(conn)
+        # Отчёты считаются по агрегатам - после исправления пересчитаются заново
+        conn.execute("DELETE FROM report_cache")
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    for line in drift:
+        print(f"DRIFT {line}")
+    print(f"Rollups rebuilt, {len(drift)} mismatches fixed")
+    return 1 if drift else 0
+
+
+# --- КЭШ ОТЧЁТОВ (report_cache) ---
+# Сводка, топ-5, расходы по категориям и список транзакций месяца.
+# Сбрасывается из _rollup_add, то есть в той же транзакции, что и вставка/удаление.
+# Отчёт, посчитанный до сброса, не сохранится: запись идёт только при том же gen.
+
+def _invalidate_report(conn, user_id, month):
+    conn.execute('''INSERT INTO report_cache (user_id, month, gen, payload) VALUES (?, ?, 1, NULL)
+                    ON CONFLICT(user_id, month) DO UPDATE SET gen = gen + 1, payload = NULL''',
+                 (user_id, month))
+
+
+REPORT_SUMMARY_QUERY = hot_query(
+    "_build_report: сводка",
+    "SELECT type, SUM(total) FROM tx_rollup WHERE user_id = ? AND month = ? GROUP BY type",
+    (1, 202401))
+# Расходы по категориям, по убыванию - первые 5 идут в топ
+REPORT_CATS_QUERY = hot_query(
+    "_build_report: расходы по категориям",
+    """SELECT category, total FROM tx_rollup
+       WHERE user_id = ? AND month = ? AND type = 'expense'
+       ORDER BY total DESC""",
+    (1, 202401))
+REPORT_TX_QUERY = hot_query(
+    "_build_report: транзакции месяца",
+    """SELECT id, amount_minor, category, type, ts, COALESCE(description, '')
+       FROM transactions
+       WHERE user_id = ? AND day >= ? AND day < ?
+       ORDER BY id DESC""",
+    (1, 19723, 19754))
+REPORT_CACHE_QUERY = hot_query(
+    "get_report: кэш",
+    "SELECT gen, payload FROM report_cache WHERE user_id = ? AND month = ?",
+    (1, 202401))
+
+
+def _build_report(conn, user_id, year, month):
+    month_key = month_number(year, month)
+    start_day, next_day = month_day_range(year, month)
+
+    summary = dict(conn.execute(REPORT_SUMMARY_QUERY, (user_id, month_key)).fetchall())
+    cats = conn.execute(REPORT_CATS_QUERY, (user_id, month_key)).fetchall()
+    tx_rows = conn.execute(REPORT_TX_QUERY, (user_id, start_day, next_day)).fetchall()
+
+    return {
+        "income": summary.get("income", 0),
+        "expense": summary.get("expense", 0),
+        "cats": [list(r) for r in cats],
+        "tx": [{"i": r[0], "a": json_amount(r[1]), "c": r[2], "t": (1 if r[3] == "expense" else 0),
+                "d": format_ts(r[4], "%m-%d %H:%M"), "ds": r[5]} for r in tx_rows],
+    }
+
+
+def _load_report(conn, user_id, year, month):
+    """(отчёт, gen для сохранения или None, если взят из кэша)"""
+    # Один снимок базы: gen и данные отчёта должны совпадать
+    conn.execute("BEGIN")
+    try:
+        row = conn.execute(REPORT_CACHE_QUERY, (user_id, month_number(year, month))).fetchone()
+        if row and row[1] is not None:
+            return json.loads(row[1]), None
+        return _build_report(conn, user_id, year, month), (row[0] if row else 0)
+    finally:
+        conn.rollback()
+
+
+def _store_report(conn, user_id, month, gen, payload):
+    conn.execute('''INSERT INTO report_cache (user_id, month, gen, payload) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(user_id, month) DO UPDATE SET payload = excluded.payload
+                    WHERE report_cache.gen = excluded.gen''',
+                 (user_id, month, gen, payload))
+
+
+async def get_report(user_id, year, month):
+    report, gen = await db.read(_load_report, user_id, year, month)
+    if gen is not None:
+        await db.write(_store_report, user_id, month_number(year, month), gen, json.dumps(report, ensure_ascii=False))
+    return report
+
+
+# --- ПОЛНОТЕКСТОВЫЙ ПОИСК (FTS5) ---
+# users_fts и tx_fts поддерживаются триггерами (миграция 7).
+# Trigram находит любую подстроку от 3 символов, порядок - по bm25 (rank).
+
+def _fts_phrase(text):
+    """Пользовательский ввод -> FTS5 фраза (без операторов запроса)"""
+    return '"' + text.replace('"', '""') + '"'
+
+
+# {match} - условие по users_fts: MATCH для запросов от 3 символов, LIKE по началу имени для коротких
+SEARCH_USERS_QUERY = """
+    SELECT u.user_id, u.username, u.first_name, COALESCE(ul.is_blocked, 0)
+    FROM users_fts
+    JOIN users u ON u.user_id = users_fts.rowid
+    LEFT JOIN user_limits ul ON ul.user_id = u.user_id
+    WHERE {match}
+    ORDER BY users_fts.rank
+    LIMIT ?
+"""
+hot_query("search_users: поиск", SEARCH_USERS_QUERY.format(match="users_fts MATCH ?"), ('"ser"', 20))
+
+
+def search_users(conn, query, limit=20):
+    query = query.strip().lower().lstrip("@")
+    if len(query) >= 3:
+        match_sql, match_params = "users_fts MATCH ?", (_fts_phrase(query),)
+    else:
+        # Меньше 3 символов trigram-индекс не покрывает: только начало имени, перебором по users_fts.
+        # LIKE в SQLite не знает регистр кириллицы - имена обычно с заглавной, проверяем и так
+        escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        match_sql = ("(users_fts.username LIKE ? ESCAPE '\\' OR users_fts.first_name LIKE ? ESCAPE '\\' "
+                     "OR users_fts.first_name LIKE ? ESCAPE '\\')")
+        match_params = (escaped + "%", escaped + "%", escaped.capitalize() + "%")
+
+    # Берём с запасом по bm25 и поднимаем наверх совпадения с начала имени
+    rows = conn.execute(SEARCH_USERS_QUERY.format(match=match_sql), (*match_params, limit * 5)).fetchall()
+    rows.sort(key=lambda r: not ((r[1] or "").lower().startswith(query) or (r[2] or "").lower().startswith(query)))
+    rows = rows[:limit]
+
+    # Поиск по ID
+    if query.isdigit() and not any(r[0] == int(query) for r in rows):
+        exact = conn.execute("""
+            SELECT u.user_id, u.username, u.first_name, COALESCE(ul.is_blocked, 0)
+            FROM users u LEFT JOIN user_limits ul ON ul.user_id = u.user_id
+            WHERE u.user_id = ?
+        """, (int(query),)).fetchone()
+        if exact:
+            rows = [exact] + rows[:limit - 1]
+    return rows
+
+
+SEARCH_TX_QUERY = hot_query("search_transactions: поиск по описаниям", """
+    SELECT t.id, t.amount_minor, t.category, t.type, t.ts, t.description
+    FROM tx_fts
+    JOIN transactions t ON t.id = tx_fts.rowid
+    WHERE tx_fts MATCH ?
+    ORDER BY tx_fts.rank
+    LIMIT ?
+""", ('owner:"#1#" AND description:"кофе"', 10))
+
+
+def search_transactions(conn, user_id, query, limit=10):
+    """Транзакции пользователя, в описании которых есть подстрока query (от 3 символов)"""
+    match = f'owner:"#{int(user_id)}#" AND description:{_fts_phrase(query.strip())}'
+    return conn.execute(SEARCH_TX_QUERY, (match, limit)).fetchall()
+
+
+# --- КЭШ ПРАВ (admins / user_limits) ---
+# Проверки прав идут на каждый апдейт - держим их в памяти процесса.
+# Админские обработчики обновляют кэш сразу после записи в БД (соседние воркеры
+# перечитывают его по сообщению peers), TTL подстраховывает, если базу меняет кто-то ещё.
+
+PERMISSIONS_TTL = 60
+
+
+class PermissionCache:
+    def __init__(self, ttl=PERMISSIONS_TTL):
+        self.ttl = ttl
+        self.admins = set()
+        self.blocked = set()
+        self.disabled = {}
+        self.loaded_at = None
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _load(conn):
+        admins = {r[0] for r in conn.execute("SELECT user_id FROM admins")}
+        limits = conn.execute("""
+            SELECT user_id, is_blocked, disabled_features FROM user_limits
+            WHERE is_blocked = 1 OR disabled_features != ''
+        """).fetchall()
+        return admins, limits
+
+    async def refresh(self):
+        admins, limits = await db.read(self._load)
+        self.admins = admins
+        self.blocked = {uid for uid, blocked, _ in limits if blocked == 1}
+        self.disabled = {uid: [f for f in features.split(',') if f] for uid, _, features in limits if features}
+        self.loaded_at = time.monotonic()
+
+    async def ensure_fresh(self):
+        if self.loaded_at is not None and time.monotonic() - self.loaded_at < self.ttl:
+            return
+        async with self._lock:
+            # Пока ждали lock, кэш мог обновить другой обработчик
+            if self.loaded_at is None or time.monotonic() - self.loaded_at >= self.ttl:
+                await self.refresh()
+
+    def set_admin(self, user_id, is_admin):
+        if is_admin:
+            self.admins.add(user_id)
+        else:
+            self.admins.discard(user_id)
+        peers.publish("p")
+
+    def set_blocked(self, user_id, blocked):
+        if blocked:
+            self.blocked.add(user_id)
+        else:
+            self.blocked.discard(user_id)
+        peers.publish("p")
+
+    def set_disabled(self, user_id, features):
+        if features:
+            self.disabled[user_id] = list(features)
+        else:
+            self.disabled.pop(user_id, None)
+        peers.publish("p")
+
+
+permissions = PermissionCache()
 
-def is_admin(user_id):
+
+async def is_admin(user_id):
     """Проверка является ли пользователь админом"""
-    with sqlite3.connect(DB_PATH) as conn:
-        result = conn.execute("SELECT 1 FROM admins WHERE user_id = ?", (user_id,)).fetchone()
-        return result is not None
+    await permissions.ensure_fresh()
+    return user_id in permissions.admins
 
 
-def is_user_blocked(user_id):
+async def is_user_blocked(user_id):
     """Проверка заблокирован ли пользователь"""
-    with sqlite3.connect(DB_PATH) as conn:
-        result = conn.execute("SELECT is_blocked FROM user_limits WHERE user_id = ?", (user_id,)).fetchone()
-        return result and result[0] == 1
+    await permissions.ensure_fresh()
+    return user_id in permissions.blocked
 
 
-def get_disabled_features(user_id):
+async def get_disabled_features(user_id):
     """Получить отключённые функции пользователя"""
-    with sqlite3.connect(DB_PATH) as conn:
-        result = conn.execute("SELECT disabled_features FROM user_limits WHERE user_id = ?", (user_id,)).fetchone()
-        if result and result[0]:
-            return result[0].split(',')
-        return []
+    await permissions.ensure_fresh()
+    return list(permissions.disabled.get(user_id, ()))
+
 
+_UPSERT_USER_SQL = hot_query("register_user: активность", '''INSERT INTO users (user_id, username, first_name, registered_at, last_active)
+                      VALUES (?, ?, ?, ?, ?)
+                      ON CONFLICT(user_id) DO UPDATE SET
+                      username = excluded.username,
+                      first_name = excluded.first_name,
+                      last_active = excluded.last_active''', (1, "u", "U", "2024-01-01 00:00:00", "2024-01-01 00:00:00"))
 
-def register_user(user):
+
+async def register_user(user):
     """Регистрация/обновление пользователя"""
-    with sqlite3.connect(DB_PATH) as conn:
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        conn.execute('''INSERT INTO users (user_id, username, first_name, registered_at, last_active)
-                        VALUES (?, ?, ?, ?, ?)
-                        ON CONFLICT(user_id) DO UPDATE SET 
-                        username = excluded.username,
-                        first_name = excluded.first_name,
-                        last_active = excluded.last_active''',
-                     (user.id, user.username, user.first_name, now, now))
-        conn.commit()
-
-
-def save_transaction(user_id, amount, category, t_type, description=None):
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        
-        # Проверка на дубликаты (защита от двойного нажатия)
-        cursor.execute("""
-            SELECT id, date FROM transactions 
-            WHERE user_id = ? AND amount = ? AND category = ? AND type = ? 
-            ORDER BY id DESC LIMIT 1
-        """, (user_id, float(amount), category, t_type))
-        
-        last_tx = cursor.fetchone()
-        if last_tx:
-            last_date_str = last_tx[1]
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    await db.execute(_UPSERT_USER_SQL, (user.id, user.username, user.first_name, now, now))
+
+
+# Как часто сбрасывать накопленную активность пользователей в users
+ACTIVITY_FLUSH_EVERY = 5.0
+
+
+class ActivityTracker(BaseMiddleware):
+    """
+    Outer middleware на update: запоминает, кто и когда писал, в памяти.
+    В базу (username, first_name, last_active) уходит одной пачкой раз в
+    ACTIVITY_FLUSH_EVERY через executemany, а не записью на каждое сообщение.
+    """
+
+    def __init__(self):
+        self._pending = {}  # user_id -> (username, first_name, время последней активности)
+        self.flushes = 0
+        self.flushed = 0
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None:
+            self._pending[user.id] = (user.username, user.first_name, time.time())
+        return await handler(event, data)
+
+    @staticmethod
+    def _upsert(conn, rows):
+        conn.executemany(_UPSERT_USER_SQL, rows)
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        rows = []
+        for user_id, (username, first_name, ts) in pending.items():
+            seen = datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+            rows.append((user_id, username, first_name, seen, seen))
+        try:
+            await db.write(self._upsert, rows)
+        except Exception:
+            # Вернуть в очередь, не затирая более свежую активность
+            for user_id, values in pending.items():
+                self._pending.setdefault(user_id, values)
+            raise
+        self.flushes += 1
+        self.flushed += len(rows)
+
+    async def run(self, every=ACTIVITY_FLUSH_EVERY):
+        while True:
+            await asyncio.sleep(every)
             try:
-                last_date = datetime.strptime(last_date_str, "%Y-%m-%d %H:%M:%S")
-                if (datetime.now() - last_date).total_seconds() < 5:
-                    logging.info("Duplicate transaction prevented")
-                    return False 
-            except ValueError:
-                pass
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Activity flush failed: {e}")
 
-        conn.execute(
-            "INSERT INTO transactions (user_id, amount, category, type, date, description) VALUES (?, ?, ?, ?, ?, ?)",
-            (user_id, float(amount), category, t_type, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), description)
-        )
+
+activity = ActivityTracker()
+dp.update.outer_middleware(activity)
+
+
+@dp.update.outer_middleware()
+async def remember_update_id(handler, event, data):
+    current_update_id.set(event.update_id)
+    return await handler(event, data)
+
+
+# Сколько хранить ключи идемпотентности (повтор позже этого срока уже не распознаётся)
+IDEMPOTENCY_KEY_TTL = 2 * 24 * 3600
+# Длина ключа от клиента
+IDEMPOTENCY_KEY_MAX_LEN = 64
+
+
+def _claim_key(conn, user_id, key):
+    """Занять ключ идемпотентности: False, если запись с этим ключом уже была (или ключа нет - True)"""
+    if key is None:
         return True
+    return conn.execute("INSERT OR IGNORE INTO idempotency_keys (user_id, key, created_at) VALUES (?, ?, ?)",
+                        (user_id, key, int(time.time()))).rowcount == 1
+
+
+EXPIRE_KEYS_QUERY = hot_query("expire_idempotency_keys",
+                              "DELETE FROM idempotency_keys WHERE created_at < ?", (0,))
+
+
+def expire_idempotency_keys(conn, ttl=IDEMPOTENCY_KEY_TTL):
+    """Удалить ключи старше ttl; сколько строк удалено"""
+    return conn.execute(EXPIRE_KEYS_QUERY, (int(time.time()) - ttl,)).rowcount
+
+
+# update_id текущего апдейта: ключ идемпотентности записей из сообщений бота
+# (тот же апдейт, доставленный повторно, не создаст вторую транзакцию)
+current_update_id = contextvars.ContextVar("current_update_id", default=None)
+
+
+def update_key():
+    update_id = current_update_id.get()
+    return None if update_id is None else f"u{update_id}"
+
+
+def _save_transaction(conn, user_id, amount, category, t_type, description=None, key=None):
+    # Защита от дублей (двойное нажатие, повторная отправка): ключ уже занят - ничего не пишем
+    if not _claim_key(conn, user_id, key):
+        logging.info("Duplicate transaction prevented")
+        return False
+
+    amount_minor = to_minor(amount)
+    now = datetime.now()
+    ts = int(now.timestamp())
+    conn.execute(
+        "INSERT INTO transactions (user_id, amount_minor, category, type, ts, day, description) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (user_id, amount_minor, category, t_type, ts, day_number(now), description)
+    )
+    _rollup_add(conn, user_id, month_number(now.year, now.month), category or '', t_type, amount_minor, 1)
+    return True
+
+
+def _save_with_new_category(conn, user_id, tx):
+    """Транзакция в новой категории: категория создаётся, только если транзакция записана"""
+    if not _save_transaction(conn, user_id, tx['amount'], tx['category_input'], tx['type'], tx['desc'], tx.get('key')):
+        return False
+    conn.execute("""INSERT INTO categories (user_id, name, type, created_at) SELECT ?, ?, ?, ?
+                    WHERE NOT EXISTS (SELECT 1 FROM categories WHERE user_id = ? AND name = ? AND type = ?)""",
+                 (user_id, tx['category_input'], tx['type'], datetime.now().strftime("%Y-%m-%d"),
+                  user_id, tx['category_input'], tx['type']))
+    return True
+
+
+async def save_transaction(user_id, amount, category, t_type, description=None, key=None):
+    saved = await db.write(_save_transaction, user_id, amount, category, t_type, description, key)
+    if saved:
+        category_index.add(user_id, t_type, category)
+        miniapp_cache.invalidate(user_id)
+    return saved
+
+
+def _set_budget(conn, user_id, category, limit, month):
+    # Upsert (удалим старый, добавим новый - проще всего)
+    conn.execute("DELETE FROM budgets WHERE user_id = ? AND category_name = ? AND month = ?",
+                 (user_id, category, month))
+    conn.execute("INSERT INTO budgets (user_id, category_name, amount_minor, month) VALUES (?, ?, ?, ?)",
+                 (user_id, category, to_minor(limit), month))
+
+
+_TX_PAGE_COLS = "id, amount_minor, category, type, ts, COALESCE(description, '')"
+TX_PAGE_NEWER_QUERY = hot_query(
+    "_load_tx_page: страница новее курсора",
+    f"SELECT {_TX_PAGE_COLS} FROM transactions WHERE user_id = ? AND id > ? ORDER BY id ASC LIMIT ?",
+    (1, 1000, 8))
+TX_PAGE_OLDER_QUERY = hot_query(
+    "_load_tx_page: страница старше курсора",
+    f"SELECT {_TX_PAGE_COLS} FROM transactions WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+    (1, 1000, 8))
+TX_HAS_NEWER_QUERY = hot_query(
+    "_load_tx_page: есть ли новее",
+    "SELECT 1 FROM transactions WHERE user_id = ? AND id > ? LIMIT 1", (1, 1000))
+TX_HAS_OLDER_QUERY = hot_query(
+    "_load_tx_page: есть ли старше",
+    "SELECT 1 FROM transactions WHERE user_id = ? AND id < ? LIMIT 1", (1, 1000))
+TX_COUNT_QUERY = hot_query(
+    "_load_tx_page: всего транзакций",
+    "SELECT tx_count FROM user_balance WHERE user_id = ?", (1,))
+
+
+def _load_tx_page(conn, user_id, cursor, per_page):
+    """
+    Страница транзакций по курсору (keyset, без OFFSET):
+    '' - самые новые, 'o<id>' - старше id, 'n<id>' - новее id.
+    Возвращает (строки от новых к старым, есть ли новее, есть ли старше, всего у пользователя).
+    """
+    rows = []
+    if cursor.startswith("n"):
+        rows = conn.execute(TX_PAGE_NEWER_QUERY, (user_id, int(cursor[1:]), per_page)).fetchall()[::-1]
+    # Назад упёрлись в начало (или курсора нет) - показываем самые новые
+    if not cursor.startswith("n") or len(rows) < per_page:
+        before = int(cursor[1:]) if cursor.startswith("o") else 2 ** 63 - 1
+        rows = conn.execute(TX_PAGE_OLDER_QUERY, (user_id, before, per_page)).fetchall()
+
+    has_newer = has_older = False
+    if rows:
+        has_newer = conn.execute(TX_HAS_NEWER_QUERY, (user_id, rows[0][0])).fetchone() is not None
+        has_older = conn.execute(TX_HAS_OLDER_QUERY, (user_id, rows[-1][0])).fetchone() is not None
+    total = conn.execute(TX_COUNT_QUERY, (user_id,)).fetchone()
+    return rows, has_newer, has_older, (total[0] if total else 0)
+
+
+def _page_cursor(rows, has_newer):
+    """Курсор, который снова откроет ту же страницу (для возврата после удаления/отмены)"""
+    return f"o{rows[0][0] + 1}" if rows and has_newer else ""
+
+
+# --- ИСХОДЯЩИЕ ЗАПРОСЫ К TELEGRAM (очередь отправки) ---
+# Лимиты Bot API: около 30 сообщений в секунду на бота и около 1 в секунду в один чат
+# (короткие всплески допустимы), сверх - 429 с retry_after.
+# SEND_GLOBAL_RATE - потолок за любую секунду с учётом всплеска SEND_GLOBAL_BURST
+# (ведро пополняется на RATE - BURST в секунду). С --workers потолок делится между воркерами
+SEND_GLOBAL_RATE = 28
+SEND_GLOBAL_BURST = 3
+SEND_CHAT_RATE = 1.0
+SEND_CHAT_BURST = 3
+# Одновременных HTTP запросов к Bot API
+SEND_CONCURRENCY = 8
+# Максимум ожидающих запросов в каждой полосе; сверх - SendQueueFull
+SEND_QUEUE_LIMIT = 1000
+# Сколько раз повторять запрос после 429
+SEND_MAX_RETRIES = 3
+# Сколько ждать отправки остатка очереди при остановке
+SEND_DRAIN_TIMEOUT = 5.0
+
+# Полосы приоритета: ответы пользователю уходят раньше фоновых обновлений Menu Button
+SEND_LANE_REPLY = 0
+SEND_LANE_MENU = 1
+SEND_LANES = ("reply", "menu")
+
+
+class SendQueueFull(Exception):
+    """Очередь отправки переполнена - запрос не принят"""
+
+
+class TokenBucket:
+    """Ведро токенов: rate запросов в секунду, не больше burst подряд"""
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def wait_time(self, now):
+        """Через сколько секунд появится токен (0 - уже есть)"""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def full(self, now):
+        return self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+
+class _SendJob:
+    __slots__ = ("make_request", "bot", "method", "chat_id", "lane", "seq", "waiters", "enqueued", "retries")
+
+    def __init__(self, make_request, bot, method, chat_id, lane, seq, waiter):
+        self.make_request = make_request
+        self.bot = bot
+        self.method = method
+        self.chat_id = chat_id
+        self.lane = lane
+        self.seq = seq
+        self.waiters = [waiter]
+        self.enqueued = time.monotonic()
+        self.retries = 0
+
+
+class SendQueue(BaseRequestMiddleware):
+    """
+    Middleware сессии бота: все запросы с chat_id (message.answer, send_message,
+    set_chat_menu_button...) проходят через очередь с общим и по-чатовым ведром
+    токенов. Полоса ответов обслуживается раньше полосы Menu Button; ещё не
+    отправленное обновление Menu Button того же чата заменяется новым.
+    На 429 чат ставится на паузу retry_after, запрос повторяется.
+    В одном чате одновременно не больше одного запроса - порядок сохраняется.
+    Запросы без chat_id (getUpdates, answerCallbackQuery, setWebhook) идут напрямую.
+
+    Очереди хранятся по чатам. Чат, который можно обслужить сейчас, лежит в куче
+    готовых своей полосы (по порядку постановки), чат на паузе или с пустым
+    ведром - в куче ожидания по времени готовности. Каждый запрос стоит O(log n),
+    полного перебора очереди на пробуждении нет.
+    """
+
+    def __init__(self, global_rate=SEND_GLOBAL_RATE, global_burst=SEND_GLOBAL_BURST, chat_rate=SEND_CHAT_RATE,
+                 chat_burst=SEND_CHAT_BURST, concurrency=SEND_CONCURRENCY, limit=SEND_QUEUE_LIMIT,
+                 max_retries=SEND_MAX_RETRIES):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.concurrency = concurrency
+        self.limit = limit
+        self.max_retries = max_retries
+        self.set_global_limit(global_rate, global_burst)
+        self._pending = {}  # chat_id -> (ответы, кнопки) - deque запросов по полосам
+        self._ready = [[] for _ in SEND_LANES]  # кучи (seq головного запроса, gen, chat_id)
+        self._waiting = []  # куча (когда будет готов, gen, chat_id)
+        self._gen = {}  # chat_id -> gen его актуальной записи в кучах; остальные записи устарели
+        self._seq = itertools.count()
+        self._depth = [0] * len(SEND_LANES)
+        self._menu_jobs = {}  # chat_id -> ещё не отправленный SetChatMenuButton
+        self._chats = {}  # chat_id -> TokenBucket
+        self._blocked = {}  # chat_id -> time.monotonic(), до которого чат на паузе после 429
+        self._busy = set()  # чаты с запросом в полёте
+        self._sending = set()
+        self._task = None
+        self._wakeup = None
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rejected = 0
+        self.coalesced = 0
+        self.max_depth = [0] * len(SEND_LANES)
+        self.latency = [deque(maxlen=1000) for _ in SEND_LANES]  # секунды от постановки до ответа
+
+    def set_global_limit(self, rate, burst):
+        """Не больше rate запросов за любую секунду, из них подряд - не больше burst"""
+        burst = max(1.0, min(burst, rate / 2))
+        self.global_rate = rate
+        self._global = TokenBucket(max(rate - burst, rate / 2), burst, time.monotonic())
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        lane = SEND_LANE_MENU if isinstance(method, SetChatMenuButton) else SEND_LANE_REPLY
+        waiter = asyncio.get_running_loop().create_future()
+        job = self._menu_jobs.get(chat_id) if lane == SEND_LANE_MENU else None
+        if job is not None:
+            # Старая кнопка ещё не ушла - отправим только новую, ответ получат оба
+            job.method = method
+            job.waiters.append(waiter)
+            self.coalesced += 1
+        else:
+            if self._depth[lane] >= self.limit:
+                self.rejected += 1
+                raise SendQueueFull(f"send queue '{SEND_LANES[lane]}' is full ({self.limit})")
+            job = _SendJob(make_request, bot, method, chat_id, lane, next(self._seq), waiter)
+            jobs = self._pending.get(chat_id)
+            if jobs is None:
+                jobs = self._pending[chat_id] = (deque(), deque())
+            jobs[lane].append(job)
+            self._depth[lane] += 1
+            if lane == SEND_LANE_MENU:
+                self._menu_jobs[chat_id] = job
+            self.max_depth[lane] = max(self.max_depth[lane], self._depth[lane])
+            # Переставляем чат, только если у него сменился головной запрос
+            if chat_id not in self._gen or (lane == SEND_LANE_REPLY and len(jobs[lane]) == 1):
+                self._schedule(chat_id, time.monotonic())
+        self._start()
+        self._wakeup.set()
+        return await waiter
+
+    def _start(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._dispatch(time.monotonic())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _schedule(self, chat_id, now):
+        """Положить чат в кучу готовых или ожидания (старая запись чата становится устаревшей)"""
+        jobs = self._pending.get(chat_id)
+        if chat_id in self._busy or jobs is None:
+            self._gen.pop(chat_id, None)
+            return
+        if not jobs[SEND_LANE_REPLY] and not jobs[SEND_LANE_MENU]:
+            del self._pending[chat_id]
+            self._gen.pop(chat_id, None)
+            return
+        gen = self._gen[chat_id] = next(self._seq)
+        wait = self._blocked.get(chat_id, now) - now
+        if wait <= 0:
+            self._blocked.pop(chat_id, None)
+            bucket = self._chats.get(chat_id)
+            if bucket is None:
+                bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+            wait = bucket.wait_time(now)
+        if wait > 0:
+            heapq.heappush(self._waiting, (now + wait, gen, chat_id))
+        else:
+            lane = SEND_LANE_REPLY if jobs[SEND_LANE_REPLY] else SEND_LANE_MENU
+            heapq.heappush(self._ready[lane], (jobs[lane][0].seq, gen, chat_id))
+
+    def _peek_ready(self):
+        """Куча, на вершине которой лежит следующий чат к отправке (None - готовых нет)"""
+        for heap in self._ready:
+            while heap and self._gen.get(heap[0][2]) != heap[0][1]:
+                heapq.heappop(heap)
+            if heap:
+                return heap
+        return None
+
+    def _dispatch(self, now):
+        """Запускает готовые запросы; возвращает, через сколько секунд проверить снова (None - ждать события)"""
+        if len(self._chats) > 1000:
+            # Полное ведро ничем не отличается от нового - храним только «потраченные»
+            self._chats = {c: b for c, b in self._chats.items() if c in self._busy or not b.full(now)}
+        while self._waiting and self._waiting[0][0] <= now:
+            _, gen, chat_id = heapq.heappop(self._waiting)
+            if self._gen.get(chat_id) == gen:
+                self._schedule(chat_id, now)
+
+        # В полёте не больше concurrency (по запросу на чат); _sending освобождается позже _busy
+        while len(self._busy) < self.concurrency:
+            heap = self._peek_ready()
+            if heap is None:
+                break
+            wait = self._global.wait_time(now)
+            if wait > 0:
+                # Общий лимит исчерпан - остальные подождут
+                return wait
+            chat_id = heapq.heappop(heap)[2]
+            del self._gen[chat_id]
+            jobs = self._pending[chat_id]
+            lane = SEND_LANE_REPLY if jobs[SEND_LANE_REPLY] else SEND_LANE_MENU
+            job = jobs[lane].popleft()
+            self._depth[lane] -= 1
+            if self._menu_jobs.get(chat_id) is job:
+                del self._menu_jobs[chat_id]
+            bucket = self._chats.get(chat_id)
+            if bucket is None:
+                bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+            bucket.wait_time(now)
+            self._global.take()
+            bucket.take()
+            self._busy.add(chat_id)
+            task = asyncio.create_task(self._send(job))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+        while self._waiting and self._gen.get(self._waiting[0][2]) != self._waiting[0][1]:
+            heapq.heappop(self._waiting)
+        return max(0.0, self._waiting[0][0] - now) if self._waiting else None
+
+    async def _send(self, job):
+        try:
+            result = await job.make_request(job.bot, job.method)
+        except TelegramRetryAfter as e:
+            if job.retries >= self.max_retries:
+                self._finish(job, error=e)
+                return
+            job.retries += 1
+            self.retried += 1
+            self._blocked[job.chat_id] = time.monotonic() + e.retry_after
+            logging.warning(f"Flood control in chat {job.chat_id}: retry after {e.retry_after}s "
+                            f"({job.retries}/{self.max_retries})")
+            newer = self._menu_jobs.get(job.chat_id) if job.lane == SEND_LANE_MENU else None
+            if newer is not None:
+                newer.waiters.extend(job.waiters)
+            else:
+                self._pending.setdefault(job.chat_id, (deque(), deque()))[job.lane].appendleft(job)
+                self._depth[job.lane] += 1
+                if job.lane == SEND_LANE_MENU:
+                    self._menu_jobs[job.chat_id] = job
+        except Exception as e:
+            self._finish(job, error=e)
+        else:
+            self._finish(job, result=result)
+        finally:
+            self._busy.discard(job.chat_id)
+            self._schedule(job.chat_id, time.monotonic())
+            self._wakeup.set()
+
+    def _finish(self, job, result=None, error=None):
+        self.latency[job.lane].append(time.monotonic() - job.enqueued)
+        if error is None:
+            self.sent += 1
+        else:
+            self.failed += 1
+        for waiter in job.waiters:
+            if waiter.done():
+                continue
+            if error is None:
+                waiter.set_result(result)
+            else:
+                waiter.set_exception(error)
+
+    def depth(self, lane=None):
+        if lane is None:
+            return sum(self._depth)
+        return self._depth[lane]
+
+    def stats(self):
+        result = {}
+        for lane, name in enumerate(SEND_LANES):
+            ordered = sorted(self.latency[lane])
+            pick = (lambda q: ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000) if ordered else (lambda q: 0.0)
+            result[name] = {"depth": self._depth[lane], "max_depth": self.max_depth[lane],
+                            "p50": pick(0.5), "p95": pick(0.95)}
+        return result
+
+    async def close(self, timeout=SEND_DRAIN_TIMEOUT):
+        """Дождаться отправки очереди (при остановке), остальное отменить"""
+        deadline = time.monotonic() + timeout
+        while (self.depth() or self._sending) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+        dropped = self.depth()
+        for jobs in self._pending.values():
+            for lane in jobs:
+                for job in lane:
+                    for waiter in job.waiters:
+                        waiter.cancel()
+        self._pending.clear()
+        self._gen.clear()
+        self._ready = [[] for _ in SEND_LANES]
+        self._waiting.clear()
+        self._depth = [0] * len(SEND_LANES)
+        self._menu_jobs.clear()
+        if dropped:
+            logging.warning(f"Send queue closed with {dropped} unsent requests")
+
+send_queue = SendQueue()
+bot.session.middleware(send_queue)
+
+# Ссылки на фоновые задачи, чтобы их не собрал GC до завершения
+_background_tasks = set()
+
+
+def send_in_background(chat_id, text, **kwargs):
+    """Поставить сообщение в очередь отправки, не дожидаясь Telegram (ошибка только в лог)"""
+
+    async def deliver():
+        try:
+            await bot.send_message(chat_id, text, **kwargs)
+        except Exception as e:
+            logging.error(f"Failed to send message to {chat_id}: {e}")
+
+    task = asyncio.create_task(deliver())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+def check_send_queue_cli(chats=12, per_chat=10):
+    """
+    Очередь отправки против локального фейкового Bot API: порядок в чатах, лимиты,
+    приоритет ответов над Menu Button, повтор после 429 и переполнение. Код возврата 1 при ошибке
+    """
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    global_rate, global_burst, chat_rate, chat_burst = 30, 3, 5.0, 2
+    flood_chat = 3
+    received = []  # (время, метод, chat_id, текст или кнопка)
+
+    async def handle(request):
+        method = request.match_info["method"].lower()
+        form = await request.post()
+        chat_id = int(form["chat_id"])
+        if chat_id == flood_chat and not handle.flooded:
+            handle.flooded = True
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                      "parameters": {"retry_after": 1}})
+        received.append((time.monotonic(), method, chat_id, form.get("text") or form.get("menu_button")))
+        await asyncio.sleep(0.02)
+        if method == "sendmessage":
+            result = {"message_id": len(received), "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "text": form["text"]}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+    handle.flooded = False
+
+    def max_in_window(stamps, window=1.0):
+        stamps, best, lo = sorted(stamps), 0, 0
+        for hi, t in enumerate(stamps):
+            while t - stamps[lo] > window:
+                lo += 1
+            best = max(best, hi - lo + 1)
+        return best
+
+    async def run():
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        api = TelegramAPIServer.from_base(f"http://127.0.0.1:{port}")
+        errors = []
+        try:
+            test_bot = Bot(token="42:TEST", session=AiohttpSession(api=api))
+            queue_ = SendQueue(global_rate=global_rate, global_burst=global_burst, chat_rate=chat_rate,
+                               chat_burst=chat_burst)
+            test_bot.session.middleware(queue_)
+
+            async def menu(chat_id, n):
+                button = types.MenuButtonWebApp(text="app", web_app=WebAppInfo(url=f"https://example.org/?n={n}"))
+                await test_bot.set_chat_menu_button(chat_id=chat_id, menu_button=button)
+
+            started = time.monotonic()
+            await asyncio.gather(*[test_bot.send_message(c, f"{c}:{i}") for i in range(per_chat) for c in range(1, chats + 1)],
+                                 *[menu(c, n) for n in range(3) for c in range(1, chats + 1)])
+            elapsed = time.monotonic() - started
+
+            for c in range(1, chats + 1):
+                seen = [r for r in received if r[2] == c]
+                texts = [r[3] for r in seen if r[1] == "sendmessage"]
+                if texts != [f"{c}:{i}" for i in range(per_chat)]:
+                    errors.append(f"chat {c}: order {texts}")
+                menus = [r for r in seen if r[1] == "setchatmenubutton"]
+                if len(menus) != 1 or "n=2" not in menus[0][3]:
+                    errors.append(f"chat {c}: menu buttons {[m[3] for m in menus]}")
+                elif seen[-1][1] != "setchatmenubutton":
+                    errors.append(f"chat {c}: menu button sent before replies")
+                burst = max_in_window([r[0] for r in seen])
+                if burst > chat_burst + chat_rate:
+                    errors.append(f"chat {c}: {burst} requests within 1s")
+            burst = max_in_window([r[0] for r in received])
+            if burst > global_rate:
+                errors.append(f"global: {burst} requests within 1s")
+            if queue_.retried != 1 or queue_.failed:
+                errors.append(f"retried={queue_.retried} failed={queue_.failed}")
+
+            st = queue_.stats()
+            print(f"{len(received)} requests in {elapsed:.2f}s, peak {burst}/s, retried {queue_.retried}, "
+                  f"coalesced {queue_.coalesced}")
+            for name, s in st.items():
+                print(f"  {name}: max depth {s['max_depth']}, p50 {s['p50']:.0f} ms, p95 {s['p95']:.0f} ms")
+            await queue_.close()
+
+            # Переполнение: лишние запросы отклоняются сразу
+            await test_bot.session.close()
+            small = SendQueue(limit=5)
+            test_bot = Bot(token="42:TEST", session=AiohttpSession(api=api))
+            test_bot.session.middleware(small)
+            results = await asyncio.gather(*[test_bot.send_message(100 + i, "x") for i in range(8)], return_exceptions=True)
+            rejected = sum(isinstance(r, SendQueueFull) for r in results)
+            print(f"  bounded queue: {rejected} of 8 rejected with limit 5")
+            if rejected != 3:
+                errors.append(f"bounded queue rejected {rejected}, expected 3")
+            await small.close()
+            await test_bot.session.close()
+        finally:
+            await runner.cleanup()
+        for e in errors:
+            print(f"FAIL {e}")
+        print("FAIL" if errors else "OK")
+        return 1 if errors else 0
+
+    return asyncio.run(run())
 
 
 # --- 1. ОБРАБОТКА ДАННЫХ ИЗ MINI APP (tg.sendData) ---
@@ -214,6 +2335,106 @@ def save_transaction(user_id, amount, category, t_type, description=None):
 #         await message.answer("❌ Ошибка при сохранении данных.")
 
 # --- 2. API ОБРАБОТЧИК (Прямой POST запрос) ---
+# Сколько действий принимает /api/batch за один запрос и сколько из них перечислять в уведомлении
+BATCH_MAX_ACTIONS = 100
+BATCH_SUMMARY_LINES = 10
+# Предел суммы в рублях: копейки должны влезть в INTEGER SQLite
+ACTION_AMOUNT_MAX = 10 ** 12
+
+
+def _action_amount(value):
+    """Сумма из MiniApp: конечное число (inf/nan иначе упадут уже в писателе)"""
+    amount = float(value)
+    if not math.isfinite(amount) or abs(amount) > ACTION_AMOUNT_MAX:
+        raise ValueError(f"invalid amount: {value!r}")
+    return amount
+
+
+def _action_text(value, name):
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError(f"{name} must be a non-empty string")
+    return value
+
+
+def _action_id(value):
+    """id цели: целое число или строка из цифр (1.5 и true не принимаем)"""
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"invalid id: {value!r}")
+    return int(value)
+
+
+def _parse_action(data):
+    """
+    Действие MiniApp -> (action, поля, ключ идемпотентности) с приведёнными типами;
+    ValueError/TypeError при кривых данных
+    """
+    action = data.get('action')
+    key = data.get('k')
+    if key is not None and (not isinstance(key, str) or not key or len(key) > IDEMPOTENCY_KEY_MAX_LEN):
+        raise ValueError("invalid idempotency key")
+    if action == "add_tx":
+        # сумма, категория, income/expense, описание
+        t_type = data.get('t')
+        if t_type not in ("income", "expense"):
+            raise ValueError(f"invalid type: {t_type!r}")
+        desc = data.get('d') or ''
+        if not isinstance(desc, str):
+            raise ValueError("description must be a string")
+        return action, (_action_amount(data.get('a')), _action_text(data.get('c'), "category"), t_type, desc), key
+    if action == "add_goal":
+        return action, (_action_text(data.get('n'), "name"), _action_amount(data.get('t'))), key
+    if action == "add_budget":
+        return action, (_action_text(data.get('c'), "category"), _action_amount(data.get('l'))), key
+    if action == "top_up_goal":
+        return action, (_action_id(data.get('id')), _action_amount(data.get('a'))), key
+    raise ValueError(f"Unknown action: {action}")
+
+
+def _apply_action(conn, user_id, action, fields, key=None):
+    """Записать разобранное действие; текст уведомления или None, если действие с этим ключом уже было"""
+    if action == "add_tx":
+        amount, cat, t_type, desc = fields
+        if not _save_transaction(conn, user_id, amount, cat, t_type, desc, key):
+            return None
+        return f"✅ Добавлено: {amount:.0f} р. ({cat})"
+    if not _claim_key(conn, user_id, key):
+        return None
+    if action == "add_goal":
+        name, target = fields
+        conn.execute("INSERT INTO goals (user_id, name, target_amount, current_amount, created_at) VALUES (?, ?, ?, 0, ?)",
+                     (user_id, name, target, datetime.now().strftime("%Y-%m-%d")))
+        return f"🎯 Цель '{name}' создана!"
+    if action == "add_budget":
+        cat, limit = fields
+        _set_budget(conn, user_id, cat, limit, current_month())
+        return f"⚖️ Бюджет на '{cat}' установлен!"
+    gid, amount = fields
+    conn.execute("UPDATE goals SET current_amount = current_amount + ? WHERE id = ? AND user_id = ?", (amount, gid, user_id))
+    return f"💰 Копилка пополнена на {amount:.0f} р.!"
+
+
+def _apply_batch(conn, user_id, actions):
+    """Действия пакета по порядку в одной транзакции писателя: ошибка любого откатывает весь пакет"""
+    return [_apply_action(conn, user_id, *parsed) for parsed in actions]
+
+
+def _after_actions(user_id, actions, texts):
+    """Кэши после коммита действий MiniApp"""
+    for (action, fields, _), text in zip(actions, texts):
+        if action == "add_tx" and text is not None:
+            category_index.add(user_id, fields[2], fields[1])
+    miniapp_cache.invalidate(user_id)
+
+
+def _batch_summary(texts):
+    if len(texts) == 1:
+        return texts[0]
+    shown = texts[:BATCH_SUMMARY_LINES]
+    summary = f"✅ Из MiniApp сохранено действий: {len(texts)}\n\n" + "\n".join(shown)
+    if len(texts) > len(shown):
+        summary += f"\n… и ещё {len(texts) - len(shown)}"
+    return summary
+
 # Универсальный API для MiniApp (работает через MenuButton и KeyboardButton)
 
 async def handle_api_action(request):
@@ -237,56 +2458,20 @@ async def handle_api_action(request):
         if not user_id:
             return web.json_response({"status": "error", "message": "user_id required"}, status=400, headers=headers)
         
-        resp_text = "✅ Данные обновлены"
+        request["metrics_action"] = action if action in ("add_tx", "add_goal", "add_budget", "top_up_goal") else "unknown"
+        if action not in ("add_tx", "add_goal", "add_budget", "top_up_goal"):
+            return web.json_response({"status": "error", "message": f"Unknown action: {action}"}, status=400, headers=headers)
+        parsed = _parse_action(data)
+        resp_text = await db.write(_apply_action, user_id, *parsed)
+        if resp_text is None:
+            return web.json_response({"status": "duplicate", "message": "Уже сохранено"}, headers=headers)
+        _after_actions(user_id, [parsed], [resp_text])
         
-        with sqlite3.connect(DB_PATH) as conn:
-            if action == "add_tx":
-                t_type = data.get('t')  # income/expense
-                amount = float(data.get('a'))
-                cat = data.get('c')
-                desc = data.get('d', '')
-                
-                # Используем save_transaction с защитой от дублей
-                if not save_transaction(user_id, amount, cat, t_type, desc):
-                    return web.json_response({"status": "duplicate", "message": "Дубликат транзакции"}, headers=headers)
-                
-                icon = "📉" if t_type == "expense" else "📈"
-                resp_text = f"✅ Добавлено: {amount:.0f} р. ({cat})"
-                
-            elif action == "add_goal":
-                name = data.get('n')
-                target = float(data.get('t'))
-                conn.execute("INSERT INTO goals (user_id, name, target_amount, current_amount, created_at) VALUES (?, ?, ?, 0, ?)",
-                             (user_id, name, target, datetime.now().strftime("%Y-%m-%d")))
-                resp_text = f"🎯 Цель '{name}' создана!"
-                
-            elif action == "add_budget":
-                cat = data.get('c')
-                limit = float(data.get('l'))
-                m_key = datetime.now().strftime("%Y-%m")
-                conn.execute("DELETE FROM budgets WHERE user_id = ? AND category_name = ? AND month_year = ?", (user_id, cat, m_key))
-                conn.execute("INSERT INTO budgets (user_id, category_name, amount, month_year) VALUES (?, ?, ?, ?)", (user_id, cat, limit, m_key))
-                resp_text = f"⚖️ Бюджет на '{cat}' установлен!"
-
-            elif action == "top_up_goal":
-                gid = data.get('id')
-                amount = float(data.get('a'))
-                conn.execute("UPDATE goals SET current_amount = current_amount + ? WHERE id = ? AND user_id = ?", (amount, gid, user_id))
-                resp_text = f"💰 Копилка пополнена на {amount:.0f} р.!"
-            
-            else:
-                return web.json_response({"status": "error", "message": f"Unknown action: {action}"}, status=400, headers=headers)
-            
-            conn.commit()
-        
-        # Отправляем уведомление в бот
-        try:
-            await bot.send_message(user_id, resp_text, parse_mode="Markdown")
-        except Exception as e:
-            logging.error(f"Failed to send message: {e}")
+        # Уведомление в бот - через очередь отправки, HTTP ответ его не ждёт
+        send_in_background(user_id, resp_text, parse_mode="Markdown")
         
         # Обновляем Menu Button
-        await update_user_menu_button(user_id)
+        menu_refresher.schedule(user_id)
         
         return web.json_response({"status": "ok", "message": resp_text}, headers=headers)
         
@@ -295,14 +2480,171 @@ async def handle_api_action(request):
         return web.json_response({"status": "error", "message": str(e)}, status=400, headers=headers)
 
 
+# Сколько живёт подписанный initData MiniApp
+INIT_DATA_TTL = 24 * 3600
+
+# Ключ проверки initData: HMAC-SHA256 токена бота с ключом "WebAppData"
+_INIT_DATA_SECRET = hmac.new(b"WebAppData", API_TOKEN.encode(), hashlib.sha256).digest()
+
+
+def validate_init_data(init_data, max_age=INIT_DATA_TTL):
+    """Проверить подпись initData из Telegram WebApp; user_id или None"""
+    fields = dict(parse_qsl(init_data or "", keep_blank_values=True))
+    received = fields.pop("hash", "")
+    check_string = "\n".join(f"{k}={v}" for k, v in sorted(fields.items()))
+    expected = hmac.new(_INIT_DATA_SECRET, check_string.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, received):
+        return None
+    try:
+        if time.time() - int(fields["auth_date"]) > max_age:
+            return None
+        return int(json.loads(fields["user"])["id"])
+    except (KeyError, ValueError, TypeError):
+        return None
+
+
+DATA_VERSION_QUERY = hot_query("api_data: версия данных",
+                               "SELECT version FROM user_data_version WHERE user_id = ?", (1,))
+
+
+def _load_data_version(conn, user_id):
+    row = conn.execute(DATA_VERSION_QUERY, (user_id,)).fetchone()
+    return row[0] if row else 0
+
+
+async def _authorize_api(request, headers):
+    """user_id из "Authorization: tma <initData>" или готовый ответ с ошибкой"""
+    auth = request.headers.get('Authorization', '')
+    user_id = validate_init_data(auth[4:] if auth.startswith('tma ') else '')
+    if user_id is None:
+        return None, web.json_response({"status": "error", "message": "invalid initData"}, status=401, headers=headers)
+    if await is_user_blocked(user_id):
+        return None, web.json_response({"status": "error", "message": "blocked"}, status=403, headers=headers)
+    return user_id, None
+
+
+async def handle_api_data(request):
+    """GET /api/data: payload MiniApp по initData, с ETag и ответом 304 без изменений"""
+    headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, OPTIONS',
+        'Access-Control-Allow-Headers': 'Authorization, If-None-Match',
+        'Access-Control-Expose-Headers': 'ETag',
+    }
+    if request.method == 'OPTIONS':
+        return web.Response(headers=headers)
+
+    user_id, error = await _authorize_api(request, headers)
+    if error:
+        return error
+
+    # Версию читаем до сборки payload: если запись пройдёт между ними, ETag окажется
+    # старее данных и следующий запрос просто заберёт их ещё раз
+    version = await db.read(_load_data_version, user_id)
+    # Бюджеты и итоги считаются за текущий месяц - он тоже часть версии
+    etag = f'"{user_id}-{version}-{current_month()}"'
+    headers['ETag'] = etag
+    headers['Cache-Control'] = 'private, no-cache'
+
+    if_none_match = request.headers.get('If-None-Match', '')
+    if if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]:
+        return web.Response(status=304, headers=headers)
+
+    # seq и mo - курсор, с которого MiniApp потом синхронизируется через /api/sync (payload из кэша общий, копируем)
+    payload = dict(await get_miniapp_data(user_id), seq=version, mo=current_month())
+    response = web.Response(text=json.dumps(payload, ensure_ascii=False), content_type='application/json', headers=headers)
+    response.enable_compression()
+    return response
+
+
+async def handle_api_sync(request):
+    """GET /api/sync?since=<seq>&mo=<месяц>: изменения данных MiniApp после версии seq"""
+    headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, OPTIONS',
+        'Access-Control-Allow-Headers': 'Authorization',
+    }
+    if request.method == 'OPTIONS':
+        return web.Response(headers=headers)
+
+    user_id, error = await _authorize_api(request, headers)
+    if error:
+        return error
+    try:
+        since = int(request.query.get('since', '0'))
+        # Месяц, за который у клиента итоги и бюджеты (нет у старых клиентов - пришлём их заново)
+        client_month = int(request.query.get('mo') or 0)
+    except ValueError:
+        return web.json_response({"status": "error", "message": "since and mo must be integers"}, status=400, headers=headers)
+
+    headers['Cache-Control'] = 'no-store'
+    delta = await db.read(_load_sync, user_id, since, current_month(), client_month)
+    response = web.Response(text=json.dumps(delta, ensure_ascii=False), content_type='application/json', headers=headers)
+    response.enable_compression()
+    return response
+
+
+async def handle_api_batch(request):
+    """
+    POST /api/batch {"actions": [...]}: накопленные MiniApp действия (add_tx, add_goal,
+    add_budget, top_up_goal) по порядку в одной транзакции, одно уведомление и одно обновление кнопки
+    """
+    headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'POST, OPTIONS',
+        'Access-Control-Allow-Headers': 'Authorization, Content-Type',
+    }
+    if request.method == 'OPTIONS':
+        return web.Response(headers=headers)
+
+    user_id, error = await _authorize_api(request, headers)
+    if error:
+        return error
+    try:
+        body = await request.json()
+    except ValueError:
+        return web.json_response({"status": "error", "message": "invalid JSON"}, status=400, headers=headers)
+    items = body.get('actions') if isinstance(body, dict) else None
+    if not isinstance(items, list) or not items:
+        return web.json_response({"status": "error", "message": "actions must be a non-empty list"}, status=400, headers=headers)
+    if len(items) > BATCH_MAX_ACTIONS:
+        return web.json_response({"status": "error", "message": f"too many actions (max {BATCH_MAX_ACTIONS})"},
+                                 status=400, headers=headers)
+
+    # Всё проверяем до записи: index - какое действие клиенту выбросить из очереди
+    actions = []
+    for index, data in enumerate(items):
+        try:
+            actions.append(_parse_action(data if isinstance(data, dict) else {}))
+        except (TypeError, ValueError) as e:
+            return web.json_response({"status": "error", "message": str(e), "index": index}, status=400, headers=headers)
+
+    try:
+        texts = await db.write(_apply_batch, user_id, actions)
+    except Exception as e:
+        logging.error(f"API batch error for {user_id}: {e}")
+        return web.json_response({"status": "error", "message": str(e)}, status=500, headers=headers)
+    _after_actions(user_id, actions, texts)
+
+    applied = [text for text in texts if text is not None]
+    summary = _batch_summary(applied) if applied else "Уже сохранено"
+    if applied:
+        send_in_background(user_id, summary, parse_mode="Markdown")
+        menu_refresher.schedule(user_id)
+    return web.json_response({
+        "status": "ok",
+        "message": summary,
+        "results": ["ok" if text is not None else "duplicate" for text in texts],
+    }, headers=headers)
+
+
 # --- 3. ОБЫЧНЫЕ КОМАНДЫ БОТА ---
 @dp.message(Command("start"))
 async def start_cmd(message: types.Message):
-    init_db()
-    register_user(message.from_user)
+    await register_user(message.from_user)
     
     # Проверка блокировки
-    if is_user_blocked(message.from_user.id):
+    if await is_user_blocked(message.from_user.id):
         await message.answer("🚫 Ваш аккаунт заблокирован. Обратитесь к администратору.")
         return
     # Проверяем, есть ли аргументы (payload)
@@ -322,17 +2664,19 @@ async def start_cmd(message: types.Message):
             decoded_bytes = base64.urlsafe_b64decode(payload)
             decoded_str = decoded_bytes.decode('utf-8')
             
-            # Формат строки: action|param1|param2
+            # Формат строки: action|param1|param2[|nonce] (nonce - ключ от повторного нажатия той же ссылки)
             parts = decoded_str.split('|')
             
             if len(parts) >= 3:
                 action = parts[0]
+                # Повторное нажатие той же ссылки или повторная доставка апдейта - запись уже была
+                key = f"s{parts[3]}"[:IDEMPOTENCY_KEY_MAX_LEN] if len(parts) > 3 and parts[3] else update_key()
                 
                 # --- ТРАНЗАКЦИЯ (income|1000|Salary или expense|500|Food) ---
                 if action in ('income', 'expense'):
                     t_type, amount, category = action, parts[1], parts[2]
                     
-                    if not save_transaction(message.from_user.id, amount, category, t_type):
+                    if not await save_transaction(message.from_user.id, amount, category, t_type, key=key):
                         try:
                             await message.delete()
                         except:
@@ -347,61 +2691,61 @@ async def start_cmd(message: types.Message):
                     icon = "📉" if t_type == 'expense' else "📈"
                     await message.answer(f"✅ **Данные сохранены!**\n{icon} {amount} р. ({category})",
                                          parse_mode="Markdown")
-                    await update_user_menu_button(message.from_user.id)
+                    menu_refresher.schedule(message.from_user.id)
                     return
                 
                 # --- ЦЕЛЬ (goal|iPhone|100000) ---
                 elif action == 'goal':
-                    name, target = parts[1], float(parts[2])
-                    with sqlite3.connect(DB_PATH) as conn:
-                        conn.execute("INSERT INTO goals (user_id, name, target_amount, current_amount, created_at) VALUES (?, ?, ?, 0, ?)",
-                                     (message.from_user.id, name, target, datetime.now().strftime("%Y-%m-%d")))
-                        conn.commit()
+                    name, target = parts[1], _action_amount(parts[2])
+                    saved = await db.write(_apply_action, message.from_user.id, "add_goal", (name, target), key)
+                    if saved:
+                        miniapp_cache.invalidate(message.from_user.id)
                     
                     try:
                         await message.delete()
                     except:
                         pass
+                    if not saved:
+                        return
                     
                     await message.answer(f"🎯 **Цель '{name}' создана!**\nНужно накопить: {target:,.0f} р.", parse_mode="Markdown")
-                    await update_user_menu_button(message.from_user.id)
+                    menu_refresher.schedule(message.from_user.id)
                     return
                 
                 # --- БЮДЖЕТ (budget|Food|10000) ---
                 elif action == 'budget':
-                    cat, limit = parts[1], float(parts[2])
-                    month_key = datetime.now().strftime("%Y-%m")
-                    with sqlite3.connect(DB_PATH) as conn:
-                        conn.execute("DELETE FROM budgets WHERE user_id = ? AND category_name = ? AND month_year = ?",
-                                     (message.from_user.id, cat, month_key))
-                        conn.execute("INSERT INTO budgets (user_id, category_name, amount, month_year) VALUES (?, ?, ?, ?)",
-                                     (message.from_user.id, cat, limit, month_key))
-                        conn.commit()
+                    cat, limit = parts[1], _action_amount(parts[2])
+                    saved = await db.write(_apply_action, message.from_user.id, "add_budget", (cat, limit), key)
+                    if saved:
+                        miniapp_cache.invalidate(message.from_user.id)
                     
                     try:
                         await message.delete()
                     except:
                         pass
+                    if not saved:
+                        return
                     
                     await message.answer(f"⚖️ **Бюджет на '{cat}' установлен!**\nЛимит: {limit:,.0f} р.", parse_mode="Markdown")
-                    await update_user_menu_button(message.from_user.id)
+                    menu_refresher.schedule(message.from_user.id)
                     return
                 
                 # --- ПОПОЛНЕНИЕ ЦЕЛИ (topup|goal_id|amount) ---
                 elif action == 'topup':
-                    goal_id, amount = int(parts[1]), float(parts[2])
-                    with sqlite3.connect(DB_PATH) as conn:
-                        conn.execute("UPDATE goals SET current_amount = current_amount + ? WHERE id = ? AND user_id = ?",
-                                     (amount, goal_id, message.from_user.id))
-                        conn.commit()
+                    goal_id, amount = int(parts[1]), _action_amount(parts[2])
+                    saved = await db.write(_apply_action, message.from_user.id, "top_up_goal", (goal_id, amount), key)
+                    if saved:
+                        miniapp_cache.invalidate(message.from_user.id)
                     
                     try:
                         await message.delete()
                     except:
                         pass
+                    if not saved:
+                        return
                     
                     await message.answer(f"💰 **Копилка пополнена на {amount:,.0f} р.!**", parse_mode="Markdown")
-                    await update_user_menu_button(message.from_user.id)
+                    menu_refresher.schedule(message.from_user.id)
                     return
                     
         except Exception as e:
@@ -409,10 +2753,8 @@ async def start_cmd(message: types.Message):
             pass
 
     # Генерируем URL с данными для MiniApp
-    payload = await get_miniapp_data(message.from_user.id, limit=10)
-    json_str = json.dumps(payload)
-    b64_data = base64.urlsafe_b64encode(json_str.encode()).decode()
-    webapp_url = f"{WEB_APP_URL}?data={b64_data}"
+    payload = await get_miniapp_data(message.from_user.id)
+    webapp_url = miniapp_url(payload)
     
     kb = [
         [KeyboardButton(text="📱 Мои Деньги", web_app=WebAppInfo(url=webapp_url))],
@@ -430,7 +2772,8 @@ async def start_cmd(message: types.Message):
         f"Или пиши мне текстом:\n"
         f"🔹 `1000 Еда` — записать расход\n"
         f"🔹 `+5000 ЗП` — записать доход\n"
-        f"🔹 `!1000 Отпуск` — отложить в копилку\n\n"
+        f"🔹 `!1000 Отпуск` — отложить в копилку\n"
+        f"🔹 `/find кофе` — найти записи по описанию\n\n"
         f"Удачного планирования! 🚀",
         reply_markup=ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True),
         parse_mode="Markdown"
@@ -443,68 +2786,147 @@ class AdminStates(StatesGroup):
     waiting_for_admin_id = State()
     waiting_for_limit_value = State()
 
-@dp.message(Command("admin"))
-async def admin_cmd(message: types.Message):
-    if not is_admin(message.from_user.id):
-        await message.answer("🚫 У вас нет доступа к админ-панели.")
-        return
-    
-    # Статистика
-    with sqlite3.connect(DB_PATH) as conn:
-        users_count = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
-        tx_count = conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
-        blocked_count = conn.execute("SELECT COUNT(*) FROM user_limits WHERE is_blocked = 1").fetchone()[0]
+ADMIN_COUNTERS_QUERY = hot_query("_admin_stats: счётчики",
+                                 "SELECT name, value FROM global_counters WHERE name IN (?, ?, ?)",
+                                 ("users", "transactions", "blocked"))
+
+
+def _admin_stats(conn):
+    counters = dict(conn.execute(ADMIN_COUNTERS_QUERY, ("users", "transactions", "blocked")).fetchall())
+    return counters.get("users", 0), counters.get("transactions", 0), counters.get("blocked", 0)
+
+
+async def _admin_dashboard():
+    users_count, tx_count, blocked_count = await db.read(_admin_stats)
     
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="👥 Пользователи", callback_data="adm_users")],
         [InlineKeyboardButton(text="🚫 Блокировки", callback_data="adm_blocks")],
         [InlineKeyboardButton(text="⚙️ Ограничения", callback_data="adm_limits")],
         [InlineKeyboardButton(text="👑 Администраторы", callback_data="adm_admins")],
+        [InlineKeyboardButton(text="🔄 Пересчитать статистику", callback_data="adm_reconcile")],
     ])
-    
-    await message.answer(
+    text = (
         f"👑 **Админ-панель FinGoal**\n\n"
         f"📊 Статистика:\n"
         f"• Пользователей: {users_count}\n"
         f"• Транзакций: {tx_count}\n"
-        f"• Заблокировано: {blocked_count}\n",
-        reply_markup=kb,
-        parse_mode="Markdown"
+        f"• Заблокировано: {blocked_count}\n"
     )
+    return text, kb
+
+
+def _count_drift(conn):
+    """Расхождение счётчиков с COUNT(*) в одном снимке базы: имя -> (счётчик, факт)"""
+    conn.execute("BEGIN")
+    try:
+        counters = dict(conn.execute("SELECT name, value FROM global_counters").fetchall())
+        return {name: (counters.get(name, 0), conn.execute(sql).fetchone()[0])
+                for name, sql in GLOBAL_COUNTERS.items()}
+    finally:
+        conn.rollback()
+
+
+def _apply_drift(conn, drift):
+    # Поправка, а не присваивание: записи после снимка уже учтены триггерами
+    for name, (counter, actual) in drift.items():
+        conn.execute("INSERT INTO global_counters (name, value) VALUES (?, ?) "
+                     "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value", (name, actual - counter))
+
+
+async def reconcile_counters():
+    """Пересчитать глобальные счётчики; {имя: (было, стало)} для тех, что разошлись"""
+    drift = {name: values for name, values in (await db.read(_count_drift)).items() if values[0] != values[1]}
+    if drift:
+        await db.write(_apply_drift, drift)
+    return drift
+
+
+@dp.message(Command("admin"))
+async def admin_cmd(message: types.Message):
+    if not await is_admin(message.from_user.id):
+        await message.answer("🚫 У вас нет доступа к админ-панели.")
+        return
+    
+    # Статистика
+    text, kb = await _admin_dashboard()
+    await message.answer(text, reply_markup=kb, parse_mode="Markdown")
 
 
 # --- Список пользователей с пагинацией ---
+_USERS_PAGE_SQL = """
+    SELECT u.user_id, u.username, u.first_name, u.last_active,
+           COALESCE(ul.is_blocked, 0) as is_blocked
+    FROM users u
+    LEFT JOIN user_limits ul ON u.user_id = ul.user_id
+    WHERE (u.last_active, u.user_id) {op} (?, ?)
+    ORDER BY u.last_active {order}, u.user_id {order}
+    LIMIT ?
+"""
+USERS_PAGE_OLDER_QUERY = hot_query("admin_users_list: страница старше курсора",
+                                   _USERS_PAGE_SQL.format(op="<", order="DESC"), ("2024-01-01 00:00:00", 1, 10))
+USERS_PAGE_NEWER_QUERY = hot_query("admin_users_list: страница новее курсора",
+                                   _USERS_PAGE_SQL.format(op=">", order="ASC"), ("2024-01-01 00:00:00", 1, 10))
+USERS_HAS_NEWER_QUERY = hot_query("admin_users_list: есть ли новее",
+                                  "SELECT 1 FROM users WHERE (last_active, user_id) > (?, ?) LIMIT 1",
+                                  ("2024-01-01 00:00:00", 1))
+USERS_HAS_OLDER_QUERY = hot_query("admin_users_list: есть ли старше",
+                                  "SELECT 1 FROM users WHERE (last_active, user_id) < (?, ?) LIMIT 1",
+                                  ("2024-01-01 00:00:00", 1))
+USERS_COUNT_QUERY = hot_query("admin_users_list: всего пользователей",
+                              "SELECT value FROM global_counters WHERE name = ?", ("users",))
+
+
+def _load_users_page(conn, cursor, per_page):
+    """
+    Страница пользователей по last_active, курсор как у _load_tx_page:
+    '' - самые активные, 'o<last_active>|<id>' - после этой строки, 'n<last_active>|<id>' - перед ней.
+    Возвращает (строки, есть ли новее, есть ли старше, всего пользователей).
+    """
+    rows = []
+    if cursor.startswith("n"):
+        last_active, _, uid = cursor[1:].rpartition("|")
+        rows = conn.execute(USERS_PAGE_NEWER_QUERY, (last_active, int(uid), per_page)).fetchall()[::-1]
+    # Назад упёрлись в начало (или курсора нет) - показываем первую страницу
+    if not cursor.startswith("n") or len(rows) < per_page:
+        last_active, uid = ("9999", 2 ** 63 - 1)
+        if cursor.startswith("o"):
+            last_active, _, uid = cursor[1:].rpartition("|")
+        rows = conn.execute(USERS_PAGE_OLDER_QUERY, (last_active, int(uid), per_page)).fetchall()
+
+    has_newer = has_older = False
+    if rows:
+        has_newer = conn.execute(USERS_HAS_NEWER_QUERY, (rows[0][3], rows[0][0])).fetchone() is not None
+        has_older = conn.execute(USERS_HAS_OLDER_QUERY, (rows[-1][3], rows[-1][0])).fetchone() is not None
+    total = conn.execute(USERS_COUNT_QUERY, ("users",)).fetchone()
+    return rows, has_newer, has_older, (total[0] if total else 0)
+
+
 @dp.callback_query(F.data.startswith("adm_users"))
 async def admin_users_list(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         await callback.answer("Нет доступа", show_alert=True)
         return
     
-    # Парсим страницу: adm_users или adm_users_page_2
-    parts = callback.data.split("_")
+    # Парсим страницу: adm_users или adm_users_page_<page>_<cursor>
+    parts = callback.data.split("_", 4)
     page = 1
+    cursor = ""
     if len(parts) >= 4 and parts[2] == "page":
         page = int(parts[3])
+        cursor = parts[4] if len(parts) > 4 else ""
     
     per_page = 10
-    offset = (page - 1) * per_page
-    
-    with sqlite3.connect(DB_PATH) as conn:
-        total_users = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
-        users = conn.execute("""
-            SELECT u.user_id, u.username, u.first_name, u.last_active,
-                   COALESCE(ul.is_blocked, 0) as is_blocked
-            FROM users u
-            LEFT JOIN user_limits ul ON u.user_id = ul.user_id
-            ORDER BY u.last_active DESC
-            LIMIT ? OFFSET ?
-        """, (per_page, offset)).fetchall()
+    
+    users, has_newer, has_older, total_users = await db.read(_load_users_page, cursor, per_page)
+    if not has_newer:
+        page = 1
     
     if not users and page == 1:
         await callback.message.edit_text("Пользователей пока нет.")
         return
     
-    total_pages = (total_users + per_page - 1) // per_page
+    total_pages = max(page, (total_users + per_page - 1) // per_page)
     
     buttons = []
     for uid, uname, fname, last_active, blocked in users:
@@ -517,11 +2939,13 @@ async def admin_users_list(callback: types.CallbackQuery):
     
     # Навигация
     nav_row = []
-    if page > 1:
-        nav_row.append(InlineKeyboardButton(text="⬅️", callback_data=f"adm_users_page_{page-1}"))
+    if has_newer:
+        first = users[0]
+        nav_row.append(InlineKeyboardButton(text="⬅️", callback_data=f"adm_users_page_{page-1}_n{first[3]}|{first[0]}"))
     nav_row.append(InlineKeyboardButton(text=f"📄 {page}/{total_pages}", callback_data="ignore"))
-    if page < total_pages:
-        nav_row.append(InlineKeyboardButton(text="➡️", callback_data=f"adm_users_page_{page+1}"))
+    if has_older:
+        last = users[-1]
+        nav_row.append(InlineKeyboardButton(text="➡️", callback_data=f"adm_users_page_{page+1}_o{last[3]}|{last[0]}"))
     buttons.append(nav_row)
     
     # Действия
@@ -541,7 +2965,7 @@ async def admin_users_list(callback: types.CallbackQuery):
 # --- Поиск пользователя по username ---
 @dp.callback_query(F.data == "adm_search_user")
 async def admin_search_prompt(callback: types.CallbackQuery, state: FSMContext):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         return
     
     await state.set_state("admin_search_user")
@@ -558,21 +2982,12 @@ async def admin_search_prompt(callback: types.CallbackQuery, state: FSMContext):
 
 @dp.message(StateFilter("admin_search_user"))
 async def admin_search_handler(message: types.Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
+    if not await is_admin(message.from_user.id):
         return
     
     query = message.text.strip().lower().replace("@", "")
     
-    with sqlite3.connect(DB_PATH) as conn:
-        users = conn.execute("""
-            SELECT u.user_id, u.username, u.first_name,
-                   COALESCE(ul.is_blocked, 0) as is_blocked
-            FROM users u
-            LEFT JOIN user_limits ul ON u.user_id = ul.user_id
-            WHERE LOWER(u.username) LIKE ? OR LOWER(u.first_name) LIKE ?
-            ORDER BY u.last_active DESC
-            LIMIT 20
-        """, (f"%{query}%", f"%{query}%")).fetchall()
+    users = await db.read(search_users, query)
     
     await state.clear()
     
@@ -605,40 +3020,37 @@ async def admin_search_handler(message: types.Message, state: FSMContext):
 # --- Детали пользователя ---
 @dp.callback_query(F.data.startswith("adm_user_"))
 async def admin_user_details(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         await callback.answer("Нет доступа", show_alert=True)
         return
     
     uid = int(callback.data.split("_")[2])
     
-    with sqlite3.connect(DB_PATH) as conn:
+    def _load(conn):
         user = conn.execute("SELECT username, first_name, registered_at, last_active FROM users WHERE user_id = ?", (uid,)).fetchone()
         if not user:
-            await callback.answer("Пользователь не найден")
-            return
+            return None, None, None, None
         
         # Статистика
-        stats = conn.execute("""
-            SELECT type, SUM(amount), COUNT(*) 
-            FROM transactions WHERE user_id = ? 
-            GROUP BY type
-        """, (uid,)).fetchall()
+        stats = conn.execute("SELECT income, expense, tx_count FROM user_balance WHERE user_id = ?",
+                             (uid,)).fetchone()
         
         goals_count = conn.execute("SELECT COUNT(*) FROM goals WHERE user_id = ?", (uid,)).fetchone()[0]
         
         limits = conn.execute("SELECT is_blocked, disabled_features FROM user_limits WHERE user_id = ?", (uid,)).fetchone()
+        return user, stats, goals_count, limits
+    
+    user, stats, goals_count, limits = await db.read(_load)
+    if not user:
+        await callback.answer("Пользователь не найден")
+        return
     
     uname, fname, reg_at, last_act = user
     is_blocked = limits[0] if limits else 0
     disabled = limits[1] if limits else ""
     
-    income = expense = tx_count = 0
-    for row in stats:
-        if row[0] == 'income':
-            income = row[1]
-        elif row[0] == 'expense':
-            expense = row[1]
-        tx_count += row[2]
+    income, expense, tx_count = stats if stats else (0, 0, 0)
+    income, expense = from_minor(income), from_minor(expense)
     
     balance = income - expense
     
@@ -676,17 +3088,16 @@ async def admin_user_details(callback: types.CallbackQuery):
 # --- Блокировка/Разблокировка ---
 @dp.callback_query(F.data.startswith("adm_block_"))
 async def admin_block_user(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         return
     
     uid = int(callback.data.split("_")[2])
     
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute("""
-            INSERT INTO user_limits (user_id, is_blocked) VALUES (?, 1)
-            ON CONFLICT(user_id) DO UPDATE SET is_blocked = 1
-        """, (uid,))
-        conn.commit()
+    await db.execute("""
+        INSERT INTO user_limits (user_id, is_blocked) VALUES (?, 1)
+        ON CONFLICT(user_id) DO UPDATE SET is_blocked = 1
+    """, (uid,))
+    permissions.set_blocked(uid, True)
     
     await callback.answer("✅ Пользователь заблокирован", show_alert=True)
     # Обновляем экран
@@ -696,14 +3107,13 @@ async def admin_block_user(callback: types.CallbackQuery):
 
 @dp.callback_query(F.data.startswith("adm_unblock_"))
 async def admin_unblock_user(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         return
     
     uid = int(callback.data.split("_")[2])
     
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute("UPDATE user_limits SET is_blocked = 0 WHERE user_id = ?", (uid,))
-        conn.commit()
+    await db.execute("UPDATE user_limits SET is_blocked = 0 WHERE user_id = ?", (uid,))
+    permissions.set_blocked(uid, False)
     
     await callback.answer("✅ Пользователь разблокирован", show_alert=True)
     callback.data = f"adm_user_{uid}"
@@ -713,29 +3123,27 @@ async def admin_unblock_user(callback: types.CallbackQuery):
 # --- Просмотр транзакций пользователя ---
 @dp.callback_query(F.data.startswith("adm_tx_"))
 async def admin_view_user_transactions(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         return
     
-    # adm_tx_123456_1 (uid_page)
+    # adm_tx_123456_1 (uid_page), adm_tx_123456_2_o789 (uid_page_cursor)
     parts = callback.data.split("_")
     uid = int(parts[2])
     page = int(parts[3]) if len(parts) > 3 else 1
+    cursor = parts[4] if len(parts) > 4 else ""
     
     per_page = 15
-    offset = (page - 1) * per_page
     
-    with sqlite3.connect(DB_PATH) as conn:
+    def _load(conn):
         user = conn.execute("SELECT first_name, username FROM users WHERE user_id = ?", (uid,)).fetchone()
-        total_tx = conn.execute("SELECT COUNT(*) FROM transactions WHERE user_id = ?", (uid,)).fetchone()[0]
-        txs = conn.execute("""
-            SELECT amount, category, type, date, COALESCE(description, '')
-            FROM transactions WHERE user_id = ?
-            ORDER BY id DESC
-            LIMIT ? OFFSET ?
-        """, (uid, per_page, offset)).fetchall()
+        return (user, *_load_tx_page(conn, uid, cursor, per_page))
+    
+    user, txs, has_newer, has_older, total_tx = await db.read(_load)
+    if not has_newer:
+        page = 1
     
     user_name = user[0] or user[1] or str(uid) if user else str(uid)
-    total_pages = max(1, (total_tx + per_page - 1) // per_page)
+    total_pages = max(page, (total_tx + per_page - 1) // per_page)
     
     if not txs:
         msg = f"📋 **Транзакции {user_name}**\n\nНет транзакций."
@@ -743,22 +3151,22 @@ async def admin_view_user_transactions(callback: types.CallbackQuery):
         msg = f"📋 **Транзакции {user_name}**\n"
         msg += f"Страница {page}/{total_pages} (всего: {total_tx})\n\n"
         
-        for amount, cat, t_type, date, desc in txs:
+        for _, amount, cat, t_type, ts, desc in txs:
             icon = "📉" if t_type == "expense" else "📈"
             sign = "-" if t_type == "expense" else "+"
-            date_short = date[5:10] if date else ""
-            msg += f"{icon} {sign}{amount:,.0f} | {cat[:12]}"
+            date_short = format_ts(ts, "%m-%d")
+            msg += f"{icon} {sign}{from_minor(amount):,.0f} | {cat[:12]}"
             if desc:
                 msg += f" | {desc[:15]}"
             msg += f" | {date_short}\n"
     
     buttons = []
     nav_row = []
-    if page > 1:
-        nav_row.append(InlineKeyboardButton(text="⬅️", callback_data=f"adm_tx_{uid}_{page-1}"))
+    if has_newer:
+        nav_row.append(InlineKeyboardButton(text="⬅️", callback_data=f"adm_tx_{uid}_{page-1}_n{txs[0][0]}"))
     nav_row.append(InlineKeyboardButton(text=f"📄 {page}/{total_pages}", callback_data="ignore"))
-    if page < total_pages:
-        nav_row.append(InlineKeyboardButton(text="➡️", callback_data=f"adm_tx_{uid}_{page+1}"))
+    if has_older:
+        nav_row.append(InlineKeyboardButton(text="➡️", callback_data=f"adm_tx_{uid}_{page+1}_o{txs[-1][0]}"))
     if nav_row:
         buttons.append(nav_row)
     
@@ -771,13 +3179,12 @@ async def admin_view_user_transactions(callback: types.CallbackQuery):
 # --- Управление ограничениями пользователя ---
 @dp.callback_query(F.data.startswith("adm_userlim_"))
 async def admin_user_limits(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         return
     
     uid = int(callback.data.split("_")[2])
     
-    with sqlite3.connect(DB_PATH) as conn:
-        limits = conn.execute("SELECT disabled_features FROM user_limits WHERE user_id = ?", (uid,)).fetchone()
+    limits = await db.fetchone("SELECT disabled_features FROM user_limits WHERE user_id = ?", (uid,))
     
     disabled = limits[0].split(',') if limits and limits[0] else []
     
@@ -809,7 +3216,7 @@ async def admin_user_limits(callback: types.CallbackQuery):
 
 @dp.callback_query(F.data.startswith("adm_feat_"))
 async def admin_toggle_feature(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         return
     
     parts = callback.data.split("_")
@@ -817,7 +3224,7 @@ async def admin_toggle_feature(callback: types.CallbackQuery):
     feature = parts[3]
     uid = int(parts[4])
     
-    with sqlite3.connect(DB_PATH) as conn:
+    def _toggle(conn):
         limits = conn.execute("SELECT disabled_features FROM user_limits WHERE user_id = ?", (uid,)).fetchone()
         current = limits[0].split(',') if limits and limits[0] else []
         current = [f for f in current if f]  # Remove empty strings
@@ -833,7 +3240,9 @@ async def admin_toggle_feature(callback: types.CallbackQuery):
             INSERT INTO user_limits (user_id, disabled_features) VALUES (?, ?)
             ON CONFLICT(user_id) DO UPDATE SET disabled_features = ?
         """, (uid, new_disabled, new_disabled))
-        conn.commit()
+        return current
+    
+    permissions.set_disabled(uid, await db.write(_toggle))
     
     await callback.answer("✅ Сохранено")
     callback.data = f"adm_userlim_{uid}"
@@ -843,16 +3252,15 @@ async def admin_toggle_feature(callback: types.CallbackQuery):
 # --- Список блокировок ---
 @dp.callback_query(F.data == "adm_blocks")
 async def admin_blocks_list(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         return
     
-    with sqlite3.connect(DB_PATH) as conn:
-        blocked = conn.execute("""
-            SELECT u.user_id, u.first_name, u.username
-            FROM user_limits ul
-            JOIN users u ON ul.user_id = u.user_id
-            WHERE ul.is_blocked = 1
-        """).fetchall()
+    blocked = await db.fetchall("""
+        SELECT u.user_id, u.first_name, u.username
+        FROM user_limits ul
+        JOIN users u ON ul.user_id = u.user_id
+        WHERE ul.is_blocked = 1
+    """)
     
     if not blocked:
         buttons = [[InlineKeyboardButton(text="🔙 Назад", callback_data="adm_back")]]
@@ -878,7 +3286,7 @@ async def admin_blocks_list(callback: types.CallbackQuery):
 # --- Управление лимитами (общее) ---
 @dp.callback_query(F.data == "adm_limits")
 async def admin_limits_menu(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         return
     
     buttons = [
@@ -897,15 +3305,14 @@ async def admin_limits_menu(callback: types.CallbackQuery):
 # --- Управление администраторами ---
 @dp.callback_query(F.data == "adm_admins")
 async def admin_admins_list(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         return
     
-    with sqlite3.connect(DB_PATH) as conn:
-        admins = conn.execute("""
-            SELECT a.user_id, u.first_name, u.username, a.added_at
-            FROM admins a
-            LEFT JOIN users u ON a.user_id = u.user_id
-        """).fetchall()
+    admins = await db.fetchall("""
+        SELECT a.user_id, u.first_name, u.username, a.added_at
+        FROM admins a
+        LEFT JOIN users u ON a.user_id = u.user_id
+    """)
     
     msg = "👑 **Администраторы:**\n\n"
     buttons = []
@@ -927,7 +3334,7 @@ async def admin_admins_list(callback: types.CallbackQuery):
 
 @dp.callback_query(F.data == "adm_addadmin")
 async def admin_add_start(callback: types.CallbackQuery, state: FSMContext):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         return
     
     await callback.message.edit_text(
@@ -948,11 +3355,10 @@ async def admin_add_finish(message: types.Message, state: FSMContext):
         await message.answer("❌ Введите корректный ID (число)")
         return
     
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute("""
-            INSERT OR IGNORE INTO admins (user_id, added_by, added_at) VALUES (?, ?, ?)
-        """, (new_admin_id, message.from_user.id, datetime.now().strftime("%Y-%m-%d")))
-        conn.commit()
+    await db.execute("""
+        INSERT OR IGNORE INTO admins (user_id, added_by, added_at) VALUES (?, ?, ?)
+    """, (new_admin_id, message.from_user.id, datetime.now().strftime("%Y-%m-%d")))
+    permissions.set_admin(new_admin_id, True)
     
     await message.answer(f"✅ Администратор {new_admin_id} добавлен!")
     await state.clear()
@@ -960,7 +3366,7 @@ async def admin_add_finish(message: types.Message, state: FSMContext):
 
 @dp.callback_query(F.data.startswith("adm_rmadmin_"))
 async def admin_remove(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         return
     
     uid = int(callback.data.split("_")[2])
@@ -969,9 +3375,8 @@ async def admin_remove(callback: types.CallbackQuery):
         await callback.answer("Нельзя удалить главного админа!", show_alert=True)
         return
     
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute("DELETE FROM admins WHERE user_id = ?", (uid,))
-        conn.commit()
+    await db.execute("DELETE FROM admins WHERE user_id = ?", (uid,))
+    permissions.set_admin(uid, False)
     
     await callback.answer("✅ Админ удалён")
     await admin_admins_list(callback)
@@ -980,41 +3385,127 @@ async def admin_remove(callback: types.CallbackQuery):
 # --- Кнопка Назад ---
 @dp.callback_query(F.data == "adm_back")
 async def admin_back(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+    if not await is_admin(callback.from_user.id):
         return
     
-    with sqlite3.connect(DB_PATH) as conn:
-        users_count = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
-        tx_count = conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
-        blocked_count = conn.execute("SELECT COUNT(*) FROM user_limits WHERE is_blocked = 1").fetchone()[0]
-    
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="👥 Пользователи", callback_data="adm_users")],
-        [InlineKeyboardButton(text="🚫 Блокировки", callback_data="adm_blocks")],
-        [InlineKeyboardButton(text="⚙️ Ограничения", callback_data="adm_limits")],
-        [InlineKeyboardButton(text="👑 Администраторы", callback_data="adm_admins")],
-    ])
+    text, kb = await _admin_dashboard()
+    await callback.message.edit_text(text, reply_markup=kb, parse_mode="Markdown")
+    await callback.answer()
+
+
+# --- Сверка счётчиков статистики ---
+
+
+async def _reconcile_and_report(chat_id):
+    try:
+        drift = await reconcile_counters()
+    except Exception as e:
+        logging.error(f"Counters reconcile failed: {e}")
+        await bot.send_message(chat_id, f"❌ Ошибка пересчёта: {e}")
+        return
+    if not drift:
+        await bot.send_message(chat_id, "✅ Счётчики сходятся, расхождений нет.")
+        return
+    lines = [f"• {name}: было {counter}, стало {actual} ({actual - counter:+d})" for name, (counter, actual) in drift.items()]
+    logging.warning(f"Counters drift fixed: {drift}")
+    await bot.send_message(chat_id, "⚠️ Счётчики исправлены:\n" + "\n".join(lines))
+
+
+@dp.callback_query(F.data == "adm_reconcile")
+async def admin_reconcile(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        return
+    # COUNT(*) по всей таблице - считаем в фоне, результат придёт отдельным сообщением
+    task = asyncio.create_task(_reconcile_and_report(callback.message.chat.id))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    await callback.answer("🔄 Пересчёт запущен")
+
+
+# --- Производительность ---
+@dp.message(Command("perf"))
+async def admin_perf(message: types.Message):
+    if not await is_admin(message.from_user.id):
+        return
     
-    await callback.message.edit_text(
-        f"👑 **Админ-панель FinGoal**\n\n"
-        f"📊 Статистика:\n"
-        f"• Пользователей: {users_count}\n"
-        f"• Транзакций: {tx_count}\n"
-        f"• Заблокировано: {blocked_count}\n",
-        reply_markup=kb,
+    lag = loop_lag.stats()
+    await message.answer(
+        f"⏱ **Производительность**"
+        f"{f' (воркер {WORKER_ID + 1} из {WORKERS})' if WORKERS > 1 else ''}\n\n"
+        f"Задержка event loop:\n"
+        f"• p50: {lag['p50']:.1f} мс\n"
+        f"• p99: {lag['p99']:.1f} мс\n"
+        f"• max: {lag['max']:.1f} мс\n\n"
+        f"Запись в БД:\n"
+        f"• коммитов: {db.commits}, записей: {db.writes}\n"
+        f"• в среднем на коммит: {db.writes / max(db.commits, 1):.1f}\n\n"
+        f"Кэш данных MiniApp:\n"
+        f"• попаданий: {miniapp_cache.hits}, промахов: {miniapp_cache.misses}\n"
+        f"• пользователей в кэше: {len(miniapp_cache)}\n"
+        + (f"• сбросов соседям: {peers.sent}, от соседей: {peers.received}, потеряно: {peers.dropped}\n"
+           if WORKERS > 1 else "")
+        + f"\n"
+        f"Обновление Menu Button:\n"
+        f"• выполнено: {menu_refresher.issued}, склеено: {menu_refresher.coalesced}\n\n"
+        f"Активность пользователей (last_active):\n"
+        f"• пачек: {activity.flushes}, строк: {activity.flushed}\n\n"
+        f"Очередь отправки в Telegram:\n"
+        f"• отправлено: {send_queue.sent}, ошибок: {send_queue.failed}, повторов после 429: {send_queue.retried}\n"
+        f"• отклонено (очередь полна): {send_queue.rejected}, склеено: {send_queue.coalesced}\n"
+        + "".join(f"• {name}: в очереди {st['depth']} (макс. {st['max_depth']}), "
+                  f"задержка p50 {st['p50']:.0f} мс, p95 {st['p95']:.0f} мс\n"
+                  for name, st in send_queue.stats().items())
+        + f"\nЛоги:\n"
+        f"• в очереди: {log_handler.queue.qsize()}, отброшено при переполнении: {log_handler.dropped}\n"
+        f"• прорежено: {log_sampler.sampled_out}, по лимиту строки: {log_sampler.rate_limited}\n",
         parse_mode="Markdown"
     )
-    await callback.answer()
+
+
+async def handle_metrics(request):
+    """GET /metrics: обработчики и то же, что /perf, в текстовом формате Prometheus"""
+    lag = loop_lag.stats()
+    queue_stats = send_queue.stats()
+    runtime = [
+        # Квантили - за последнюю минуту, _sum/_count - с запуска
+        ("fingoal_event_loop_lag_seconds", "summary", "Event loop lag (quantiles over the last minute).",
+         [(_prom_labels(quantile="0.5"), lag["p50"] / 1000), (_prom_labels(quantile="0.99"), lag["p99"] / 1000),
+          ("", loop_lag.total, "_sum"), ("", loop_lag.count, "_count")]),
+        ("fingoal_db_commits_total", "counter", "Writer commits.", [("", db.commits)]),
+        ("fingoal_db_writes_total", "counter", "Writes committed by the writer thread.", [("", db.writes)]),
+        ("fingoal_miniapp_cache_hits_total", "counter", "MiniApp payload cache hits.", [("", miniapp_cache.hits)]),
+        ("fingoal_miniapp_cache_misses_total", "counter", "MiniApp payload cache misses.", [("", miniapp_cache.misses)]),
+        ("fingoal_send_queue_depth", "gauge", "Outbound Telegram requests waiting in the send queue.",
+         [(_prom_labels(lane=name), st["depth"]) for name, st in queue_stats.items()]),
+        ("fingoal_send_requests_total", "counter", "Outbound Telegram requests by result.",
+         [(_prom_labels(result="sent"), send_queue.sent), (_prom_labels(result="failed"), send_queue.failed),
+          (_prom_labels(result="rejected"), send_queue.rejected)]),
+        ("fingoal_send_retries_total", "counter", "Outbound requests retried after 429.", [("", send_queue.retried)]),
+        ("fingoal_log_dropped_total", "counter", "Log records dropped because the log queue was full.",
+         [("", log_handler.dropped)]),
+    ]
+    lines = [handler_metrics.render()]
+    for name, kind, help_text, samples in runtime:
+        lines.append(f"# HELP {name} {help_text}\n# TYPE {name} {kind}\n")
+        for labels, value, *suffix in samples:
+            sample = name + (suffix[0] if suffix else "")
+            lines.append(f"{sample}{{{labels}}} {value}\n" if labels else f"{sample} {value}\n")
+    return web.Response(text="".join(lines), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8",
+                                                      "Cache-Control": "no-store"})
+
+
+BALANCE_QUERY = hot_query("get_balance: баланс",
+                          "SELECT income, expense FROM user_balance WHERE user_id = ?", (1,))
+HISTORY_QUERY = hot_query("get_history: последние транзакции",
+                          "SELECT ts, amount_minor, category, type FROM transactions WHERE user_id = ? ORDER BY id DESC LIMIT 5",
+                          (1,))
 
 
 @dp.message(F.text.in_({"💰 Баланс", "📊 Мой Баланс", "Баланс"}))
 async def get_balance(message: types.Message):
-    with sqlite3.connect(DB_PATH) as conn:
-        rows = conn.execute("SELECT amount, type FROM transactions WHERE user_id = ?",
-                            (message.from_user.id,)).fetchall()
+    row = await db.fetchone(BALANCE_QUERY, (message.from_user.id,))
 
-    inc = sum(r[0] for r in rows if r[1] == 'income')
-    exp = sum(r[0] for r in rows if r[1] == 'expense')
+    inc, exp = (from_minor(row[0]), from_minor(row[1])) if row else (0, 0)
 
     await message.answer(
         f"📊 **Ваш баланс:**\n\n🟢 Доходы: {inc:,.0f} р.\n🔴 Расходы: {exp:,.0f} р.\n\n💰 **Итого: {inc - exp:,.0f} р.**",
@@ -1023,10 +3514,7 @@ async def get_balance(message: types.Message):
 
 @dp.message(F.text == "📋 История")
 async def get_history(message: types.Message):
-    with sqlite3.connect(DB_PATH) as conn:
-        rows = conn.execute(
-            "SELECT date, amount, category, type FROM transactions WHERE user_id = ? ORDER BY id DESC LIMIT 5",
-            (message.from_user.id,)).fetchall()
+    rows = await db.fetchall(HISTORY_QUERY, (message.from_user.id,))
 
     if not rows:
         return await message.answer("История пуста.")
@@ -1034,7 +3522,7 @@ async def get_history(message: types.Message):
     text = "📂 **Последние 5 записей:**\n\n"
     for r in rows:
         sign = "+" if r[3] == 'income' else "-"
-        text += f"`{r[0][:10]}` | **{sign}{r[1]:.0f} р.** ({r[2]})\n"
+        text += f"`{format_ts(r[0], '%Y-%m-%d')}` | **{sign}{from_minor(r[1]):.0f} р.** ({r[2]})\n"
     await message.answer(text, parse_mode="Markdown")
 
 
@@ -1046,21 +3534,17 @@ async def user_transactions_menu(message: types.Message):
     await show_user_transactions(message.from_user.id, 1, message=message)
 
 
-async def show_user_transactions(user_id: int, page: int, message: types.Message = None, callback: types.CallbackQuery = None):
+async def show_user_transactions(user_id: int, page: int, message: types.Message = None, callback: types.CallbackQuery = None,
+                                 cursor: str = ""):
     """Универсальная функция показа транзакций"""
     per_page = 8
-    offset = (page - 1) * per_page
     
-    with sqlite3.connect(DB_PATH) as conn:
-        total_tx = conn.execute("SELECT COUNT(*) FROM transactions WHERE user_id = ?", (user_id,)).fetchone()[0]
-        txs = conn.execute("""
-            SELECT id, amount, category, type, date, COALESCE(description, '')
-            FROM transactions WHERE user_id = ?
-            ORDER BY id DESC
-            LIMIT ? OFFSET ?
-        """, (user_id, per_page, offset)).fetchall()
+    txs, has_newer, has_older, total_tx = await db.read(_load_tx_page, user_id, cursor, per_page)
+    if not has_newer:
+        page = 1
     
-    total_pages = max(1, (total_tx + per_page - 1) // per_page)
+    total_pages = max(page, (total_tx + per_page - 1) // per_page)
+    here = _page_cursor(txs, has_newer)
     
     if not txs and page == 1:
         text = "📋 **Ваши транзакции**\n\nПока пусто. Добавьте первую запись!"
@@ -1069,11 +3553,11 @@ async def show_user_transactions(user_id: int, page: int, message: types.Message
         text = f"📋 **Ваши транзакции** ({total_tx})\n"
         text += f"Страница {page}/{total_pages}\n\n"
         
-        for tx_id, amount, cat, t_type, date, desc in txs:
+        for tx_id, amount, cat, t_type, ts, desc in txs:
             icon = "📉" if t_type == "expense" else "📈"
             sign = "-" if t_type == "expense" else "+"
-            date_short = date[5:10] if date else ""
-            text += f"{icon} {sign}{amount:,.0f} | {cat[:12]}"
+            date_short = format_ts(ts, "%m-%d")
+            text += f"{icon} {sign}{from_minor(amount):,.0f} | {cat[:12]}"
             if desc:
                 text += f" | {desc[:10]}"
             text += f" | {date_short}\n"
@@ -1082,21 +3566,21 @@ async def show_user_transactions(user_id: int, page: int, message: types.Message
         
         # Кнопки транзакций для удаления
         buttons = []
-        for tx_id, amount, cat, t_type, date, desc in txs:
+        for tx_id, amount, cat, t_type, ts, desc in txs:
             icon = "📉" if t_type == "expense" else "📈"
             sign = "-" if t_type == "expense" else "+"
             buttons.append([InlineKeyboardButton(
-                text=f"❌ {icon} {sign}{amount:,.0f} {cat[:10]}",
-                callback_data=f"user_del_tx_{tx_id}_{page}"
+                text=f"❌ {icon} {sign}{from_minor(amount):,.0f} {cat[:10]}",
+                callback_data=f"user_del_tx_{tx_id}_{page}_{here}"
             )])
         
         # Навигация
         nav_row = []
-        if page > 1:
-            nav_row.append(InlineKeyboardButton(text="⬅️", callback_data=f"user_tx_page_{page-1}"))
+        if has_newer:
+            nav_row.append(InlineKeyboardButton(text="⬅️", callback_data=f"user_tx_page_{page-1}_n{txs[0][0]}"))
         nav_row.append(InlineKeyboardButton(text=f"📄 {page}/{total_pages}", callback_data="ignore"))
-        if page < total_pages:
-            nav_row.append(InlineKeyboardButton(text="➡️", callback_data=f"user_tx_page_{page+1}"))
+        if has_older:
+            nav_row.append(InlineKeyboardButton(text="➡️", callback_data=f"user_tx_page_{page+1}_o{txs[-1][0]}"))
         if nav_row:
             buttons.append(nav_row)
         
@@ -1114,9 +3598,11 @@ async def show_user_transactions(user_id: int, page: int, message: types.Message
 
 @dp.callback_query(F.data.startswith("user_tx_page_"))
 async def user_tx_navigate(callback: types.CallbackQuery):
-    """Пагинация транзакций"""
-    page = int(callback.data.split("_")[3])
-    await show_user_transactions(callback.from_user.id, page, callback=callback)
+    """Пагинация транзакций: user_tx_page_<page>_<cursor>"""
+    parts = callback.data.split("_")
+    page = int(parts[3])
+    cursor = parts[4] if len(parts) > 4 else ""
+    await show_user_transactions(callback.from_user.id, page, callback=callback, cursor=cursor)
 
 
 @dp.callback_query(F.data.startswith("user_del_tx_"))
@@ -1125,32 +3611,32 @@ async def user_delete_tx_confirm(callback: types.CallbackQuery):
     parts = callback.data.split("_")
     tx_id = int(parts[3])
     page = int(parts[4]) if len(parts) > 4 else 1
+    cursor = parts[5] if len(parts) > 5 else ""
     
     # Получаем инфо о транзакции
-    with sqlite3.connect(DB_PATH) as conn:
-        tx = conn.execute("""
-            SELECT amount, category, type, date 
-            FROM transactions 
-            WHERE id = ? AND user_id = ?
-        """, (tx_id, callback.from_user.id)).fetchone()
+    tx = await db.fetchone("""
+        SELECT amount_minor, category, type, ts 
+        FROM transactions 
+        WHERE id = ? AND user_id = ?
+    """, (tx_id, callback.from_user.id))
     
     if not tx:
         await callback.answer("Транзакция не найдена", show_alert=True)
         return
     
-    amount, cat, t_type, date = tx
+    amount, cat, t_type, ts = tx
     icon = "📉" if t_type == "expense" else "📈"
     sign = "-" if t_type == "expense" else "+"
     
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Да, удалить", callback_data=f"user_confirm_del_{tx_id}_{page}")],
-        [InlineKeyboardButton(text="🔙 Отмена", callback_data=f"user_tx_page_{page}")]
+        [InlineKeyboardButton(text="✅ Да, удалить", callback_data=f"user_confirm_del_{tx_id}_{page}_{cursor}")],
+        [InlineKeyboardButton(text="🔙 Отмена", callback_data=f"user_tx_page_{page}_{cursor}")]
     ])
     
     await callback.message.edit_text(
         f"🗑 **Удалить транзакцию?**\n\n"
-        f"{icon} {sign}{amount:,.0f} р. ({cat})\n"
-        f"Дата: {date[:10] if date else 'N/A'}",
+        f"{icon} {sign}{from_minor(amount):,.0f} р. ({cat})\n"
+        f"Дата: {format_ts(ts, '%Y-%m-%d') or 'N/A'}",
         reply_markup=kb,
         parse_mode="Markdown"
     )
@@ -1163,24 +3649,45 @@ async def user_delete_tx_execute(callback: types.CallbackQuery):
     parts = callback.data.split("_")
     tx_id = int(parts[3])
     page = int(parts[4]) if len(parts) > 4 else 1
-    
-    with sqlite3.connect(DB_PATH) as conn:
-        # Проверяем, что транзакция принадлежит пользователю
-        tx = conn.execute("SELECT id FROM transactions WHERE id = ? AND user_id = ?", 
-                         (tx_id, callback.from_user.id)).fetchone()
-        if tx:
-            conn.execute("DELETE FROM transactions WHERE id = ?", (tx_id,))
-            conn.commit()
-            await callback.answer("✅ Транзакция удалена!", show_alert=True)
-        else:
-            await callback.answer("❌ Ошибка удаления", show_alert=True)
-            return
+    cursor = parts[5] if len(parts) > 5 else ""
+    
+    # Условие по user_id гарантирует, что транзакция принадлежит пользователю
+    if await db.write(_delete_transactions, callback.from_user.id, "id = ?", (tx_id,)):
+        # Это могла быть последняя запись категории
+        category_index.invalidate(callback.from_user.id)
+        miniapp_cache.invalidate(callback.from_user.id)
+        await callback.answer("✅ Транзакция удалена!", show_alert=True)
+    else:
+        await callback.answer("❌ Ошибка удаления", show_alert=True)
+        return
     
     # Обновляем Menu Button
-    await update_user_menu_button(callback.from_user.id)
+    menu_refresher.schedule(callback.from_user.id)
     
     # Возвращаемся к списку
-    await show_user_transactions(callback.from_user.id, page, callback=callback)
+    await show_user_transactions(callback.from_user.id, page, callback=callback, cursor=cursor)
+
+
+@dp.message(Command("find"))
+async def find_transactions(message: types.Message):
+    """Поиск по описаниям своих транзакций: /find кофе"""
+    args = message.text.split(maxsplit=1)
+    query = args[1].strip() if len(args) > 1 else ""
+    if len(query) < 3:
+        await message.answer("🔎 Напишите, что искать (от 3 символов):\n`/find кофе`", parse_mode="Markdown")
+        return
+    
+    txs = await db.read(search_transactions, message.from_user.id, query)
+    if not txs:
+        await message.answer(f"🔎 По запросу \"{query}\" ничего не найдено.")
+        return
+    
+    text = f"🔎 **Найдено по \"{query}\":**\n\n"
+    for tx_id, amount, cat, t_type, ts, desc in txs:
+        icon = "📉" if t_type == "expense" else "📈"
+        sign = "-" if t_type == "expense" else "+"
+        text += f"{icon} {sign}{from_minor(amount):,.0f} | {cat[:12]} | {desc[:25]} | {format_ts(ts, '%Y-%m-%d')}\n"
+    await message.answer(text, parse_mode="Markdown")
 
 
 # --- 4. ФУНКЦИОНАЛ ЦЕЛЕЙ ---
@@ -1204,24 +3711,23 @@ async def goal_create_start(callback: types.CallbackQuery, state: FSMContext):
 
 @dp.message(GoalStates.waiting_for_name)
 async def goal_name_entered(message: types.Message, state: FSMContext):
-    logging.info(f"DEBUG: Goal name entered: {message.text}")
+    logging.debug(f"Goal name entered: {message.text}")
     await state.update_data(name=message.text)
     await message.answer("Сколько нужно накопить? (Введите число, например: 100000)")
     await state.set_state(GoalStates.waiting_for_target)
-    logging.info("DEBUG: State set to waiting_for_target")
+    logging.debug("State set to waiting_for_target")
 
 @dp.message(GoalStates.waiting_for_target)
 async def goal_target_entered(message: types.Message, state: FSMContext):
-    logging.info(f"DEBUG: Goal target entered: {message.text}")
+    logging.debug(f"Goal target entered: {message.text}")
     try:
         target = float(message.text.replace(' ', ''))
         data = await state.get_data()
         name = data['name']
         
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.execute("INSERT INTO goals (user_id, name, target_amount, current_amount) VALUES (?, ?, ?, 0)",
+        await db.execute("INSERT INTO goals (user_id, name, target_amount, current_amount) VALUES (?, ?, ?, 0)",
                          (message.from_user.id, name, target))
-            conn.commit()
+        miniapp_cache.invalidate(message.from_user.id)
             
         await message.answer(f"✅ Цель **'{name}'** создана!\nЦель: {target:,.0f} р.\n\nПополняйте её командой: `!сумма {name}`", parse_mode="Markdown")
         await state.clear()
@@ -1239,9 +3745,8 @@ def generate_progress_bar(current, target, length=10):
 
 @dp.callback_query(F.data == "goal_list")
 async def goal_list_view(callback: types.CallbackQuery):
-    with sqlite3.connect(DB_PATH) as conn:
-        goals = conn.execute("SELECT name, target_amount, current_amount FROM goals WHERE user_id = ?", 
-                             (callback.from_user.id,)).fetchall()
+    goals = await db.fetchall("SELECT name, target_amount, current_amount FROM goals WHERE user_id = ?", 
+                              (callback.from_user.id,))
     
     if not goals:
         await callback.message.answer("У вас пока нет целей. Создайте первую!")
@@ -1260,9 +3765,8 @@ async def goal_list_view(callback: types.CallbackQuery):
 # -- Удаление цели --
 @dp.callback_query(F.data == "goal_delete")
 async def goal_delete_select(callback: types.CallbackQuery):
-    with sqlite3.connect(DB_PATH) as conn:
-        goals = conn.execute("SELECT id, name FROM goals WHERE user_id = ?", 
-                             (callback.from_user.id,)).fetchall()
+    goals = await db.fetchall("SELECT id, name FROM goals WHERE user_id = ?", 
+                              (callback.from_user.id,))
     
     if not goals:
         await callback.message.answer("Нечего удалять 🤷‍♂️")
@@ -1284,9 +3788,8 @@ async def goal_delete_select(callback: types.CallbackQuery):
 async def goal_delete_perform(callback: types.CallbackQuery):
     goal_id = callback.data.split("_")[2]
     
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute("DELETE FROM goals WHERE id = ?", (goal_id,))
-        conn.commit()
+    await db.execute("DELETE FROM goals WHERE id = ?", (goal_id,))
+    miniapp_cache.invalidate(callback.from_user.id)
     
     await callback.message.edit_text("✅ Цель удалена.")
     await callback.answer()
@@ -1317,42 +3820,55 @@ async def cat_create_start(callback: types.CallbackQuery, state: FSMContext):
 @dp.callback_query(F.data.startswith("type_"))
 async def cat_type_selected(callback: types.CallbackQuery, state: FSMContext):
     c_type = callback.data.split("_")[1]
-    logging.info(f"DEBUG: Category type selected: {c_type}")
+    logging.debug(f"Category type selected: {c_type}")
     await state.update_data(type=c_type)
     await callback.message.answer("Введите название категории (например: 'Такси'):")
     await state.set_state(CategoryStates.waiting_for_name)
-    logging.info("DEBUG: State set to CategoryStates.waiting_for_name")
+    logging.debug("State set to CategoryStates.waiting_for_name")
     await callback.answer()
 
 @dp.message(CategoryStates.waiting_for_name)
 async def cat_name_entered(message: types.Message, state: FSMContext):
-    logging.info(f"DEBUG: Category name entered: {message.text}")
+    logging.debug(f"Category name entered: {message.text}")
     name = message.text.strip()
     data = await state.get_data()
     c_type = data['type']
     
-    with sqlite3.connect(DB_PATH) as conn:
+    def _create(conn):
         # Проверка на дубликат
         exist = conn.execute("SELECT id FROM categories WHERE user_id = ? AND name = ? AND type = ?", 
                              (message.from_user.id, name, c_type)).fetchone()
         if exist:
-             await message.answer("Такая категория уже есть!")
-        else:
-            conn.execute("INSERT INTO categories (user_id, name, type, created_at) VALUES (?, ?, ?, ?)",
-                         (message.from_user.id, name, c_type, datetime.now().strftime("%Y-%m-%d")))
-            conn.commit()
-            await message.answer(f"✅ Категория **{name}** ({'Расход' if c_type == 'expense' else 'Доход'}) создана!", parse_mode="Markdown")
+            return False
+        conn.execute("INSERT INTO categories (user_id, name, type, created_at) VALUES (?, ?, ?, ?)",
+                     (message.from_user.id, name, c_type, datetime.now().strftime("%Y-%m-%d")))
+        return True
+    
+    if not await db.write(_create):
+        await message.answer("Такая категория уже есть!")
+    else:
+        category_index.add(message.from_user.id, c_type, name)
+        miniapp_cache.invalidate(message.from_user.id)
+        await message.answer(f"✅ Категория **{name}** ({'Расход' if c_type == 'expense' else 'Доход'}) создана!", parse_mode="Markdown")
     
     await state.clear()
 
 
 # -- Список со статистикой --
+CAT_TOTALS_QUERY = hot_query("cat_list_view: суммы за месяц", """
+    SELECT category, type, SUM(total)
+    FROM tx_rollup
+    WHERE user_id = ? AND month >= ?
+    GROUP BY category, type
+""", (1, 202401))
+
+
 @dp.callback_query(F.data == "cat_list")
 async def cat_list_view(callback: types.CallbackQuery):
     now = datetime.now()
-    month_start = now.strftime("%Y-%m-01") # грубо сработает для выборки по строке YYYY-MM-DD
+    month = month_number(now.year, now.month)
     
-    with sqlite3.connect(DB_PATH) as conn:
+    def _load(conn):
         # 1. Берем наши созданные категории
         cats = conn.execute("SELECT name, type FROM categories WHERE user_id = ?", 
                             (callback.from_user.id,)).fetchall()
@@ -1361,15 +3877,13 @@ async def cat_list_view(callback: types.CallbackQuery):
         # (Осторожно: тут могут быть категории, которых нет в списке categories, если запись была текстом.
         #  Но мы покажем всё, что есть в transactions, сгруппировав по имени)
         
-        stats = conn.execute("""
-            SELECT category, type, SUM(amount) 
-            FROM transactions 
-            WHERE user_id = ? AND date >= ? 
-            GROUP BY category, type
-        """, (callback.from_user.id, month_start)).fetchall()
+        stats = conn.execute(CAT_TOTALS_QUERY, (callback.from_user.id, month)).fetchall()
+        return cats, stats
+    
+    cats, stats = await db.read(_load)
         
     # Преобразуем stats в словарь для быстрого поиска
-    stats_dict = {(r[0].lower(), r[1]): r[2] for r in stats} # (name, type) -> amount
+    stats_dict = {(r[0].lower(), r[1]): from_minor(r[2]) for r in stats} # (name, type) -> amount
     
     # Собираем список для отображения. 
     # Объединим "официальные" категории и те, что просто встречались в транзакциях.
@@ -1416,7 +3930,7 @@ async def cat_list_view(callback: types.CallbackQuery):
 # -- Удаление --
 @dp.callback_query(F.data == "cat_delete")
 async def cat_delete_start(callback: types.CallbackQuery, state: FSMContext):
-    with sqlite3.connect(DB_PATH) as conn:
+    def _load(conn):
         # 1. Официальные категории
         cats_db = conn.execute("SELECT name FROM categories WHERE user_id = ?", 
                                (callback.from_user.id,)).fetchall()
@@ -1424,6 +3938,9 @@ async def cat_delete_start(callback: types.CallbackQuery, state: FSMContext):
         # 2. Категории из транзакций (призраки)
         cats_tx = conn.execute("SELECT DISTINCT category FROM transactions WHERE user_id = ?", 
                                (callback.from_user.id,)).fetchall()
+        return cats_db, cats_tx
+    
+    cats_db, cats_tx = await db.read(_load)
         
     all_names = set()
     for (name,) in cats_db: all_names.add(name)
@@ -1459,11 +3976,14 @@ async def cat_delete_perform(callback: types.CallbackQuery, state: FSMContext):
 
     cat_name = cats[idx]
     
-    with sqlite3.connect(DB_PATH) as conn:
+    def _delete(conn):
         # Удаляем отовсюду
         conn.execute("DELETE FROM categories WHERE name = ? AND user_id = ?", (cat_name, callback.from_user.id))
-        conn.execute("DELETE FROM transactions WHERE category = ? AND user_id = ?", (cat_name, callback.from_user.id))
-        conn.commit()
+        _delete_transactions(conn, callback.from_user.id, "category = ?", (cat_name,))
+    
+    await db.write(_delete)
+    category_index.invalidate(callback.from_user.id)
+    miniapp_cache.invalidate(callback.from_user.id)
     
     await callback.message.edit_text(f"✅ Категория **'{cat_name}'** и все её транзакции удалены.", parse_mode="Markdown")
     await callback.answer()
@@ -1487,12 +4007,15 @@ async def budgets_menu(message: types.Message):
 @dp.callback_query(F.data == "budget_set")
 async def budget_set_start(callback: types.CallbackQuery, state: FSMContext):
     # Предлагаем выбрать категорию из существующих (только расходы)
-    with sqlite3.connect(DB_PATH) as conn:
+    def _load(conn):
         cats = conn.execute("SELECT name FROM categories WHERE user_id = ? AND type = 'expense'", 
                             (callback.from_user.id,)).fetchall()
         # Также добавим те, что были в транзакциях
         cats_tx = conn.execute("SELECT DISTINCT category FROM transactions WHERE user_id = ? AND type = 'expense'", 
                                (callback.from_user.id,)).fetchall()
+        return cats, cats_tx
+    
+    cats, cats_tx = await db.read(_load)
     
     all_cats = sorted(list(set([c[0] for c in cats] + [c[0] for c in cats_tx])))
     
@@ -1529,15 +4052,9 @@ async def budget_amount_entered(message: types.Message, state: FSMContext):
         amount = float(message.text.replace(' ', ''))
         data = await state.get_data()
         cat_name = data['cat_name']
-        month_key = datetime.now().strftime("%Y-%m")
         
-        with sqlite3.connect(DB_PATH) as conn:
-            # Upsert (удалим старый, добавим новый - проще всего)
-            conn.execute("DELETE FROM budgets WHERE user_id = ? AND category_name = ? AND month_year = ?",
-                         (message.from_user.id, cat_name, month_key))
-            conn.execute("INSERT INTO budgets (user_id, category_name, amount, month_year) VALUES (?, ?, ?, ?)",
-                         (message.from_user.id, cat_name, amount, month_key))
-            conn.commit()
+        await db.write(_set_budget, message.from_user.id, cat_name, amount, current_month())
+        miniapp_cache.invalidate(message.from_user.id)
             
         await message.answer(f"✅ Установлен бюджет **{amount:,.0f} р.** на *{cat_name}*.", parse_mode="Markdown")
         await state.clear()
@@ -1545,23 +4062,30 @@ async def budget_amount_entered(message: types.Message, state: FSMContext):
         await message.answer("Введите корректное число.")
 
 # -- Список и проверка --
+BUDGETS_QUERY = hot_query("budgets: бюджеты месяца",
+                          "SELECT category_name, amount_minor FROM budgets WHERE user_id = ? AND month = ?",
+                          (1, 202401))
+BUDGET_SPENT_QUERY = hot_query("budgets: траты по категориям", """
+    SELECT category, SUM(total)
+    FROM tx_rollup
+    WHERE user_id = ? AND month >= ? AND type = 'expense'
+    GROUP BY category
+""", (1, 202401))
+
+
 @dp.callback_query(F.data == "budget_list")
 async def budget_list_view(callback: types.CallbackQuery):
-    month_key = datetime.now().strftime("%Y-%m")
-    month_start = datetime.now().strftime("%Y-%m-01")
+    month = current_month()
     
-    with sqlite3.connect(DB_PATH) as conn:
+    def _load(conn):
         # Ваши бюджеты
-        budgets = conn.execute("SELECT category_name, amount FROM budgets WHERE user_id = ? AND month_year = ?", 
-                               (callback.from_user.id, month_key)).fetchall()
+        budgets = conn.execute(BUDGETS_QUERY, (callback.from_user.id, month)).fetchall()
         
         # Ваши траты по этим категориям
-        stats = conn.execute("""
-            SELECT category, SUM(amount) 
-            FROM transactions 
-            WHERE user_id = ? AND date >= ? AND type = 'expense'
-            GROUP BY category
-        """, (callback.from_user.id, month_start)).fetchall()
+        stats = conn.execute(BUDGET_SPENT_QUERY, (callback.from_user.id, month)).fetchall()
+        return budgets, stats
+    
+    budgets, stats = await db.read(_load)
     
     if not budgets:
         await callback.message.answer("Бюджеты на этот месяц не установлены.")
@@ -1579,7 +4103,7 @@ async def budget_list_view(callback: types.CallbackQuery):
         # Визуал
         if percent > 1:
             icon = "🔴"
-            status = f"ПРЕВЫШЕНИЕ на {spent - limit:,.0f} р.!"
+            status = f"ПРЕВЫШЕНИЕ на {from_minor(spent - limit):,.0f} р.!"
         elif percent > 0.8:
             icon = "🟠"
             status = "Осталось немного"
@@ -1591,7 +4115,7 @@ async def budget_list_view(callback: types.CallbackQuery):
         filled = int(min(percent, 1) * bar_len)
         bar = "█" * filled + "░" * (bar_len - filled)
         
-        msg += f"**{cat}** {icon}\n{bar} {int(percent*100)}%\n💸 {spent:,.0f} / {limit:,.0f} р.\n_{status}_\n\n"
+        msg += f"**{cat}** {icon}\n{bar} {int(percent*100)}%\n💸 {from_minor(spent):,.0f} / {from_minor(limit):,.0f} р.\n_{status}_\n\n"
 
     await callback.message.answer(msg, parse_mode="Markdown")
     await callback.answer()
@@ -1619,56 +4143,24 @@ async def report_navigate(callback: types.CallbackQuery):
         pass # Если текст не изменился (редкий кейс)
     await callback.answer()
 
+@handler_metrics.measured
 async def generate_report_response(user_id, year, month):
-    # Начало и конец месяца
-    month_str = f"{year}-{month:02d}"
-    start_date = f"{month_str}-01"
+    report = await get_report(user_id, year, month)
     
-    # След месяц для query (чтобы взять < next_start)
-    if month == 12:
-        next_start = f"{year+1}-01-01"
-    else:
-        next_start = f"{year}-{month+1:02d}-01"
-        
-    with sqlite3.connect(DB_PATH) as conn:
-        # 1. Общие цифры
-        summ = conn.execute("""
-            SELECT type, SUM(amount)
-            FROM transactions
-            WHERE user_id = ? AND date >= ? AND date < ?
-            GROUP BY type
-        """, (user_id, start_date, next_start)).fetchall()
-        
-        # 2. По категориям (расходы) - Топ 5
-        cats = conn.execute("""
-            SELECT category, SUM(amount)
-            FROM transactions
-            WHERE user_id = ? AND date >= ? AND date < ? AND type = 'expense'
-            GROUP BY category
-            ORDER BY SUM(amount) DESC
-            LIMIT 5
-        """, (user_id, start_date, next_start)).fetchall()
-        
-        # Для JSON берем все
-        cats_all = conn.execute("""
-            SELECT category, SUM(amount)
-            FROM transactions
-            WHERE user_id = ? AND date >= ? AND date < ? AND type = 'expense'
-            GROUP BY category
-        """, (user_id, start_date, next_start)).fetchall()
-        
+    def _load(conn):
         # Бюджеты и цели не зависят от месяца жестко, но бюджеты привязаны к месяцу.
         # Покажем бюджеты именно этого месяца
-        month_key = f"{year}-{month:02d}"
-        budgets = conn.execute("SELECT category_name, amount FROM budgets WHERE user_id = ? AND month_year = ?", 
-                               (user_id, month_key)).fetchall()
+        budgets = conn.execute(BUDGETS_QUERY, (user_id, month_number(year, month))).fetchall()
         
         current_goals = conn.execute("SELECT name, current_amount, target_amount FROM goals WHERE user_id = ?", 
                              (user_id,)).fetchall()
+        return budgets, current_goals
+
+    budgets, current_goals = await db.read(_load)
 
-    summary = {r[0]: r[1] for r in summ}
-    total_income = summary.get('income', 0)
-    total_expense = summary.get('expense', 0)
+    cats = report["cats"][:5]
+    total_income = from_minor(report["income"])
+    total_expense = from_minor(report["expense"])
     balance = total_income - total_expense
     
     # Имя месяца
@@ -1682,13 +4174,13 @@ async def generate_report_response(user_id, year, month):
     if cats:
         msg += "**🏆 Топ-5 расходов:**\n"
         for name, amount in cats:
-            msg += f"- {name}: {amount:,.0f} р.\n"
+            msg += f"- {name}: {from_minor(amount):,.0f} р.\n"
         msg += "\n"
         
     if budgets:
         msg += "**⚖️ Бюджеты (в этом месяце):**\n"
         for name, limit in budgets:
-             msg += f"- {name}: {limit:,.0f} р.\n"
+             msg += f"- {name}: {from_minor(limit):,.0f} р.\n"
         msg += "\n"
         
     if current_goals and (year == datetime.now().year and month == datetime.now().month):
@@ -1699,16 +4191,7 @@ async def generate_report_response(user_id, year, month):
              msg += f"- {name}: {curr:,.0f} / {target:,.0f} ({percent:.0f}%)\n"
 
     # JSON for WebApp - передаём полные данные транзакций для выбранного месяца
-    # Получаем транзакции за выбранный месяц
-    with sqlite3.connect(DB_PATH) as conn:
-        tx_rows = conn.execute("""
-            SELECT id, amount, category, type, date, COALESCE(description, '') 
-            FROM transactions 
-            WHERE user_id = ? AND date >= ? AND date < ?
-            ORDER BY id DESC
-        """, (user_id, start_date, next_start)).fetchall()
-        
-        tx = [{"i": r[0], "a": int(r[1]), "c": r[2], "t": (1 if r[3] == "expense" else 0), "d": r[4][5:16], "ds": r[5]} for r in tx_rows]
+    tx = report["tx"]
     
     report_data = {
         'uid': user_id,
@@ -1716,13 +4199,11 @@ async def generate_report_response(user_id, year, month):
         'g': [],  # Цели не нужны для отчёта
         'b': [],  # Бюджеты не нужны для отчёта
         'c': {"expense": [], "income": []},
-        's': {'i': int(total_income), 'e': int(total_expense)},
+        's': {'i': json_amount(report["income"]), 'e': json_amount(report["expense"])},
         'm': month_name,
         'tab': 'reports'  # Автопереход на вкладку отчётов
     }
-    json_str = json.dumps(report_data)
-    b64_data = base64.urlsafe_b64encode(json_str.encode()).decode()
-    report_url = f"{WEB_APP_URL}?data={b64_data}"
+    report_url = miniapp_url(report_data)
     
     # Кнопки навигации
     # Prev:
@@ -1761,10 +4242,7 @@ async def generate_report_response(user_id, year, month):
 async def open_miniapp_handler(message: types.Message):
     # Генерация ссылки с данными
     payload = await get_miniapp_data(message.from_user.id)
-    json_str = json.dumps(payload)
-    # Сжатие? JSON может быть большим. Надеемся на 20 txs и base64.
-    b64_data = base64.urlsafe_b64encode(json_str.encode()).decode()
-    url = f"{WEB_APP_URL}?data={b64_data}"
+    url = miniapp_url(payload)
     
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📱 Открыть приложение", web_app=WebAppInfo(url=url))]
@@ -1791,38 +4269,238 @@ FUNNY_INCOME_RESPONSES = [
     "Наконец-то пополнение!",
 ]
 
+# Сколько пар (пользователь, тип) держать в индексе категорий
+CATEGORY_INDEX_USERS = 5000
+
+# Сколько пользователей держать в кэше payload для MiniApp
+MINIAPP_CACHE_USERS = 2000
+
+# Журнал изменений для /api/sync: сколько последних записей хранить на пользователя и как часто чистить
+CHANGE_LOG_KEEP = 1000
+CHANGE_LOG_COMPACT_EVERY = 3600
+# Пользователей за одну запись компактизации: писатель не занят дольше одной пачки
+CHANGE_LOG_COMPACT_BATCH = 200
+
+
+class CategoryMatcher:
+    """
+    Категории одного пользователя одного типа.
+    match() принимает те же решения, что и прежний поиск:
+    точное совпадение без учёта регистра, иначе difflib.get_close_matches(n=1, cutoff=0.5).
+    Кандидаты берутся из индекса по символам: ratio() >= 0.5 невозможно без общих символов,
+    а их число (quick_ratio) и длины (real_quick_ratio) отсекаем до дорогого ratio().
+    Первыми проверяются имена с общими биграммами (опечатка почти всегда сохраняет пару соседних
+    символов): найденный среди них score поднимает порог, и остальным хватает дешёвых оценок.
+    Обойтись одними биграммами нельзя: перестановка ("rnet" и "rent") не оставляет общих пар
+    при ratio() 0.75 - на корпусе check_category_matcher_cli это около 0.25% запросов с другим ответом.
+    """
+
+    def __init__(self, names=()):
+        self.names = {}  # lower -> оригинальное имя (первое добавленное)
+        self._chars = {}  # символ -> {lower-имя: сколько раз встречается}
+        self._bigrams = {}  # пара соседних символов -> {lower-имена}
+        for name in names:
+            self.add(name)
+
+    @staticmethod
+    def _pairs(text):
+        return {text[i:i + 2] for i in range(len(text) - 1)}
+
+    def add(self, name):
+        key = name.lower()
+        if key in self.names:
+            return
+        self.names[key] = name
+        for ch, count in Counter(key).items():
+            self._chars.setdefault(ch, {})[key] = count
+        for pair in self._pairs(key):
+            self._bigrams.setdefault(pair, set()).add(key)
+
+    def match(self, query, cutoff=0.5):
+        query = query.lower().strip()
+        if query in self.names:
+            return self.names[query]
+
+        common = {}
+        for ch, count in Counter(query).items():
+            for key, key_count in self._chars.get(ch, {}).items():
+                common[key] = common.get(key, 0) + min(count, key_count)
+        likely = set()
+        for pair in self._pairs(query):
+            likely |= self._bigrams.get(pair, set())
+
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(query)
+        best = None
+        for key in [*likely, *(common.keys() - likely)]:
+            # Верхняя граница ratio() ниже найденного - этот ключ не победит (равный ещё может по строке)
+            bar = best[0] if best else cutoff
+            total = len(query) + len(key)
+            if 2.0 * min(len(query), len(key)) / total < bar or 2.0 * common[key] / total < bar:
+                continue
+            matcher.set_seq1(key)
+            score = matcher.ratio()
+            # get_close_matches выбирает максимум по (score, строка)
+            if score >= cutoff and (best is None or (score, key) > best):
+                best = (score, key)
+        return self.names[best[1]] if best else None
+
+
+class UserBuilds:
+    """
+    Версии данных по user_id для кэшей в памяти: снимок, во время сборки которого у того же
+    пользователя прошла запись, не кэшируется. Записи других пользователей снимок не трогают.
+    Хранятся только пользователи, у которых сборка идёт прямо сейчас.
+    """
+
+    def __init__(self):
+        self._builds = {}  # user_id -> [сборок в процессе, версия]
+
+    def start(self, user_id):
+        entry = self._builds.setdefault(user_id, [0, 0])
+        entry[0] += 1
+        return entry[1]
+
+    def finish(self, user_id, version):
+        """True, если с start() записей этого пользователя не было"""
+        entry = self._builds[user_id]
+        entry[0] -= 1
+        if not entry[0]:
+            del self._builds[user_id]
+        return entry[1] == version
+
+    def bump(self, user_id):
+        entry = self._builds.get(user_id)
+        if entry is not None:
+            entry[1] += 1
+
+
+class CategoryIndex:
+    """Ленивые CategoryMatcher по (user_id, type) с LRU вытеснением"""
+
+    def __init__(self, max_users=CATEGORY_INDEX_USERS):
+        self.max_users = max_users
+        self._matchers = OrderedDict()  # (user_id, type) -> matcher
+        self._builds = UserBuilds()
+
+    _OWN_SQL = hot_query("CategoryIndex: свои категории",
+                         "SELECT name FROM categories WHERE user_id = ? AND type = ?", (1, "expense"))
+    _HISTORY_SQL = hot_query("CategoryIndex: категории из истории",
+                             "SELECT DISTINCT category FROM tx_rollup WHERE user_id = ? AND type = ?", (1, "expense"))
+
+    @staticmethod
+    def _load(conn, user_id, t_type):
+        # Сначала свои категории - их написание в приоритете
+        names = [r[0] for r in conn.execute(CategoryIndex._OWN_SQL, (user_id, t_type))]
+        # Категории из истории берём из месячных агрегатов, а не из всех транзакций
+        names += [r[0] for r in conn.execute(CategoryIndex._HISTORY_SQL, (user_id, t_type))]
+        return [name for name in names if name]
+
+    async def get(self, user_id, t_type):
+        key = (user_id, t_type)
+        matcher = self._matchers.get(key)
+        if matcher is not None:
+            self._matchers.move_to_end(key)
+            return matcher
+
+        version = self._builds.start(user_id)
+        try:
+            matcher = CategoryMatcher(await db.read(self._load, user_id, t_type))
+        finally:
+            unchanged = self._builds.finish(user_id, version)
+        # Пока читали, пользователь мог добавить/удалить категорию - такой снимок не кэшируем
+        if unchanged:
+            self._matchers[key] = matcher
+            self._matchers.move_to_end(key)
+            if len(self._matchers) > self.max_users:
+                self._matchers.popitem(last=False)
+        return matcher
+
+    def add(self, user_id, t_type, name):
+        self._builds.bump(user_id)
+        matcher = self._matchers.get((user_id, t_type))
+        if matcher is not None and name:
+            matcher.add(name)
+        # Соседние воркеры просто перечитают категории пользователя
+        peers.publish("c", user_id)
+
+    def invalidate(self, user_id):
+        self.drop(user_id)
+        peers.publish("c", user_id)
+
+    def drop(self, user_id):
+        self._builds.bump(user_id)
+        self._matchers.pop((user_id, 'expense'), None)
+        self._matchers.pop((user_id, 'income'), None)
+
+
+category_index = CategoryIndex()
+
+
+def _difflib_category_match(names, category_input):
+    """Прежний алгоритм выбора категории - эталон для check_category_matcher_cli"""
+    name_map = {}
+    for name in names:
+        name_map.setdefault(name.lower(), name)
+    query = category_input.lower().strip()
+    if query in name_map:
+        return name_map[query]
+    matches = difflib.get_close_matches(query, list(name_map), n=1, cutoff=0.5)
+    return name_map[matches[0]] if matches else None
+
+
+def check_category_matcher_cli(rounds=3000, seed=1):
+    """Сверка CategoryMatcher с difflib на корпусе категорий с опечатками: код возврата 1 при расхождении"""
+    rng = random.Random(seed)
+    base = ["Еда", "Продукты", "Кафе", "Ресторан", "Такси", "Транспорт", "Бензин", "Зарплата", "ЗП", "Аренда",
+            "Коммуналка", "Интернет", "Связь", "Одежда", "Здоровье", "Аптека", "Спорт", "Подарки", "Развлечения",
+            "Кино", "Путешествия", "Отпуск", "Кредит", "Ипотека", "Дети", "Образование", "Книги", "Подписки",
+            "Food", "Groceries", "Cafe", "Taxi", "Salary", "Rent", "Gym", "Gifts", "Travel", "Coffee", "Beer", "Pets",
+            "Еда и напитки", "Еда на работе", "Фриланс", "Кешбэк", "Дивиденды", "Такси ночью", "Кофе", "Пиво"]
+    alphabet = "абвгдеёжзийклмнопрстуфхцчшщъыьэюяabcdefghijklmnopqrstuvwxyz "
+
+    def typo(word):
+        word = list(word)
+        for _ in range(rng.choice([0, 1, 1, 2, 3])):
+            op = rng.choice("dist")
+            pos = rng.randrange(len(word) + 1)
+            if op == "d" and word and pos < len(word):
+                del word[pos]
+            elif op == "i":
+                word.insert(pos, rng.choice(alphabet))
+            elif op == "s" and word and pos < len(word):
+                word[pos] = rng.choice(alphabet)
+            elif op == "t" and pos + 1 < len(word):
+                word[pos], word[pos + 1] = word[pos + 1], word[pos]
+        text = "".join(word)
+        return rng.choice([text, text.upper(), text.capitalize(), f" {text} "])
+
+    mismatches = 0
+    for _ in range(rounds):
+        names = [rng.choice(base) if rng.random() < 0.7 else typo(rng.choice(base))
+                 for _ in range(rng.randint(0, 40))]
+        matcher = CategoryMatcher(names)
+        for _ in range(5):
+            query = typo(rng.choice(base)) if rng.random() < 0.9 else "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 12)))
+            want, got = _difflib_category_match(names, query), matcher.match(query)
+            if (want or "").lower() != (got or "").lower():
+                mismatches += 1
+                print(f"MISMATCH {query!r}: difflib={want!r} index={got!r} names={names!r}")
+    print(f"{'FAIL' if mismatches else 'OK'}: {rounds * 5} queries, {mismatches} mismatches")
+    return 1 if mismatches else 0
+
+
 async def process_transaction_request(message: types.Message, state: FSMContext, amount, category_input, t_type, desc):
-    # 1. Получаем список существующих категорий пользователя (из таблицы categories + из транзакций)
-    with sqlite3.connect(DB_PATH) as conn:
-        cats_db = conn.execute("SELECT name FROM categories WHERE user_id = ? AND type = ?", 
-                               (message.from_user.id, t_type)).fetchall()
-        cats_tx = conn.execute("SELECT DISTINCT category FROM transactions WHERE user_id = ? AND type = ?",
-                               (message.from_user.id, t_type)).fetchall()
-    
-    # Объединяем, убираем дубли (с учетом регистра)
-    existing_names_raw = list(set([c[0] for c in cats_db] + [c[0] for c in cats_tx]))
-    
-    # 2. Нечеткий поиск (Fuzzy match) - с нормализацией регистра
-    category_input_lower = category_input.lower().strip()
-    
-    # Создаём маппинг lower -> original для точного совпадения
-    name_map = {name.lower(): name for name in existing_names_raw}
-    existing_names_lower = list(name_map.keys())
-    
-    # Точное совпадение (без учёта регистра)
-    if category_input_lower in name_map:
-        matched_category = name_map[category_input_lower]
-    else:
-        # Нечеткий поиск с cutoff=0.5 (позволяет 1-2 ошибки)
-        matches = difflib.get_close_matches(category_input_lower, existing_names_lower, n=1, cutoff=0.5)
-        if matches:
-            matched_category = name_map[matches[0]]  # Получаем оригинальное имя с правильным регистром
-        else:
-            matched_category = None
+    # 1. Категории пользователя (из таблицы categories + из транзакций) - индекс в памяти
+    matcher = await category_index.get(message.from_user.id, t_type)
+    
+    # 2. Точное совпадение без учёта регистра, иначе нечеткий поиск с cutoff=0.5 (позволяет 1-2 ошибки)
+    matched_category = matcher.match(category_input)
     
     if matched_category:
         # Нашли совпадение! Используем существующую категорию
-        save_transaction(message.from_user.id, amount, matched_category, t_type, desc)
+        if not await save_transaction(message.from_user.id, amount, matched_category, t_type, desc, update_key()):
+            return  # тот же апдейт повторно - запись и ответ уже были
         
         icon = "📉" if t_type == 'expense' else "📈"
         responses = FUNNY_RESPONSES if t_type == 'expense' else FUNNY_INCOME_RESPONSES
@@ -1838,7 +4516,7 @@ async def process_transaction_request(message: types.Message, state: FSMContext,
         
         # Проверка бюджета (шутливая)
         if t_type == 'expense':
-            warning = check_budget_exceeded(message.from_user.id, matched_category, amount)
+            warning = await check_budget_exceeded(message.from_user.id, matched_category, amount)
             if warning:
                 caption += f"\n\n🚨 {warning}"
 
@@ -1851,14 +4529,15 @@ async def process_transaction_request(message: types.Message, state: FSMContext,
         'amount': amount,
         'category_input': category_input,
         'type': t_type,
-        'desc': desc
+        'desc': desc,
+        'key': update_key()
     })
     
     kb_buttons = [
         [InlineKeyboardButton(text=f"➕ Создать '{category_input}'", callback_data="tx_create_new")],
         [InlineKeyboardButton(text="📂 Выбрать из списка", callback_data="tx_choose_existing")]
     ]
-    if existing_names:
+    if matcher.names:
         kb_buttons.append([InlineKeyboardButton(text="❌ Отмена", callback_data="tx_cancel")])
         
     kb = InlineKeyboardMarkup(inline_keyboard=kb_buttons)
@@ -1875,20 +4554,31 @@ async def parse_and_save(message: types.Message, state: FSMContext):
     if match_goal:
         amount = float(match_goal.group(1))
         goal_name = match_goal.group(2).strip()
-        with sqlite3.connect(DB_PATH) as conn:
+        key = update_key()
+        def _top_up(conn):
+            # Тот же апдейт доставлен повторно - пополнение уже было
+            if not _claim_key(conn, user_id, key):
+                return False, None
             cursor = conn.cursor()
             cursor.execute("SELECT id, current_amount FROM goals WHERE user_id = ? AND name LIKE ?", (user_id, f"%{goal_name}%"))
             goal = cursor.fetchone()
             if goal:
-                new_amount = goal[1] + amount
-                cursor.execute("UPDATE goals SET current_amount = ? WHERE id = ?", (new_amount, goal[0]))
-                await message.answer(f"🎯 **Цель '{goal_name}' пополнена!**\nБыло: {goal[1]}\nСтало: {new_amount}\nДобавлено: +{amount}")
+                cursor.execute("UPDATE goals SET current_amount = current_amount + ? WHERE id = ?", (amount, goal[0]))
             else:
                 cursor.execute("INSERT INTO goals (user_id, name, target_amount, current_amount, created_at) VALUES (?, ?, ?, ?, ?)",
                                (user_id, goal_name, 0, amount, datetime.now().strftime("%Y-%m-%d")))
-                await message.answer(f"🆕 **Новая цель '{goal_name}' создана!**\nНачало положено: {amount} р.")
-            conn.commit()
-        await update_user_menu_button(user_id) # UPDATE APP DATA
+            return True, goal
+        
+        saved, goal = await db.write(_top_up)
+        if not saved:
+            return
+        miniapp_cache.invalidate(user_id)
+        if goal:
+            new_amount = goal[1] + amount
+            await message.answer(f"🎯 **Цель '{goal_name}' пополнена!**\nБыло: {goal[1]}\nСтало: {new_amount}\nДобавлено: +{amount}")
+        else:
+            await message.answer(f"🆕 **Новая цель '{goal_name}' создана!**\nНачало положено: {amount} р.")
+        menu_refresher.schedule(user_id) # UPDATE APP DATA
         return
 
     # 2. Доход (+1000 Зарплата)
@@ -1926,17 +4616,16 @@ async def tx_create_new_cat(callback: types.CallbackQuery, state: FSMContext):
         await callback.message.edit_text("Ошибка: данные устарели.")
         return
 
-    # Создаем категорию
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute("INSERT INTO categories (user_id, name, type, created_at) VALUES (?, ?, ?, ?)",
-                     (callback.from_user.id, tx['category_input'], tx['type'], datetime.now().strftime("%Y-%m-%d")))
-        conn.commit()
-        
-    # Сохраняем транзакцию
-    save_transaction(callback.from_user.id, tx['amount'], tx['category_input'], tx['type'], tx['desc'])
+    # Категория и транзакция - одной записью; повторное нажатие (тот же ключ) не создаёт ни того, ни другого
+    if not await db.write(_save_with_new_category, callback.from_user.id, tx):
+        await callback.message.edit_text("⚠️ Транзакция уже добавлена (защита от дубликатов)")
+        await state.clear()
+        return
+    category_index.add(callback.from_user.id, tx['type'], tx['category_input'])
+    miniapp_cache.invalidate(callback.from_user.id)
     
     await callback.message.edit_text(f"✅ Создана категория **'{tx['category_input']}'** и добавлена запись:\n{tx['amount']} р.", parse_mode="Markdown")
-    await update_user_menu_button(callback.from_user.id) # UPDATE APP DATA
+    menu_refresher.schedule(callback.from_user.id) # UPDATE APP DATA
     await state.clear()
 
 @dp.callback_query(F.data == "tx_choose_existing")
@@ -1944,9 +4633,8 @@ async def tx_choose_start(callback: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     tx = data.get('pending_tx')
     
-    with sqlite3.connect(DB_PATH) as conn:
-        cats = conn.execute("SELECT name FROM categories WHERE user_id = ? AND type = ?", 
-                            (callback.from_user.id, tx['type'])).fetchall()
+    cats = await db.fetchall("SELECT name FROM categories WHERE user_id = ? AND type = ?", 
+                             (callback.from_user.id, tx['type']))
         
     buttons = []
     # Группируем по 2
@@ -1972,10 +4660,12 @@ async def tx_select_existing(callback: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     tx = data.get('pending_tx')
     
-    save_transaction(callback.from_user.id, tx['amount'], selected_cat, tx['type'], tx['desc'])
+    if not await save_transaction(callback.from_user.id, tx['amount'], selected_cat, tx['type'], tx['desc'], tx.get('key')):
+        await callback.answer("Уже добавлено")
+        return
     
     await callback.message.edit_text(f"✅ Добавлено в **'{selected_cat}'**:\n{tx['amount']} р.", parse_mode="Markdown")
-    await update_user_menu_button(callback.from_user.id) # UPDATE APP DATA
+    menu_refresher.schedule(callback.from_user.id) # UPDATE APP DATA
     await state.clear()
     
 @dp.callback_query(F.data == "tx_cancel")
@@ -1989,7 +4679,7 @@ async def tx_cancel(callback: types.CallbackQuery, state: FSMContext):
 async def text_handler(message: types.Message, state: FSMContext):
     current_state = await state.get_state()
     if current_state:
-        logging.info(f"DEBUG: Text handler skipped because of active state: {current_state}")
+        logging.debug(f"Text handler skipped because of active state: {current_state}")
         return
 
     if message.text in ["💰 Баланс", "📊 Мой Баланс", "Баланс", "📋 История", "🎯 Цели", "📂 Категории", "📊 Бюджеты", "📈 Отчеты", "📋 Транзакции"]:
@@ -2002,28 +4692,37 @@ async def text_handler(message: types.Message, state: FSMContext):
 # Note: Removed duplicate text_handler, the one above is used
 
 
-def check_budget_exceeded(user_id, category_name, current_amount):
-    month_key = datetime.now().strftime("%Y-%m")
-    month_start = datetime.now().strftime("%Y-%m-01")
+BUDGET_LIMIT_QUERY = hot_query(
+    "check_budget_exceeded: бюджет категории",
+    "SELECT amount_minor FROM budgets WHERE user_id = ? AND category_name = ? AND month = ?",
+    (1, "Еда", 202401))
+CATEGORY_SPENT_QUERY = hot_query(
+    "check_budget_exceeded: траты категории",
+    "SELECT SUM(total) FROM tx_rollup WHERE user_id = ? AND month >= ? AND type = 'expense' AND category = ?",
+    (1, 202401, "Еда"))
+
+
+async def check_budget_exceeded(user_id, category_name, current_amount):
+    month = current_month()
     
-    with sqlite3.connect(DB_PATH) as conn:
+    def _load(conn):
         # 1. Получаем бюджет
-        budget_row = conn.execute("SELECT amount FROM budgets WHERE user_id = ? AND category_name = ? AND month_year = ?", 
-                              (user_id, category_name, month_key)).fetchone()
+        budget_row = conn.execute(BUDGET_LIMIT_QUERY, (user_id, category_name, month)).fetchone()
         if not budget_row:
-            return None # Нет бюджета - нет проблем
-            
-        limit = budget_row[0]
+            return None, 0 # Нет бюджета - нет проблем
         
         # 2. Получаем сумму трат (включая только что добавленную? save_transaction уже сработал)
-        spent_row = conn.execute("SELECT SUM(amount) FROM transactions WHERE user_id = ? AND category = ? AND date >= ? AND type = 'expense'",
-                                 (user_id, category_name, month_start)).fetchone()
-        spent = spent_row[0] if spent_row and spent_row[0] else 0
+        spent_row = conn.execute(CATEGORY_SPENT_QUERY, (user_id, month, category_name)).fetchone()
+        return budget_row[0], (spent_row[0] if spent_row and spent_row[0] else 0)
+    
+    limit, spent = await db.read(_load)
+    if limit is None:
+        return None
 
     if spent > limit:
         # Проверим, было ли превышение ДО этой транзакции?
         # Если (spent - current_amount) <= limit < spent -> значит только что превысили
-        prev_spent = spent - current_amount
+        prev_spent = spent - to_minor(current_amount)
         if prev_spent <= limit:
             return random.choice([
                 "АЛАРМ! Бюджет пробит! 😱",
@@ -2038,19 +4737,254 @@ def check_budget_exceeded(user_id, category_name, current_amount):
 
 # --- 8. FULL MINI APP SUPPORT (DYNAMIC MENU BUTTON) ---
 
+# Сколько ждать после записи, прежде чем обновить Menu Button (записи за это время склеиваются)
+MENU_REFRESH_DELAY = 1.0
+
+
+class MenuRefresher:
+    """
+    Фоновое обновление Menu Button с debounce по пользователю.
+    Обработчик записи только ставит пользователя в очередь и сразу отвечает;
+    несколько записей за MENU_REFRESH_DELAY дают одну пересборку и один вызов Telegram.
+    """
+
+    def __init__(self, delay=MENU_REFRESH_DELAY):
+        self.delay = delay
+        self._pending = {}  # user_id -> задача с отложенным обновлением
+        self.issued = 0
+        self.coalesced = 0
+
+    def schedule(self, user_id):
+        if user_id in self._pending:
+            self.coalesced += 1
+            return
+        self._pending[user_id] = asyncio.create_task(self._refresh_later(user_id))
+
+    async def _refresh_later(self, user_id):
+        await asyncio.sleep(self.delay)
+        # Снимаем с очереди до обновления: запись во время обновления запланирует новое
+        del self._pending[user_id]
+        self.issued += 1
+        await update_user_menu_button(user_id)
+
+    async def flush(self):
+        """Выполнить все отложенные обновления сразу (при остановке)"""
+        pending, self._pending = self._pending, {}
+        for task in pending.values():
+            task.cancel()
+        self.issued += len(pending)
+        await asyncio.gather(*(update_user_menu_button(uid) for uid in pending))
+
+
+menu_refresher = MenuRefresher()
+
+
+# Компактный формат payload для MiniApp (параметр ?z=).
+# base64url( версия (1 байт) + deflate(тело) ), тело версии 1:
+#   JSON всех полей, кроме tx
+#   словарь строк (категории и описания), транзакции ссылаются на него по номеру
+#   транзакции по столбцам: id (дельта от предыдущего), сумма в копейках,
+#   категория и тип, описание, время (дельта минут от предыдущей)
+# Числа - varint, знаковые - zigzag. Декодер - decodeCompact() в index.html.
+MINIAPP_PAYLOAD_VERSION = 1
+
+# Сколько транзакций брать в payload и максимальная длина URL: лишние старые транзакции отрезаются
+MINIAPP_TX_LIMIT = 100
+MINIAPP_URL_BUDGET = 2048
+
+
+def _put_varint(out, value):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _put_zigzag(out, value):
+    _put_varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+
+
+def _put_str(out, text):
+    data = text.encode()
+    _put_varint(out, len(data))
+    out.extend(data)
+
+
+def _tx_minute(d):
+    """'MM-DD HH:MM' -> число, монотонное по времени внутри года (0 - пустая дата)"""
+    if not d:
+        return 0
+    return ((int(d[0:2]) * 32 + int(d[3:5])) * 24 + int(d[6:8])) * 60 + int(d[9:11])
+
+
+def encode_miniapp_payload(payload):
+    """Payload MiniApp -> строка для параметра ?z="""
+    tx = payload.get("tx") or []
+    meta = {k: v for k, v in payload.items() if k != "tx"}
+
+    strings = {}  # строка -> номер + 1 (0 - None)
+
+    def ref(text):
+        if text is None:
+            return 0
+        return strings.setdefault(text, len(strings) + 1)
+
+    refs = [(ref(t["c"]), ref(t.get("ds"))) for t in tx]
+
+    out = bytearray()
+    _put_str(out, json.dumps(meta, ensure_ascii=False, separators=(",", ":")))
+    _put_varint(out, len(strings))
+    for text in strings:
+        _put_str(out, text)
+    _put_varint(out, len(tx))
+    prev = 0
+    for t in tx:
+        _put_zigzag(out, prev - t["i"])
+        prev = t["i"]
+    for t in tx:
+        _put_zigzag(out, int(round(t["a"] * 100)))
+    for (cat, _), t in zip(refs, tx):
+        _put_varint(out, cat * 2 + t["t"])
+    for _, desc in refs:
+        _put_varint(out, desc)
+    prev = 0
+    for t in tx:
+        minute = _tx_minute(t["d"])
+        _put_zigzag(out, prev - minute)
+        prev = minute
+
+    data = bytes([MINIAPP_PAYLOAD_VERSION]) + zlib.compress(bytes(out), 9)
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def decode_miniapp_payload(encoded):
+    """Обратное преобразование (для проверки формата, в боте не используется)"""
+    data = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+    if data[0] != MINIAPP_PAYLOAD_VERSION:
+        raise ValueError(f"unknown payload version {data[0]}")
+    buf = zlib.decompress(data[1:])
+    pos = 0
+
+    def varint():
+        nonlocal pos
+        result = shift = 0
+        while True:
+            byte = buf[pos]
+            pos += 1
+            result |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                return result
+
+    def zigzag():
+        value = varint()
+        return -(value + 1) // 2 if value & 1 else value // 2
+
+    def text():
+        nonlocal pos
+        n = varint()
+        pos += n
+        return buf[pos - n:pos].decode()
+
+    payload = json.loads(text())
+    strings = [None] + [text() for _ in range(varint())]
+    n = varint()
+    tx = [{} for _ in range(n)]
+    prev = 0
+    for t in tx:
+        prev -= zigzag()
+        t["i"] = prev
+    for t in tx:
+        minor = zigzag()
+        t["a"] = minor // 100 if minor % 100 == 0 else minor / 100
+    for t in tx:
+        value = varint()
+        t["c"], t["t"] = strings[value >> 1], value & 1
+    for t in tx:
+        t["ds"] = strings[varint()]
+    prev = 0
+    for t in tx:
+        prev -= zigzag()
+        minute, hour, day, month = prev % 60, prev // 60 % 24, prev // 1440 % 32, prev // 46080
+        t["d"] = f"{month:02d}-{day:02d} {hour:02d}:{minute:02d}" if prev else ""
+    payload["tx"] = tx
+    return payload
+
+
+def miniapp_url(payload, **params):
+    """
+    URL MiniApp с payload в компактном формате. Если не влезает в MINIAPP_URL_BUDGET,
+    отрезаем самые старые транзакции (tx отсортированы от новых к старым).
+    """
+    suffix = "".join(f"&{k}={v}" for k, v in params.items())
+
+    def build(n):
+        return f"{WEB_APP_URL}?z={encode_miniapp_payload(dict(payload, tx=tx[:n]))}{suffix}"
+
+    tx = payload.get("tx") or []
+    url = build(len(tx))
+    if len(url) <= MINIAPP_URL_BUDGET:
+        return url
+    lo, hi = 0, len(tx) - 1  # ищем максимальное n, при котором URL влезает
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if len(build(mid)) <= MINIAPP_URL_BUDGET:
+            lo = mid
+        else:
+            hi = mid - 1
+    return build(lo)
+
+
+def bench_payload_cli(seed=1):
+    """Размер URL в старом (base64 JSON) и компактном формате и сколько транзакций влезает в бюджет"""
+    rng = random.Random(seed)
+    cats = ["Продукты", "Кафе", "Такси", "Транспорт", "Аптека", "Связь", "Подписки", "Одежда", "Развлечения", "Кофе"]
+    descs = ["", "", "", "обед", "пятёрочка", "такси домой", "кофе с собой", "подарок маме", "netflix"]
+    ts = int(datetime(2025, 6, 28, 21, 0).timestamp())
+    tx, tx_id = [], 50000
+    for _ in range(400):
+        income = rng.random() < 0.05
+        minor = rng.randint(5, 2000) * 100 if rng.random() < 0.8 else rng.randint(100, 300000)
+        tx.append({"i": tx_id, "a": json_amount(minor * (30 if income else 1)), "c": "Зарплата" if income else rng.choice(cats),
+                   "t": 0 if income else 1, "d": format_ts(ts, "%m-%d %H:%M"), "ds": rng.choice(descs)})
+        tx_id -= rng.randint(1, 40)
+        ts -= rng.randint(600, 30000)
+    payload = {"uid": 123456789, "tx": tx, "g": [{"i": 1, "n": "Отпуск", "c": 45000, "t": 150000}],
+               "b": [{"n": "Продукты", "l": 30000, "s": 21450}], "c": {"expense": sorted(cats), "income": ["Зарплата"]},
+               "s": {"i": 150000, "e": 98000.5}, "m": "June"}
+
+    def legacy_url(n):
+        data = base64.urlsafe_b64encode(json.dumps(dict(payload, tx=tx[:n])).encode()).decode()
+        return f"{WEB_APP_URL}?data={data}"
+
+    def compact_url(n):
+        return f"{WEB_APP_URL}?z={encode_miniapp_payload(dict(payload, tx=tx[:n]))}"
+
+    def fits(build):
+        return max((n for n in range(len(tx) + 1) if len(build(n)) <= MINIAPP_URL_BUDGET), default=0)
+
+    errors = 0
+    print(f"{'tx':>5} {'base64 JSON':>12} {'compact':>8} {'ratio':>6}")
+    for n in (10, 25, 50, 100, 200, 400):
+        legacy, compact = len(legacy_url(n)), len(compact_url(n))
+        decoded = decode_miniapp_payload(compact_url(n).split("?z=", 1)[1])
+        if decoded != dict(payload, tx=tx[:n]):
+            errors += 1
+            print(f"FAIL round trip for {n} tx")
+        print(f"{n:>5} {legacy:>12} {compact:>8} {legacy / compact:>5.1f}x")
+    print(f"URL budget {MINIAPP_URL_BUDGET}: base64 JSON fits {fits(legacy_url)} tx, compact fits {fits(compact_url)} tx")
+    return 1 if errors else 0
+
+
 async def update_user_menu_button(user_id):
     """
     Updates the native Menu Button for the user with a dynamic URL containing their latest data.
     """
     try:
-        # Generate Payload
-        # Limit to 10 transactions to keep URL short (< 2KB safety)
-        payload = await get_miniapp_data(user_id, limit=10)
-        json_str = json.dumps(payload)
-        b64_data = base64.urlsafe_b64encode(json_str.encode()).decode()
+        # Generate Payload (сколько транзакций влезет в MINIAPP_URL_BUDGET)
+        payload = await get_miniapp_data(user_id)
         # Add timestamp to force cache invalidation
-        ts = int(datetime.now().timestamp())
-        url = f"{WEB_APP_URL}?data={b64_data}&v={ts}"
+        url = miniapp_url(payload, v=int(datetime.now().timestamp()))
         
         # Update Button
         await bot.set_chat_menu_button(
@@ -2060,141 +4994,293 @@ async def update_user_menu_button(user_id):
     except Exception as e:
         logging.error(f"Failed to update menu button for {user_id}: {e}")
 
-async def get_miniapp_data(user_id, limit=15):
-    month_start = datetime.now().strftime("%Y-%m-01")
-    month_key = datetime.now().strftime("%Y-%m")
-    
-    with sqlite3.connect(DB_PATH) as conn:
-        # 1. Transactions
-        tx_rows = conn.execute("""
-            SELECT id, amount, category, type, date, description 
-            FROM transactions 
-            WHERE user_id = ? 
-            ORDER BY id DESC LIMIT ?
-        """, (user_id, limit)).fetchall()
-        
-        # Short keys: i=id, a=amount, c=cat, t=type(0=inc,1=exp), d=date
-        # Optimize size: "2023-10-15 12:00:00" -> "15 Oct" handling in JS? 
-        # For now keep full date but maybe truncated?
-        tx = [{"i": r[0], "a": int(r[1]), "c": r[2], "t": (1 if r[3] == "expense" else 0), "d": r[4][5:16], "ds": r[5]} for r in tx_rows]
-        
-        # 2. Goals
-        goals_rows = conn.execute("SELECT id, name, current_amount, target_amount FROM goals WHERE user_id = ?", (user_id,)).fetchall()
-        goals = [{"i": r[0], "n": r[1], "c": int(r[2]), "t": int(r[3])} for r in goals_rows]
-        
-        # 3. Budgets
-        bud_rows = conn.execute("SELECT category_name, amount FROM budgets WHERE user_id = ? AND month_year = ?", (user_id, month_key)).fetchall()
-        buds = {r[0]: r[1] for r in bud_rows}
-        
-        # 4. Categories - включаем и из таблицы categories, и уникальные из транзакций
-        # Разделяем по типу для удобства фильтрации в MiniApp
-        cat_rows = conn.execute("SELECT DISTINCT name, type FROM categories WHERE user_id = ?", (user_id,)).fetchall()
-        tx_cats = conn.execute("SELECT DISTINCT category, type FROM transactions WHERE user_id = ?", (user_id,)).fetchall()
-        
-        # Объединяем и разделяем по типу
-        expense_cats = set()
-        income_cats = set()
-        for name, ctype in cat_rows:
-            if ctype == 'expense':
-                expense_cats.add(name)
-            else:
-                income_cats.add(name)
-        for name, ctype in tx_cats:
-            if ctype == 'expense':
-                expense_cats.add(name)
-            else:
-                income_cats.add(name)
-        
-        cats = {
-            "expense": sorted(list(expense_cats)),
-            "income": sorted(list(income_cats))
-        }
-        
-        # 5. Stats
-        summ = conn.execute("SELECT type, SUM(amount) FROM transactions WHERE user_id = ? AND date >= ? GROUP BY type", (user_id, month_start)).fetchall()
-        
-        # Calc spent for budgets
-        cat_spent_rows = conn.execute("SELECT category, SUM(amount) FROM transactions WHERE user_id = ? AND date >= ? AND type = 'expense' GROUP BY category", (user_id, month_start)).fetchall()
-        cat_spent = {r[0]: r[1] for r in cat_spent_rows}
-        
-    summary = {r[0]: r[1] for r in summ}
-    inc = summary.get('income', 0)
-    exp = summary.get('expense', 0)
-    
+class MiniAppCache:
+    """
+    Готовые payload для MiniApp по user_id с LRU вытеснением.
+    Обработчики записи вызывают invalidate() после коммита (он же сбрасывает
+    снимок в соседних воркерах), и снимок пересобирается только при следующем обращении.
+    """
+
+    def __init__(self, max_users=MINIAPP_CACHE_USERS):
+        self.max_users = max_users
+        self._payloads = OrderedDict()  # user_id -> {limit: (месяц, payload)}
+        self._builds = UserBuilds()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._payloads)
+
+    async def get(self, user_id, limit):
+        month = current_month()
+        entry = self._payloads.get(user_id, {}).get(limit)
+        # Снимок прошлого месяца устарел сам по себе: бюджеты и итоги считаются за текущий
+        if entry is not None and entry[0] == month:
+            self.hits += 1
+            self._payloads.move_to_end(user_id)
+            return entry[1]
+
+        self.misses += 1
+        version = self._builds.start(user_id)
+        try:
+            payload = await _build_miniapp_data(user_id, limit, month)
+        finally:
+            unchanged = self._builds.finish(user_id, version)
+        # Пока собирали, могла пройти запись этого пользователя - такой снимок не кэшируем
+        if unchanged:
+            self._payloads.setdefault(user_id, {})[limit] = (month, payload)
+            self._payloads.move_to_end(user_id)
+            if len(self._payloads) > self.max_users:
+                self._payloads.popitem(last=False)
+        return payload
+
+    def invalidate(self, user_id):
+        self.drop(user_id)
+        peers.publish("m", user_id)
+
+    def drop(self, user_id):
+        self._builds.bump(user_id)
+        self._payloads.pop(user_id, None)
+
+
+miniapp_cache = MiniAppCache()
+
+
+async def get_miniapp_data(user_id, limit=MINIAPP_TX_LIMIT):
+    """Payload для MiniApp из кэша; возвращаемый dict общий - не изменять"""
+    return await miniapp_cache.get(user_id, limit)
+
+
+def _tx_item(r):
+    # Short keys: i=id, a=amount, c=cat, t=type(0=inc,1=exp), d=date ("MM-DD HH:MM")
+    return {"i": r[0], "a": json_amount(r[1]), "c": r[2], "t": (1 if r[3] == "expense" else 0), "d": format_ts(r[4], "%m-%d %H:%M"), "ds": r[5]}
+
+
+def _goal_item(r):
+    return {"i": r[0], "n": r[1], "c": int(r[2]), "t": int(r[3])}
+
+
+MINIAPP_CATS_QUERY = hot_query("get_miniapp_data: категории",
+                               "SELECT DISTINCT name, type FROM categories WHERE user_id = ?", (1,))
+MINIAPP_TX_CATS_QUERY = hot_query("get_miniapp_data: категории из транзакций",
+                                  "SELECT DISTINCT category, type FROM transactions WHERE user_id = ?", (1,))
+MINIAPP_SUMMARY_QUERY = hot_query("get_miniapp_data: сводка за месяц",
+                                  "SELECT type, SUM(total) FROM tx_rollup WHERE user_id = ? AND month >= ? GROUP BY type",
+                                  (1, 202401))
+
+
+def _load_miniapp_sections(conn, user_id, month):
+    """Бюджеты, категории и итоги месяца - части payload, которые пересчитываются целиком"""
+    # Budgets
+    bud_rows = conn.execute(BUDGETS_QUERY, (user_id, month)).fetchall()
+    buds = {r[0]: r[1] for r in bud_rows}
+
+    # Categories - включаем и из таблицы categories, и уникальные из транзакций
+    # Разделяем по типу для удобства фильтрации в MiniApp
+    cat_rows = conn.execute(MINIAPP_CATS_QUERY, (user_id,)).fetchall()
+    tx_cats = conn.execute(MINIAPP_TX_CATS_QUERY, (user_id,)).fetchall()
+
+    # Объединяем и разделяем по типу
+    expense_cats = set()
+    income_cats = set()
+    for name, ctype in cat_rows + tx_cats:
+        if ctype == 'expense':
+            expense_cats.add(name)
+        else:
+            income_cats.add(name)
+
+    cats = {
+        "expense": sorted(list(expense_cats)),
+        "income": sorted(list(income_cats))
+    }
+
+    # Stats
+    summary = dict(conn.execute(MINIAPP_SUMMARY_QUERY, (user_id, month)).fetchall())
+
+    # Calc spent for budgets
+    cat_spent_rows = conn.execute(BUDGET_SPENT_QUERY, (user_id, month)).fetchall()
+    cat_spent = {r[0]: r[1] for r in cat_spent_rows}
+
     budgets_list = []
     # Merge budget info
     all_bud_cats = set(buds.keys()) | set(cat_spent.keys())
     for c in all_bud_cats:
-        l = int(buds.get(c, 0))
-        s = int(cat_spent.get(c, 0))
+        l = json_amount(buds.get(c, 0))
+        s = json_amount(cat_spent.get(c, 0))
         if l > 0 or s > 0:
              budgets_list.append({"n": c, "l": l, "s": s})
-    
-    payload = {
-        "uid": user_id,  # User ID для API запросов
-        "tx": tx,
-        "g": goals,
+
+    return {
         "b": budgets_list,
         "c": cats,
-        "s": {"i": int(inc), "e": int(exp)}, # bal calculated on client
+        "s": {"i": json_amount(summary.get('income', 0)), "e": json_amount(summary.get('expense', 0))}, # bal calculated on client
         "m": datetime.now().strftime("%B")
     }
+
+
+MINIAPP_TX_QUERY = hot_query("get_miniapp_data: последние транзакции", """
+        SELECT id, amount_minor, category, type, ts, description
+        FROM transactions
+        WHERE user_id = ?
+        ORDER BY id DESC LIMIT ?
+    """, (1, 10))
+MINIAPP_GOALS_QUERY = hot_query("get_miniapp_data: цели",
+                                "SELECT id, name, current_amount, target_amount FROM goals WHERE user_id = ?", (1,))
+
+
+def _load_miniapp_data(conn, user_id, limit, month):
+    tx_rows = conn.execute(MINIAPP_TX_QUERY, (user_id, limit)).fetchall()
+    goals_rows = conn.execute(MINIAPP_GOALS_QUERY, (user_id,)).fetchall()
+
+    payload = {
+        "uid": user_id,  # User ID для API запросов
+        "tx": [_tx_item(r) for r in tx_rows],
+        "g": [_goal_item(r) for r in goals_rows],
+    }
+    payload.update(_load_miniapp_sections(conn, user_id, month))
     return payload
 
+
+async def _build_miniapp_data(user_id, limit, month):
+    return await db.read(_load_miniapp_data, user_id, limit, month)
+
+
+SYNC_VERSION_QUERY = hot_query("api_sync: версия и граница журнала",
+                               "SELECT version, log_floor FROM user_data_version WHERE user_id = ?", (1,))
+SYNC_CHANGES_QUERY = hot_query("api_sync: изменения с версии",
+                               "SELECT entity, entity_id FROM change_log WHERE user_id = ? AND seq > ?", (1, 10))
+SYNC_TX_QUERY = hot_query("api_sync: изменённые транзакции",
+                          "SELECT id, amount_minor, category, type, ts, description FROM transactions "
+                          "WHERE user_id = ? AND id IN (SELECT value FROM json_each(?))", (1, "[1, 2]"))
+SYNC_GOALS_QUERY = hot_query("api_sync: изменённые цели",
+                             "SELECT id, name, current_amount, target_amount FROM goals "
+                             "WHERE user_id = ? AND id IN (SELECT value FROM json_each(?))", (1, "[1, 2]"))
+
+
+def _load_sync(conn, user_id, since, month, client_month):
+    """
+    Изменения после версии since для /api/sync, одним снимком базы.
+    Транзакции и цели - изменённые строки ("up") и удалённые id ("del"),
+    бюджеты/категории/итоги зависят от всех транзакций и месяца и присылаются целиком;
+    сменился месяц - они приходят и без изменений в данных.
+    После удалений в "up" добавляются строки, которые заняли их место в последних n.
+    Если журнал уже не покрывает since - полный payload в "full".
+    """
+    conn.execute("BEGIN")
+    try:
+        row = conn.execute(SYNC_VERSION_QUERY, (user_id,)).fetchone()
+        version, floor = row or (0, 0)
+        if since < floor or since > version:
+            return {"seq": version, "mo": month,
+                    "full": dict(_load_miniapp_data(conn, user_id, MINIAPP_TX_LIMIT, month), seq=version, mo=month)}
+        if since == version and client_month == month:
+            return {"seq": version, "mo": month}
+
+        changed = {}
+        for entity, entity_id in conn.execute(SYNC_CHANGES_QUERY, (user_id, since)):
+            changed.setdefault(entity, set()).add(entity_id)
+
+        def rows(sql, entity):
+            ids = changed.get(entity, set())
+            found = conn.execute(sql, (user_id, json.dumps(sorted(ids)))).fetchall() if ids else []
+            return found, sorted(ids - {r[0] for r in found})
+
+        tx_rows, tx_deleted = rows(SYNC_TX_QUERY, "transactions")
+        goal_rows, goals_deleted = rows(SYNC_GOALS_QUERY, "goals")
+        if tx_deleted:
+            # Удалённые могли быть в списке клиента: на их место сдвинулись более старые -
+            # это хвост текущих последних n (не больше числа удалённых)
+            latest = conn.execute(MINIAPP_TX_QUERY, (user_id, MINIAPP_TX_LIMIT)).fetchall()
+            seen = {r[0] for r in tx_rows}
+            tx_rows += [r for r in latest[-len(tx_deleted):] if r[0] not in seen]
+        delta = {
+            "seq": version,
+            "mo": month,
+            "n": MINIAPP_TX_LIMIT,
+            "tx": {"up": [_tx_item(r) for r in tx_rows], "del": tx_deleted},
+            "g": {"up": [_goal_item(r) for r in goal_rows], "del": goals_deleted},
+        }
+        delta.update(_load_miniapp_sections(conn, user_id, month))
+        return delta
+    finally:
+        conn.rollback()
+
+
+COMPACT_USERS_QUERY = hot_query("compact_change_log: пачка пользователей",
+                                "SELECT user_id, version, log_floor FROM user_data_version WHERE user_id > ? "
+                                "ORDER BY user_id LIMIT ?", (0, 200))
+COMPACT_DELETE_QUERY = hot_query("compact_change_log: старые записи пользователя",
+                                 "DELETE FROM change_log WHERE user_id = ? AND seq <= ?", (1, 10))
+
+
+def compact_change_log(conn, after_user, keep=CHANGE_LOG_KEEP, batch=CHANGE_LOG_COMPACT_BATCH):
+    """
+    Оставить последние keep записей журнала пользователям с user_id > after_user (не больше batch).
+    Возвращает (последний user_id пачки или None, если пользователи кончились; сколько строк удалено)
+    """
+    users = conn.execute(COMPACT_USERS_QUERY, (after_user, batch)).fetchall()
+    removed = 0
+    for user_id, version, floor in users:
+        if version - keep > floor:
+            conn.execute("UPDATE user_data_version SET log_floor = ? WHERE user_id = ?", (version - keep, user_id))
+            removed += conn.execute(COMPACT_DELETE_QUERY, (user_id, version - keep)).rowcount
+    return (users[-1][0] if users else None), removed
+
+
+async def compact_change_log_all():
+    """Пройти всех пользователей пачками, каждая - отдельная запись; сколько строк удалено"""
+    after_user, removed = -2 ** 63, 0
+    while after_user is not None:
+        after_user, batch_removed = await db.write(compact_change_log, after_user)
+        removed += batch_removed
+    return removed
+
+
+async def change_log_compactor(every=CHANGE_LOG_COMPACT_EVERY):
+    while True:
+        await asyncio.sleep(every)
+        try:
+            removed = await compact_change_log_all()
+            if removed:
+                logging.info(f"change_log compacted: {removed} rows removed")
+            expired = await db.write(expire_idempotency_keys)
+            if expired:
+                logging.info(f"idempotency_keys: {expired} expired keys removed")
+        except Exception as e:
+            logging.error(f"change_log compaction failed: {e}")
+
+
 @dp.message(F.web_app_data)
 async def web_app_data_handler(message: types.Message):
     try:
-        logging.info(f"DEBUG: WEB APP DATA RECEIVED: {message.web_app_data.data}")
         data = json.loads(message.web_app_data.data)
         action = data.get('action')
         uid = message.from_user.id
+        # Сам payload (суммы, описания) в лог не пишем
+        logging.debug(f"Web app data from {uid}: action={action}, {len(message.web_app_data.data)} bytes")
         
-        resp_text = "✅ Данные обновлены"
-        
-        with sqlite3.connect(DB_PATH) as conn:
-            if action == "add_tx":
-                t_type = data.get('t')   # income/expense
-                amount = float(data.get('a'))
-                cat = data.get('c')
-                desc = data.get('d', '')
-                
-                # Используем save_transaction с защитой от дублей
-                if not save_transaction(uid, amount, cat, t_type, desc):
-                    logging.info(f"Duplicate transaction prevented for user {uid}")
-                    await message.answer("⚠️ Транзакция уже добавлена (защита от дубликатов)")
-                    return
-                
-                resp_text = f"✅ Добавлено: {amount} р. ({cat})"
-                if t_type == "expense":
-                    w = check_budget_exceeded(uid, cat, amount)
-                    if w: resp_text += f"\n\n🚨 {w}"
-                    
-            elif action == "add_goal":
-                name = data.get('n')
-                target = float(data.get('t'))
-                conn.execute("INSERT INTO goals (user_id, name, target_amount, current_amount, created_at) VALUES (?, ?, ?, 0, ?)",
-                             (uid, name, target, datetime.now().strftime("%Y-%m-%d")))
-                resp_text = f"🎯 Цель '{name}' создана!"
-                
-            elif action == "add_budget":
-                cat = data.get('c')
-                limit = float(data.get('l'))
-                m_key = datetime.now().strftime("%Y-%m")
-                conn.execute("DELETE FROM budgets WHERE user_id = ? AND category_name = ? AND month_year = ?", (uid, cat, m_key))
-                conn.execute("INSERT INTO budgets (user_id, category_name, amount, month_year) VALUES (?, ?, ?, ?)", (uid, cat, limit, m_key))
-                resp_text = f"⚖️ Бюджет на '{cat}' установлен!"
-
-            elif action == "top_up_goal":
-                gid = data.get('id')
-                amount = float(data.get('a'))
-                conn.execute("UPDATE goals SET current_amount = current_amount + ? WHERE id = ? AND user_id = ?", (amount, gid, uid))
-                resp_text = f"💰 Копилка пополнена на {amount} р.!"
-
-            conn.commit()
-            logging.info(f"Transaction committed successfully for user {uid}, action: {action}")
+        # Те же разбор и запись, что у /api/action и /api/batch. Ключ из MiniApp совпадает с ключом
+        # HTTP запроса - действие не задвоится, даже если запрос дошёл, а ответ нет и MiniApp
+        # отправил то же через sendData. Без ключа - id апдейта (повторная доставка того же апдейта)
+        if not isinstance(data.get('k'), str) or not data['k']:
+            data['k'] = update_key()
+        parsed = _parse_action(data)
+        resp_text = await db.write(_apply_action, uid, *parsed)
+        if resp_text is None:
+            logging.info(f"Duplicate {action} prevented for user {uid}")
+            await message.answer("⚠️ Уже сохранено (защита от дубликатов)")
+            return
+        _after_actions(uid, [parsed], [resp_text])
+
+        if action == "add_tx" and parsed[1][2] == "expense":
+            amount, cat = parsed[1][:2]
+            w = await check_budget_exceeded(uid, cat, amount)
+            if w: resp_text += f"\n\n🚨 {w}"
+
+        logging.info(f"Transaction committed successfully for user {uid}, action: {action}")
         
         # Update Menu Button (Critical!)
-        await update_user_menu_button(uid)
+        menu_refresher.schedule(uid)
         
         # Just notify user
         await message.answer(resp_text)
@@ -2208,41 +5294,221 @@ async def web_app_data_handler(message: types.Message):
 @dp.message(Command("reset_all_data_secret"))
 async def secret_reset_data(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    with sqlite3.connect(DB_PATH) as conn:
+    def _reset(conn):
         conn.execute("DELETE FROM transactions WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM tx_rollup WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM user_balance WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM report_cache WHERE user_id = ?", (user_id,))
         conn.execute("DELETE FROM goals WHERE user_id = ?", (user_id,))
         conn.execute("DELETE FROM categories WHERE user_id = ?", (user_id,))
         conn.execute("DELETE FROM budgets WHERE user_id = ?", (user_id,))
-        conn.commit()
+    
+    await db.write(_reset)
+    category_index.invalidate(user_id)
+    miniapp_cache.invalidate(user_id)
     
     await state.clear()
-    await update_user_menu_button(user_id) # Reset app state too
+    menu_refresher.schedule(user_id) # Reset app state too
     await message.answer("💥 **ПОЛНЫЙ СБРОС ВЫПОЛНЕН**\nВсе ваши категории, транзакции, цели и бюджеты удалены.\n\nЖмите /start для начала новой жизни.", parse_mode="Markdown")
 
 
 async def main():
-    init_db()
+    if UPDATES_MODE not in ("polling", "webhook"):
+        raise RuntimeError(f"FINGOAL_UPDATES_MODE must be polling or webhook, got {UPDATES_MODE!r}")
+    if UPDATES_MODE == "webhook" and not WEBHOOK_BASE_URL.startswith("https://"):
+        raise RuntimeError("FINGOAL_WEBHOOK_URL (https://...) is required in webhook mode")
+
+    if WORKERS > 1:
+        # Миграции уже выполнил супервизор. Кэши соседи сбрасывают сообщениями peers;
+        # FSM без слоя в памяти - апдейты одного пользователя приходят в разные воркеры
+        fsm_storage.shared = True
+        # Лимит Bot API общий на бота - каждому воркеру его доля
+        send_queue.set_global_limit(SEND_GLOBAL_RATE / WORKERS, SEND_GLOBAL_BURST / WORKERS)
+    else:
+        run_migrations()
+    db.open()
+    await permissions.refresh()
+
+    # Фоновый замер задержки event loop (см. /perf)
+    lag_task = asyncio.create_task(loop_lag.run())
+    # Чистка журнала изменений /api/sync и старых ключей идемпотентности (общая база - хватает одного воркера)
+    compact_task = asyncio.create_task(change_log_compactor()) if WORKER_ID == 0 else None
+    # Пачечная запись last_active
+    activity_task = asyncio.create_task(activity.run())
+    # Сброс FSM в базу и чистка брошенных состояний
+    fsm_task = asyncio.create_task(fsm_storage.run())
+    # Сбросы кэшей от соседних воркеров
+    peers_task = asyncio.create_task(peers.run()) if peers.sock else None
 
     # Настройка API сервера (aiohttp)
-    app = web.Application()
+    app = web.Application(middlewares=[http_metrics_middleware])
     app.router.add_route('*', '/api/action', handle_api_action)  # Новый универсальный эндпоинт
+    app.router.add_route('*', '/api/data', handle_api_data)  # Данные MiniApp (GET с ETag)
+    app.router.add_route('*', '/api/sync', handle_api_sync)  # Изменения после версии (GET ?since=)
+    app.router.add_route('*', '/api/batch', handle_api_batch)  # Пакет действий из очереди MiniApp
+    if UPDATES_MODE == "webhook":
+        # Апдейты Telegram на том же сервере; чужие запросы без секрета получают 401
+        SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
     runner = web.AppRunner(app)
     await runner.setup()
-
-    # Слушаем на всех интерфейсах (0.0.0.0)
-    api_site = web.TCPSite(runner, '0.0.0.0', 8080)
+    # Метрики для Prometheus - отдельное приложение только на localhost
+    metrics_app = web.Application()
+    metrics_app.router.add_get('/metrics', handle_metrics)
+    metrics_runner = web.AppRunner(metrics_app, access_log=None)
+    await metrics_runner.setup()
+
+    # Слушаем на всех интерфейсах (0.0.0.0); воркеры делят порт через SO_REUSEPORT,
+    # ядро раскидывает соединения между ними
+    api_site = web.TCPSite(runner, '0.0.0.0', 8080, reuse_port=WORKERS > 1)
     await api_site.start()
+    await web.TCPSite(metrics_runner, '127.0.0.1', METRICS_PORT + WORKER_ID).start()
 
-    logging.info("API server started on port 8080")
-
-    # Сброс вебхука перед запуском polling
-    await bot.delete_webhook(drop_pending_updates=True)
+    logging.info(f"API server started on port 8080 (worker {WORKER_ID + 1}/{WORKERS}, pid {os.getpid()})")
 
-    # Запуск бота (polling)
-    await dp.start_polling(bot)
+    try:
+        if UPDATES_MODE == "webhook":
+            if WORKER_ID == 0:
+                # Накопившиеся за время перезапуска апдейты не сбрасываем - Telegram дошлёт их сам
+                await bot.set_webhook(WEBHOOK_BASE_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                                      allowed_updates=dp.resolve_used_update_types(), drop_pending_updates=False)
+                logging.info(f"Webhook mode: {WEBHOOK_BASE_URL}{WEBHOOK_PATH}")
+            stop = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, stop.set)
+            await stop.wait()
+        else:
+            # Снимаем вебхук (если бот раньше работал в режиме webhook), очередь апдейтов сохраняем
+            await bot.delete_webhook(drop_pending_updates=False)
+            # Запуск бота (polling). Сессию закрываем сами - после неё ещё досылается очередь
+            await dp.start_polling(bot, close_bot_session=False)
+    finally:
+        lag_task.cancel()
+        if compact_task:
+            compact_task.cancel()
+        activity_task.cancel()
+        fsm_task.cancel()
+        if peers_task:
+            peers_task.cancel()
+        await menu_refresher.flush()
+        # Дослать очередь исходящих (в т.ч. только что поставленные кнопки)
+        await send_queue.close()
+        await bot.session.close()
+        await activity.flush()
+        await fsm_storage.close()
+        await runner.cleanup()
+        await metrics_runner.cleanup()
+        db.close()
+
+
+def run_workers(count):
+    """
+    Супервизор: миграции, затем count процессов main() на общем порту 8080.
+    Упавший воркер перезапускается; SIGTERM/SIGINT передаются воркерам.
+
+    Отдельного процесса-писателя нет: у каждого воркера свой поток записи (Database),
+    и group commit склеивает записи только внутри воркера. Писатели разных воркеров
+    сериализует SQLite (WAL, BEGIN IMMEDIATE, ожидание блокировки до 30 с) - запись
+    не масштабируется по ядрам, масштабируются чтение, JSON и обработка апдейтов.
+    Это осознанный компромисс: запись здесь короткая, а перенос записи в другой
+    процесс потребовал бы сериализовать каждую функцию db.write.
+    Кэши в памяти согласуются сообщениями между воркерами (PeerInvalidation).
+    """
+    global WORKERS
+    WORKERS = count
+    # До fork: в супервизоре не должно быть ни потоков, ни event loop
+    run_migrations()
+    sockets = PeerInvalidation.make_sockets(count)
+
+    children = {}  # pid -> номер воркера
+    stopping = False
+
+    def spawn(worker_id):
+        global WORKER_ID
+        pid = os.fork()
+        if pid:
+            children[pid] = worker_id
+            return
+        WORKER_ID = worker_id
+        use_worker_log_file(worker_id)
+        peers.attach(sockets, worker_id)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        code = 0
+        try:
+            asyncio.run(main())
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        except Exception:
+            logging.exception(f"Worker {worker_id} crashed")
+            code = 1
+        finally:
+            # os._exit не вызывает atexit - дописываем очередь логов сами
+            stop_log_listener()
+            logging.shutdown()
+            os._exit(code)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for worker_id in range(count):
+        spawn(worker_id)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        worker_id = children.pop(pid, None)
+        if worker_id is None or stopping:
+            continue
+        logging.error(f"Worker {worker_id + 1} (pid {pid}) exited with status {status}, restarting")
+        time.sleep(1)
+        spawn(worker_id)
+    logging.info("Bot stopped")
 
 
 if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="FinGoal bot")
+    parser.add_argument("--check-plans", action="store_true",
+                        help="проверить EXPLAIN QUERY PLAN горячих запросов и выйти")
+    parser.add_argument("--rebuild-rollups", action="store_true",
+                        help="пересчитать агрегаты из transactions, показать расхождения и выйти")
+    parser.add_argument("--check-category-matcher", action="store_true",
+                        help="сверить индекс категорий с difflib на тестовом корпусе и выйти")
+    parser.add_argument("--bench-payload", action="store_true",
+                        help="сравнить размер URL MiniApp в старом и компактном формате и выйти")
+    parser.add_argument("--check-send-queue", action="store_true",
+                        help="прогнать очередь отправки против локального фейкового Bot API и выйти")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="число процессов на общем порту 8080 (только FINGOAL_UPDATES_MODE=webhook)")
+    args = parser.parse_args()
+
+    if args.check_plans:
+        sys.exit(check_plans_cli())
+    if args.rebuild_rollups:
+        sys.exit(rebuild_rollups_cli())
+    if args.check_category_matcher:
+        sys.exit(check_category_matcher_cli())
+    if args.bench_payload:
+        sys.exit(bench_payload_cli())
+    if args.check_send_queue:
+        sys.exit(check_send_queue_cli())
+    if args.workers > 1:
+        if UPDATES_MODE != "webhook":
+            parser.error("--workers > 1 requires FINGOAL_UPDATES_MODE=webhook (polling allows one consumer)")
+        run_workers(args.workers)
+        sys.exit(0)
+
     try:
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
@@ -30,6 +30,17 @@ Type=simple
 User=root
 WorkingDirectory=/opt/fingoal
 ExecStart=/usr/bin/python3 bot.py
+# Вебхук вместо polling (апдейты приходят через nginx на /api/telegram):
+# Environment=FINGOAL_UPDATES_MODE=webhook
+# Environment=FINGOAL_WEBHOOK_URL=https://fingoal.ru
+# Несколько процессов на порту 8080 (только вместе с webhook - polling допускает одного получателя):
+# ExecStart=/usr/bin/python3 bot.py --workers 4
+# Масштабируются чтение и обработка апдейтов; запись в SQLite всё равно идёт по очереди
+# между воркерами.
+# Метрики Prometheus - только с самого сервера: http://127.0.0.1:9100/metrics
+# (с --workers у каждого воркера свой порт: 9100, 9101, ...)
+# Подробные логи (bot_debug.log - JSON по строке, ротация по 10 МБ и раз в сутки):
+# Environment=FINGOAL_LOG_LEVEL=DEBUG
 Restart=always
 RestartSec=5
 